@@ -0,0 +1,160 @@
+#!/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Fabian Deutsch <fabiand@fedoraproject.org>
+#
+
+"""
+Measures the requests per second the daemons HTTP server handles under
+the traffic of many slaves: Each slave sends heartbeats and finishes
+steps, while a few clients download slow archives.
+
+    PYTHONPATH=. python benchmarks/http_server.py --server pooled
+    PYTHONPATH=. python benchmarks/http_server.py --server wsgiref
+"""
+
+from igor.daemon import server
+import argparse
+import bottle
+import httplib
+import threading
+import time
+import wsgiref.simple_server
+
+
+def create_app(archive_time):
+    app = bottle.Bottle()
+    lock = threading.Lock()
+    steps = {}
+
+    @app.route("/jobs/<cookie>/heartbeat")
+    def heartbeat(cookie):
+        return "ok"
+
+    @app.route("/jobs/<cookie>/step/<n>/success")
+    def finish_step(cookie, n):
+        with lock:
+            steps[cookie] = int(n)
+        return "{\"current_step\": %s}" % n
+
+    @app.route("/jobs/<cookie>/artifacts.tar.bz2")
+    def archive(cookie):
+        def chunks():
+            # Like compressing a large archive
+            for n in range(10):
+                time.sleep(archive_time / 10.0)
+                yield "x" * 1024
+        return chunks()
+
+    return app
+
+
+def start_server(kind, port, app, workers):
+    if kind == "pooled":
+        srv = server.PooledWSGIServer(("127.0.0.1", port),
+                                      server.KeepAliveRequestHandler,
+                                      workers=workers,
+                                      queue_size=4 * workers)
+    else:
+        srv = wsgiref.simple_server.make_server(
+            "127.0.0.1", port, app,
+            handler_class=wsgiref.simple_server.WSGIRequestHandler)
+    srv.set_app(app)
+    thread = threading.Thread(target=srv.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return srv
+
+
+def slave(port, cookie, until, latencies, errors):
+    connection = httplib.HTTPConnection("127.0.0.1", port, timeout=30)
+    n = 0
+    while time.time() < until:
+        path = "/jobs/%s/heartbeat" % cookie if n % 2 else \
+            "/jobs/%s/step/%d/success" % (cookie, n)
+        started = time.time()
+        try:
+            connection.request("GET", path)
+            response = connection.getresponse()
+            response.read()
+            if response.status != 200:
+                errors.append(response.status)
+        except Exception as e:
+            errors.append(e)
+            connection.close()
+            continue
+        latencies.append(time.time() - started)
+        n += 1
+
+
+def downloader(port, until):
+    while time.time() < until:
+        connection = httplib.HTTPConnection("127.0.0.1", port, timeout=60)
+        try:
+            connection.request("GET", "/jobs/i0/artifacts.tar.bz2")
+            connection.getresponse().read()
+        except Exception:
+            pass
+        connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--server", choices=["pooled", "wsgiref"],
+                        default="pooled")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--slaves", type=int, default=32)
+    parser.add_argument("--downloads", type=int, default=2,
+                        help="Clients downloading slow archives")
+    parser.add_argument("--archive-time", type=float, default=1.0,
+                        help="Seconds it takes to build an archive")
+    parser.add_argument("--duration", type=float, default=10)
+    args = parser.parse_args()
+
+    srv = start_server(args.server, args.port,
+                       create_app(args.archive_time), args.workers)
+    until = time.time() + args.duration
+    latencies, errors = [], []
+    threads = [threading.Thread(target=slave,
+                                args=(args.port, "i%d" % n, until,
+                                      latencies, errors))
+               for n in range(args.slaves)]
+    threads += [threading.Thread(target=downloader, args=(args.port, until))
+                for n in range(args.downloads)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+    srv.shutdown()
+
+    latencies.sort()
+    print "server: %s, %d slaves, %d downloads" % \
+        (args.server, args.slaves, args.downloads)
+    print "requests: %d in %.1fs, %.1f/s, %d errors" % \
+        (len(latencies), elapsed, len(latencies) / elapsed, len(errors))
+    if latencies:
+        print "latency: median %.1fms, 99%% %.1fms, max %.1fms" % \
+            tuple(1000 * latencies[int(q * (len(latencies) - 1))]
+                  for q in (0.5, 0.99, 1))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+#!/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Fabian Deutsch <fabiand@fedoraproject.org>
+#
+
+"""
+Drives many jobs through one JobCenter with fake hosts and slaves, and
+checks that they all finish and that no deadline is missed: The slaves
+which keep sending results pass, those which stall time out in time.
+Prints the latency of finishing a step while other jobs are being set
+up and torn down, exits with 1 if a check failed.
+
+    PYTHONPATH=. python benchmarks/job_center.py --slaves 200
+"""
+
+from igor.daemon import job, main
+import argparse
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+
+class FakeHost(object):
+    """A host whose setup and teardown take some time
+    """
+    session = None
+
+    def __init__(self, name, setup_time):
+        self.name = name
+        self.setup_time = setup_time
+
+    def get_name(self):
+        return self.name
+
+    def prepare(self):
+        time.sleep(self.setup_time)
+
+    def start(self):
+        pass
+
+    def purge(self):
+        time.sleep(self.setup_time)
+
+
+class FakeProfile(object):
+    def get_name(self):
+        return "fake-profile"
+
+    def assign_to(self, host, additional_kargs=""):
+        pass
+
+    def revoke_from(self, host):
+        pass
+
+
+class FakeJobSpec(object):
+    def __init__(self, host, n_steps, step_timeout):
+        testcases = []
+        for n in range(n_steps):
+            testcase = main.Testcase("step-%d.sh" % n)
+            testcase.timeout = step_timeout
+            testcases.append(testcase)
+        self.host = host
+        self.profile = FakeProfile()
+        self.additional_kargs = ""
+        self.testsuite = main.Testsuite("fake", [main.Testset("fake",
+                                                              testcases)])
+
+
+class Slave(threading.Thread):
+    """Runs the steps of one job like the bootstrap script on a host
+    """
+    def __init__(self, jc, cookie, n_steps, step_time, stall_at=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.jc = jc
+        self.job = jc.jobs[cookie]
+        self.cookie = cookie
+        self.n_steps = n_steps
+        self.step_time = step_time
+        self.stall_at = stall_at
+        self.latencies = []
+        self.stalled_at = None
+
+    def run(self):
+        while self.job.state() != job.s_running:
+            if self.job.reached_endstate():
+                return
+            self.job.state_changed.wait(1)
+        for n in range(self.n_steps):
+            time.sleep(random.uniform(0, self.step_time))
+            if n == self.stall_at:
+                self.stalled_at = time.time()
+                return
+            self.jc.heartbeat(self.cookie)
+            started = time.time()
+            self.jc.finish_test_step(self.cookie, n, True)
+            self.latencies.append(time.time() - started)
+
+
+def percentile(values, q):
+    return values[int(q * (len(values) - 1))] if values else 0
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--slaves", type=int, default=200)
+    parser.add_argument("--stalled", type=int, default=10,
+                        help="Slaves which stop sending results")
+    parser.add_argument("--steps", type=int, default=5)
+    parser.add_argument("--step-time", type=float, default=0.5,
+                        help="Longest time a step takes on a slave")
+    parser.add_argument("--step-timeout", type=int, default=5)
+    parser.add_argument("--setup-time", type=float, default=0.2,
+                        help="Time to set up and to tear down a host")
+    parser.add_argument("--setup-workers", type=int, default=16)
+    parser.add_argument("--tolerance", type=float, default=1,
+                        help="Seconds a stalled job may time out late")
+    args = parser.parse_args()
+
+    session_path = tempfile.mkdtemp()
+    jc = job.JobCenter(session_path, hooks_path="/nonexistent",
+                       setup_workers=args.setup_workers,
+                       heartbeat_interval=0,
+                       max_ended_jobs=args.slaves + 1)
+    slaves = []
+    started = time.time()
+    for n in range(args.slaves):
+        spec = FakeJobSpec(FakeHost("host-%d" % n, args.setup_time),
+                           args.steps, args.step_timeout)
+        cookie = jc.submit(spec)["cookie"]
+        stall_at = random.randrange(args.steps) if n < args.stalled \
+            else None
+        slave = Slave(jc, cookie, args.steps, args.step_time, stall_at)
+        slave.start()
+        slaves.append(slave)
+        jc.start_job(cookie)
+
+    for slave in slaves:
+        slave.join()
+    for slave in slaves:
+        while not slave.job.reached_endstate():
+            slave.job.state_changed.wait(1)
+    elapsed = time.time() - started
+
+    failures = []
+    for slave in slaves:
+        state = slave.job.state()
+        if slave.stall_at is None and state != job.s_passed:
+            failures.append("%s ended %s" % (slave.cookie, state))
+        elif slave.stall_at is not None:
+            timed_out_at = slave.job._state_times.get(str(job.s_timedout))
+            late = (timed_out_at or 0) - slave.job.deadline()
+            if timed_out_at is None:
+                failures.append("%s ended %s, not timedout" %
+                                (slave.cookie, state))
+            elif late > args.tolerance:
+                failures.append("%s timed out %.1fs late" %
+                                (slave.cookie, late))
+
+    latencies = sorted(sum([s.latencies for s in slaves], []))
+    print "%d jobs (%d stalled) with %d steps in %.1fs" % \
+        (args.slaves, args.stalled, args.steps, elapsed)
+    print "finish_step latency: median %.1fms, 99%% %.1fms, max %.1fms" % \
+        tuple(1000 * percentile(latencies, q) for q in (0.5, 0.99, 1))
+    for failure in failures:
+        print "FAILED: %s" % failure
+    shutil.rmtree(session_path, ignore_errors=True)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(run())
@@ -0,0 +1,81 @@
+#!/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Fabian Deutsch <fabiand@fedoraproject.org>
+#
+
+"""
+Measures how long parsing the testsets of a synthetic catalog of 10k
+testcases takes with the pure python safe loader, and with the loading
+layer of igor.utils (C loader if available, and it's cache).
+
+    PYTHONPATH=. python benchmarks/yaml_catalog.py
+"""
+
+from igor import utils
+import argparse
+import time
+import yaml
+
+
+def testset_text(n_testcases, n):
+    documents = ["---\ndescription: 'Synthetic testset %d'\n"
+                 "searchpath: '../tcs'\nlibs: []\n" % n]
+    for m in range(n_testcases):
+        documents.append("---\nfilename: 'testcase-%d-%d.sh'\n"
+                         "timeout: %d\nexpect_failure: %s\n" %
+                         (n, m, 60 + m, m % 7 == 0))
+    return "".join(documents)
+
+
+def measure(name, load_all, texts, baseline=None):
+    started = time.time()
+    n_documents = sum(len(load_all(text)) for text in texts)
+    elapsed = time.time() - started
+    speedup = " (%.1fx)" % (baseline / elapsed) if baseline else ""
+    print "%-28s %7.3fs for %d documents%s" % \
+        (name, elapsed, n_documents, speedup)
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--testcases", type=int, default=10000)
+    parser.add_argument("--per-set", type=int, default=100)
+    args = parser.parse_args()
+
+    texts = [testset_text(args.per_set, n)
+             for n in range(args.testcases // args.per_set)]
+    print "Loader: %s" % utils.YamlLoader.__mro__[1].__name__
+
+    baseline = measure("yaml.SafeLoader",
+                       lambda text: list(yaml.load_all(
+                           text, Loader=yaml.SafeLoader)),
+                       texts)
+    measure("utils.yaml_load_all, no cache",
+            lambda text: utils.yaml_load_all(text, cached=False),
+            texts, baseline)
+    utils.yaml_cache.maxsize = max(utils.yaml_cache.maxsize, len(texts))
+    measure("utils.yaml_load_all, cold",
+            utils.yaml_load_all, texts, baseline)
+    measure("utils.yaml_load_all, cached",
+            utils.yaml_load_all, texts, baseline)
+
+
+if __name__ == "__main__":
+    main()
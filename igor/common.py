@@ -45,6 +45,7 @@ class routes(object):
     job_step_finish = '/jobs/<cookie>/step/<n:int>/<result:re:success|failed>'
     job_step_result = '/jobs/<cookie>/step/<n:int>/result'
     job_step_annotate = '/jobs/<cookie>/step/current/annotate'
+    job_heartbeat = '/jobs/<cookie>/heartbeat'
 
     job_set_boot_profile = '/jobs/<cookie>/set/enable_pxe/<enable_pxe>'
     job_set_kernelargs = '/jobs/<cookie>/set/kernelargs/<kernelargs>'
@@ -75,6 +76,9 @@ class routes(object):
     testcase_source = '/testcases/<suitename>/<setname>/<casename>/source'
 
     server_log = '/server/log'
+    server_diagnostics = '/server/diagnostics'
+
+    events = '/events'
 
     datastore = '/store'
     datastore_file = '/store/<filename>'
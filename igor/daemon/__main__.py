@@ -2,17 +2,22 @@
 # -*- coding: utf-8 -*-
 
 from igor import common, log, reports, utils
-from igor.daemon import config, job, main
+from igor.daemon import config, job, main, server, tarstream
 from igor.daemon.hacks import IgordJSONEncoder
 from string import Template
 import StringIO
 import argparse
 import bottle
+import contextlib
 import importlib
 import json
 import os
+import re
 import subprocess
 import tarfile
+import tempfile
+import threading
+import time
 import yaml
 
 log.configure("/tmp/igord.log")
@@ -22,6 +27,17 @@ logger = log.getLogger(__name__)
 logger.info("Starting igor daemon")
 
 BOTTLE_MAX_READ_SIZE = 1024 * 1024 * 512
+# Longest time a status request waits for a change (?wait=)
+LONG_POLL_MAX_WAIT = 300
+# Seconds between two keepalive comments on an idle event stream
+EVENTS_KEEPALIVE = 15
+# Bytes sent at once when following an artifact
+FOLLOW_CHUNK_SIZE = 64 * 1024
+# Longest time an artifact is followed, the client can continue at the
+# offset it reached
+FOLLOW_MAX_DURATION = 60 * 60
+# Bytes written at once when a datastore file is uploaded
+DATASTORE_CHUNK_SIZE = 1024 * 1024
 
 parser = argparse.ArgumentParser()
 parser.add_argument("-c", "--config", help="Config file to use",
@@ -83,23 +99,59 @@ load_backends(CONFIG["daemon"]["enable-backends"]["hosts"],
 #
 # Now prepare the essential objects
 #
-jc = job.JobCenter(session_path=CONFIG["daemon"]["session"]["path"],
-                   hooks_path=CONFIG["daemon"]["hooks"]["path"])
-
+inventory_config = CONFIG["daemon"].get("inventory", {})
 inventory = main.Inventory(
     plans=plan_origins,
     testsuites=testsuite_origins,
     profiles=profile_origins,
-    hosts=host_origins)
+    hosts=host_origins,
+    workers=inventory_config.get("workers", 4),
+    origin_timeout=inventory_config.get("origin_timeout", 30))
 inventory.check()
+inventory.start_refreshing(inventory_config.get("refresh_interval", 60))
 
-
-def to_json(obj):
+jobs_config = CONFIG["daemon"].get("jobs", {})
+jc = job.JobCenter(session_path=CONFIG["daemon"]["session"]["path"],
+                   hooks_path=CONFIG["daemon"]["hooks"]["path"],
+                   setup_workers=jobs_config.get("setup_workers", 4),
+                   heartbeat_interval=jobs_config.get("heartbeat_interval",
+                                                      30),
+                   max_missed_heartbeats=jobs_config.get(
+                       "max_missed_heartbeats", 4),
+                   store_path=jobs_config.get("store", {}).get("path"),
+                   store_commit_interval=jobs_config.get("store", {}).get(
+                       "commit_interval", 1),
+                   max_ended_jobs=jobs_config.get("max_ended_jobs", 10),
+                   cleanup_age=jobs_config.get("cleanup_age", 5 * 60),
+                   inventory=inventory)
+
+artifacts_config = CONFIG["daemon"].get("artifacts", {})
+ARTIFACT_MAX_SIZE = artifacts_config.get("max_size", BOTTLE_MAX_READ_SIZE)
+
+server_config = CONFIG["daemon"].get("server", {})
+# Event streams, followed artifacts and long polls keep a worker busy, only
+# this many of them are served at once so that the other workers stay free
+# for the step and heartbeat calls of the hosts. Long polls are cheap and
+# there is one per watching client, they get their own slots.
+_stream_slots = threading.BoundedSemaphore(server_config.get("max_streams",
+                                                             4))
+_long_poll_slots = threading.BoundedSemaphore(
+    server_config.get("max_long_polls", 8))
+
+
+# (key, format, root tag): serialized response
+_serialized = {}
+_serialized_max_size = 1024
+
+
+def to_json(obj, key=None):
+    """Serialize obj in the requested format
+    If a key is given, the serialization is reused as long as the key
+    stays the same.
+    """
     typ = "json"
     root_tag = "result"
 
-    r = json.dumps(obj, cls=IgordJSONEncoder, sort_keys=True, indent=2)
-
     if "format" in bottle.request.query:
         typ = bottle.request.query["format"]
     if "root" in bottle.request.query:
@@ -108,6 +160,15 @@ def to_json(obj):
     if "x-igor-format-xml" in bottle.request.headers:
         typ = "xml"
 
+    # A single get, an other thread can clear the cache at any time
+    cached = _serialized.get((key, typ, root_tag)) if key is not None \
+        else None
+    if cached is not None:
+        bottle.response.content_type = "application/%s" % typ
+        return cached
+
+    r = json.dumps(obj, cls=IgordJSONEncoder, sort_keys=True, indent=2)
+
     if typ == "xml":
         j = json.loads(r)
         r = "<?xml-stylesheet type='text/xsl' href='/ui/index.xsl' ?>\n"
@@ -117,10 +178,84 @@ def to_json(obj):
         j = json.loads(r)
         r = yaml.dump_all(j)
 
+    if key is not None:
+        if len(_serialized) >= _serialized_max_size:
+            _serialized.clear()
+        _serialized[(key, typ, root_tag)] = r
+
     bottle.response.content_type = "application/%s" % typ
     return r
 
 
+@contextlib.contextmanager
+def stream_slot(slots=_stream_slots):
+    """Take one of the slots for long running requests for the duration of
+    the block, answers 503 if all are taken
+    """
+    if not slots.acquire(False):
+        error = bottle.HTTPError(503, "Too many streams or long polls")
+        error.set_header("Retry-After", "5")
+        raise error
+    try:
+        yield
+    finally:
+        slots.release()
+
+
+def wait_for_version(current_version):
+    """Supports ?since=<version>&wait=<seconds>: Block until
+    current_version() is newer than since, or until wait seconds passed.
+    """
+    since = bottle.request.query.get("since")
+    if since is None:
+        return
+    try:
+        since = int(since)
+        wait = min(float(bottle.request.query.get("wait", 30)),
+                   LONG_POLL_MAX_WAIT)
+    except ValueError:
+        bottle.abort(400, "since and wait need to be numbers")
+    if (current_version() or 0) > since:
+        return
+    with stream_slot(_long_poll_slots):
+        jc.wait_for_change(lambda: (current_version() or 0) > since, wait)
+
+
+def request_body(max_size):
+    """Returns a stream of the request body and it's length, the body is
+    not read into memory.
+    A chunked body has no length (None), it is decoded while it is read
+    and reading it raises server.BodyTooLarge beyond max_size bytes.
+    """
+    request = bottle.request
+    stream = request.environ["wsgi.input"]
+    if "chunked" in request.get_header("Transfer-Encoding", "").lower():
+        return server.ChunkedBody(stream, max_size), None
+    return stream, max(request.content_length, 0)
+
+
+def offset_mismatch(offset):
+    """The reply if an upload does not continue where the artifact ends
+    """
+    bottle.response.status = 416
+    if offset:
+        bottle.response.set_header("Range", "bytes=0-%d" % (offset - 1))
+    return to_json({"offset": offset})
+
+
+def archive_response(iter_archive):
+    """Streams an archive created by iter_archive(codec), the codec can be
+    chosen with ?codec=none|gz|bz2|xz|zstd (xz and zstd if available)
+    """
+    codec = bottle.request.query.get("codec", "bz2")
+    try:
+        chunks = iter_archive(codec)
+    except ValueError as e:
+        bottle.abort(400, str(e))
+    bottle.response.content_type = tarstream.codecs[codec][0]
+    return chunks
+
+
 def check_authentication(user, password):
     return user == password
 
@@ -160,20 +295,52 @@ def dav_get():
 
 @app.route(common.routes.datastore_file)
 def dav_file_get(filename):
-    path = _datastore_filename(filename)
-    with open(path, "rb") as src:
-        return src.read()
+    return server.file_response(_datastore_filename(filename))
 
 
 @app.route(common.routes.datastore_file, method='PUT')
 def dav_file_put(filename):
-    length = bottle.request.headers["Content-Length"]
-    length = int(length) if length else None
+    stream, length = request_body(BOTTLE_MAX_READ_SIZE)
+    if (length or 0) > BOTTLE_MAX_READ_SIZE:
+        bottle.abort(413, "Files may not be larger than %d bytes" %
+                     BOTTLE_MAX_READ_SIZE)
     path = _datastore_filename(filename)
-    with open(path, "w") as dst:
-        data = bottle.request.body.read(length)  # @UndefinedVariable
-        logger.debug("Wrote '%s'" % path)
-        dst.write(data)
+    try:
+        received = _receive_file(path, stream, length)
+    except server.BodyTooLarge as e:
+        bottle.abort(413, str(e))
+    except IOError as e:
+        bottle.abort(400, str(e))
+    logger.debug("Wrote %d bytes to '%s'" % (received, path))
+
+
+def _receive_file(path, stream, length):
+    """Write length bytes (all if None) of stream to a temporary file next
+    to path, and move it into place once all arrived. On errors path is
+    left as it was.
+    """
+    fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(path),
+                                   prefix=".%s." % os.path.basename(path))
+    received = 0
+    try:
+        with os.fdopen(fd, "wb") as dst:
+            while length is None or received < length:
+                chunk = stream.read(DATASTORE_CHUNK_SIZE if length is None
+                                    else min(DATASTORE_CHUNK_SIZE,
+                                             length - received))
+                if not chunk:
+                    break
+                dst.write(chunk)
+                received += len(chunk)
+        if length is not None and received < length:
+            raise IOError("Body ended after %d of %d bytes" %
+                          (received, length))
+        os.chmod(tmppath, 0o644)
+        os.rename(tmppath, path)
+    except:
+        os.unlink(tmppath)
+        raise
+    return received
 
 
 @app.route(common.routes.datastore_file, method='DELETE')
@@ -204,16 +371,17 @@ def dav_file_trigger(filename):
 @app.route('/jobs/submit/<tname>/with/<pname>/on/<hname>')
 @app.route('/jobs/submit/<tname>/with/<pname>/on/<hname>/<cookiereq>')  # FIXME
 def submit_testsuite(tname, pname, hname, cookiereq=None):
+    items = {}
     for key, name in [("testsuites", tname),
                       ("profiles", pname),
                       ("hosts", hname)]:
-        item = inventory._lookup(key, name)
-        if item is None:
+        items[key] = inventory._lookup(key, name)
+        if items[key] is None:
             bottle.abort(412, "Unknown %s '%s'" % (key, name))
     xkargs = bottle.request.query.additional_kargs
-    spec = main.JobSpec(testsuite=inventory.testsuites()[tname],
-                        profile=inventory.profiles()[pname],
-                        host=inventory.hosts()[hname],
+    spec = main.JobSpec(testsuite=items["testsuites"],
+                        profile=items["profiles"],
+                        host=items["hosts"],
                         additional_kargs=xkargs or "")
     logger.debug("Submitting with args: %s" % str(spec))
     resp = jc.submit(spec, cookiereq)
@@ -223,7 +391,19 @@ def submit_testsuite(tname, pname, hname, cookiereq=None):
 
 @app.route(common.routes.jobs)
 def get_jobs():
-    return to_json(jc.get_jobs())
+    """All jobs in memory and the last archived ones, ?archived=<n> sets
+    how many (default 100), ?archived_since=<time> only returns archived
+    jobs created later
+    """
+    query = bottle.request.query
+    try:
+        limit = int(query.get("archived", 100))
+        since = float(query["archived_since"]) \
+            if "archived_since" in query else None
+    except ValueError:
+        bottle.abort(400, "archived and archived_since need to be numbers")
+    wait_for_version(lambda: jc.version)
+    return to_json(jc.get_jobs(limit, since))
 
 
 @app.route(common.routes.job_start)
@@ -234,30 +414,39 @@ def start_job(cookie):
     return to_json(m)
 
 
+def job_summary(cookie):
+    """The dict of a job, also of archived ones
+    """
+    j = jc.job_summary(cookie)
+    if j is None:
+        bottle.abort(404, "Unknown job '%s'" % cookie)
+    return j if type(j) is dict else j.__to_dict__()
+
+
 @app.route(common.routes.job_status)
 def job_status(cookie):
-    if cookie not in jc.jobs:
+    j = jc.job_summary(cookie)
+    if j is None:
         bottle.abort(404, "Unknown job '%s'" % cookie)
-    m = jc.jobs[cookie]
-    return to_json(m)
+    if type(j) is dict:
+        # Archived jobs don't change anymore
+        return to_json(j, key=(cookie, "archived"))
+    wait_for_version(lambda: j.version)
+    return to_json(j, key=j.snapshot_key())
 
 
 @app.route(common.routes.job_report)
 def job_report(cookie):
-    if cookie not in jc.jobs:
-        bottle.abort(404, "Unknown job '%s'" % cookie)
-    j = jc.jobs[cookie]
+    j = job_summary(cookie)
     bottle.response.content_type = "text/plain; charset=utf8"
-    return str(reports.job_status_to_report(j.__to_dict__()))
+    return str(reports.job_status_to_report(j))
 
 
 @app.route(common.routes.job_report_junit)
 def job_report_junit(cookie):
-    if cookie not in jc.jobs:
-        bottle.abort(404, "Unknown job '%s'" % cookie)
-    j = jc.jobs[cookie]
+    j = job_summary(cookie)
     bottle.response.content_type = "application/xml; charset=utf8"
-    return str(reports.job_status_to_junit(j.__to_dict__()))
+    return str(reports.job_status_to_junit(j))
 
 
 @app.route(common.routes.job_step_skip)
@@ -276,6 +465,14 @@ def finish_step(cookie, n, result):
     return to_json(m)
 
 
+@app.route(common.routes.job_heartbeat)
+def heartbeat(cookie):
+    if cookie not in jc.jobs:
+        bottle.abort(404, "Unknown job '%s'" % cookie)
+    state = jc.heartbeat(cookie)
+    return to_json({"state": state})
+
+
 @app.route(common.routes.job_step_result)
 def get_step(cookie, step):
     if cookie not in jc.jobs:
@@ -290,7 +487,10 @@ def annotate_step(cookie):
         bottle.abort(404, "Unknown job '%s'" % cookie)
     j = jc.jobs[cookie]
     data = bottle.request.body.read(BOTTLE_MAX_READ_SIZE)  # @UndefinedVariable
-    j.annotate(data)
+    try:
+        j.annotate(data)
+    except yaml.YAMLError as e:
+        bottle.abort(409, "Existing annotations can not be read: %s" % e)
 
 
 @app.route(common.routes.job, method='DELETE')
@@ -310,11 +510,9 @@ def get_job_testsuite_archive(cookie):
     if cookie not in jc.jobs:
         bottle.abort(404, "Unknown job '%s'" % cookie)
     t = jc.jobs[cookie].testsuite
-    r = t.get_archive()
-    if not r:
+    if not t:
         bottle.abort(404, 'No testsuite for %s' % (cookie))
-
-    return r.getvalue()
+    return archive_response(lambda codec: t.iter_archive(codec=codec))
 
 
 @app.route(common.routes.job_artifacts)
@@ -331,28 +529,157 @@ def get_artifacts_archive(cookie):
     if cookie not in jc.jobs:
         bottle.abort(404, "Unknown job '%s'" % cookie)
     j = jc.jobs[cookie]
-    bottle.response.content_type = "application/x-bzip2"
-    return j.get_artifacts_archive().getvalue()
+    return archive_response(j.iter_artifacts_archive)
 
 
 @app.route(common.routes.job_artifact, method='PUT')
 def add_artifact(cookie, name):
+    """Streams the body to disk.
+    Large artifacts can be sent in parts using Content-Range
+    (bytes <first>-<last>/<total>), an upload which broke can be continued
+    at the offset returned by a 416 response.
+    An optional ?checksum=<algorithm>:<hexdigest> (e.g. sha256:…) is
+    verified once the artifact is complete.
+    """
     if cookie not in jc.jobs:
         bottle.abort(404, "Unknown job '%s'" % cookie)
     if "/" in name:
         bottle.abort(412, "Name may not contain slashes")
     j = jc.jobs[cookie]
-    data = bottle.request.body.read(BOTTLE_MAX_READ_SIZE)  # @UndefinedVariable
-    j.add_artifact_to_current_step(name, data)
+
+    request = bottle.request
+    stream, length = request_body(ARTIFACT_MAX_SIZE)
+    offset, total = 0, None
+    content_range = request.get_header("Content-Range")
+    if content_range:
+        if length is None:
+            bottle.abort(411, "Content-Range needs a Content-Length")
+        m = re.match(r"bytes (\d+)-(\d+)/(\d+|\*)$", content_range.strip())
+        if not m or int(m.group(2)) - int(m.group(1)) + 1 != length:
+            bottle.abort(400, "Invalid Content-Range: %s" % content_range)
+        offset = int(m.group(1))
+        total = None if m.group(3) == "*" else int(m.group(3))
+
+    if max(offset + (length or 0), total) > ARTIFACT_MAX_SIZE:
+        bottle.abort(413, "Artifacts may not be larger than %d bytes" %
+                     ARTIFACT_MAX_SIZE)
+    uploaded = j.uploaded_size_for_current_step(name)
+    if offset and offset != uploaded:
+        return offset_mismatch(uploaded)
+
+    try:
+        aname, complete = j.upload_artifact_to_current_step(
+            name, stream, length, offset, total,
+            request.query.get("checksum"))
+    except server.BodyTooLarge as e:
+        bottle.abort(413, str(e))
+    except IOError as e:
+        bottle.abort(400, str(e))
+    except ValueError as e:
+        bottle.abort(412, str(e))
+    return to_json({"name": aname,
+                    "offset": offset + (length if length is not None
+                                        else stream.received),
+                    "complete": complete})
+
+
+@app.route(common.routes.job_artifact, method='POST')
+def append_artifact(cookie, name):
+    """Appends the body to an artifact of the job, e.g. to stream a log.
+    With ?offset=<size> the append is only done if the artifact has this
+    size, otherwise the reply is 416 with the current size.
+    """
+    if cookie not in jc.jobs:
+        bottle.abort(404, "Unknown job '%s'" % cookie)
+    if "/" in name:
+        bottle.abort(412, "Name may not contain slashes")
+    j = jc.jobs[cookie]
+
+    size = j.artifact_size(name)
+    stream, length = request_body(ARTIFACT_MAX_SIZE - size)
+    if size + (length or 0) > ARTIFACT_MAX_SIZE:
+        bottle.abort(413, "Artifacts may not be larger than %d bytes" %
+                     ARTIFACT_MAX_SIZE)
+    offset = bottle.request.query.get("offset")
+    try:
+        offset = None if offset is None else int(offset)
+    except ValueError:
+        bottle.abort(400, "offset needs to be a number")
+
+    try:
+        size = j.append_artifact(name, stream, length, offset)
+    except server.BodyTooLarge as e:
+        bottle.abort(413, str(e))
+    except IOError as e:
+        bottle.abort(400, str(e))
+    except ValueError:
+        return offset_mismatch(j.artifact_size(name))
+    return to_json({"name": name, "offset": size})
 
 
 @app.route(common.routes.job_artifact)
 def get_artifact(cookie, name):
+    """Returns an artifact, or with ?offset=<n> the part after n bytes, or
+    with ?tail=<n> the last n bytes.
+    ?follow=1 keeps sending what gets appended until the job ended, or
+    at most FOLLOW_MAX_DURATION seconds.
+    """
     if cookie not in jc.jobs:
         bottle.abort(404, "Unknown job '%s'" % cookie)
     j = jc.jobs[cookie]
+    query = bottle.request.query
     bottle.response.content_type = "text/plain; charset=utf8"
-    return str(j.get_artifact(name))
+    if not (query.get("offset") or query.get("tail") or query.get("follow")):
+        if "/" in name:
+            bottle.abort(412, "Name may not contain slashes")
+        return server.file_response(j.artifact_filename(name),
+                                    "text/plain; charset=utf8")
+
+    try:
+        offset = int(query.get("offset", 0))
+        if query.get("tail"):
+            offset = max(0, j.artifact_size(name) - int(query.get("tail")))
+    except ValueError:
+        bottle.abort(400, "offset and tail need to be numbers")
+
+    if not query.get("follow"):
+        # Streamed like the whole artifact, the rest is not read into memory
+        if "/" in name:
+            bottle.abort(412, "Name may not contain slashes")
+        filename = j.artifact_filename(name)
+        if not os.path.isfile(filename):
+            bottle.abort(404, "Unknown artifact '%s'" % name)
+        size = os.path.getsize(filename)
+        offset = min(max(0, offset), size)
+        body = server.FileRange(open(filename, "rb"), offset, size - offset)
+        return bottle.HTTPResponse(body, headers={
+            "Content-Type": "text/plain; charset=utf8",
+            "Content-Length": str(size - offset)})
+
+    environ = bottle.request.environ
+    until = time.time() + FOLLOW_MAX_DURATION
+
+    def follow(offset):
+        # The generator is started by bottle before the response is sent,
+        # so a 503 can still be raised here
+        with stream_slot():
+            while time.time() < until:
+                if j.artifact_size(name) > offset:
+                    data, offset = j.read_artifact(name, offset,
+                                                   FOLLOW_CHUNK_SIZE)
+                    yield data
+                elif j.reached_endstate():
+                    break
+                elif server.client_disconnected(environ):
+                    # Nothing is written while waiting, so the server
+                    # would not notice it
+                    logger.debug("Client stopped following %s" % name)
+                    break
+                else:
+                    j.wait_for_artifact(name, offset,
+                                        min(EVENTS_KEEPALIVE,
+                                            max(0, until - time.time())))
+    return follow(offset)
 
 
 @app.route('/firstboot/<cookie>')
@@ -391,7 +718,8 @@ def get_bootstrap_script(cookie):
     r = Template(script).safe_substitute(
         igor_cookie=cookie,
         igor_current_step=jc.jobs[cookie].current_step,
-        igor_testsuite=jc.jobs[cookie].testsuite.name
+        igor_testsuite=jc.jobs[cookie].testsuite.name,
+        igor_heartbeat_interval=jc.heartbeat_interval or 0
     )
 
     if not r:
@@ -417,24 +745,19 @@ def validate_testsuites():
 
 @app.route(common.routes.testsuite_summary)
 def get_testsuite_summary(name):
-    testsuites = inventory.testsuites()
-    if name not in testsuites:
+    testsuite = inventory.testsuites(name)
+    if testsuite is None:
         bottle.abort(404, "Unknown testsuite '%s'" % name)
-    return to_json(testsuites[name])
+    return to_json(testsuite)
 
 
 @app.route(common.routes.testsuite_archive)
 @app.route(common.routes.testsuite_archive + '/<tarball>')
 def get_testsuite_archive(name, tarball="testsuite.tar"):
-    testsuites = inventory.testsuites()
-    if name not in testsuites:
+    t = inventory.testsuites(name)
+    if t is None:
         bottle.abort(404, "Unknown testsuite '%s'" % name)
-    t = testsuites[name]
-    r = t.get_archive()
-    if not r:
-        bottle.abort(404, 'No testsuite for %s' % (name))
-    bottle.response.content_type = "application/x-tar; charset=binary"
-    return r.getvalue()
+    return archive_response(lambda codec: t.iter_archive(codec=codec))
 
 
 @app.route(common.routes.testplans)
@@ -444,17 +767,17 @@ def list_plans():
 
 @app.route(common.routes.testplan)
 def plan_info(name):
-    if name not in inventory.plans():
+    if inventory.plans(name) is None:
         bottle.abort(404, "Unknown plan: %s" % name)
-    plan = inventory.plans()[name]
+    plan = inventory.plans(name)
     return to_json(plan)
 
 
 @app.route(common.routes.testplan_start)
 def run_plans(name):
-    if name not in inventory.plans():
+    if inventory.plans(name) is None:
         bottle.abort(404, "Unknown plan: %s" % name)
-    plan = inventory.plans()[name]
+    plan = inventory.plans(name).instantiate()
     plan.inventory = inventory      # FIXME not very nice
     plan.variables.update({k: bottle.request.query[k]
                            for k in bottle.request.query.keys()})
@@ -464,22 +787,23 @@ def run_plans(name):
 
 @app.route(common.routes.testplan)
 def testplan_summary(name):
-    if name not in inventory.plans():
+    if inventory.plans(name) is None:
         bottle.abort(404, "Unknown plan: %s" % name)
-    return to_json(inventory.plans()[name])
+    return to_json(inventory.plans(name))
 
 
 @app.route(common.routes.testplan_status)
 def status_plans(name):
-    if name not in inventory.plans():
+    if inventory.plans(name) is None:
         bottle.abort(404, "Unknown plan: %s" % name)
+    wait_for_version(lambda: jc.plan_version(name))
     r = jc.status_plan(name)
     return to_json(r)
 
 
 @app.route(common.routes.testplan_report)
 def testplan_report(name):
-    if name not in inventory.plans():
+    if inventory.plans(name) is None:
         bottle.abort(404, "Unknown plan: %s" % name)
     r = jc.status_plan(name)
     bottle.response.content_type = "text/plain; charset=utf8"
@@ -488,7 +812,7 @@ def testplan_report(name):
 
 @app.route(common.routes.testplan_report_junit)
 def testplan_junit_report(name):
-    if name not in inventory.plans():
+    if inventory.plans(name) is None:
         bottle.abort(404, "Unknown plan: %s" % name)
     r = jc.status_plan(name)
     bottle.response.content_type = "application/xml; charset=utf8"
@@ -498,7 +822,7 @@ def testplan_junit_report(name):
 
 @app.route(common.routes.testplan_abort)
 def abort_plans(name):
-    if name not in inventory.plans():
+    if inventory.plans(name) is None:
         bottle.abort(404, "Unknown plan: %s" % name)
     r = jc.abort_plan(name)
     return to_json(r.__to_dict__())
@@ -516,10 +840,9 @@ def list_hosts():
 
 @app.route(common.routes.testcase_source)
 def testcase_source(suitename, setname, casename):
-    testsuites = inventory.testsuites()
-    if suitename not in testsuites:
+    suite = inventory.testsuites(suitename)
+    if suite is None:
         bottle.abort(404, "Unknown testsuite '%s'" % suitename)
-    suite = testsuites[suitename]
     tset = None
     for _tset in suite.testsets:
         if _tset.name == setname:
@@ -575,7 +898,8 @@ def profile_from_vmlinuz_put(pname):
 @app.route(common.routes.profile_set_kernelargs, method='GET')
 @app.route(common.routes.profile_set_kernelargs, method='POST')
 def profile_kargs(pname):
-    if pname not in inventory.profiles():
+    profile = inventory.profiles(pname)
+    if profile is None:
         bottle.abort(404, "Unknown profile")
     kargs = bottle.request.forms.kargs
     n_kargs = "NO_KARGS_FOUND"
@@ -584,24 +908,26 @@ def profile_kargs(pname):
             bottle.abort(412, "{igor_cookie} not found in kargs, this is " +
                               "needed to initiate the callback to Igor, " +
                               "e.g. boot_trigger=igor/testjob/{igor_cookie}")
-        n_kargs = inventory.profiles()[pname].kargs(kargs)
+        n_kargs = profile.kargs(kargs)
     else:
 #        bottle.abort(412, "No kargs specified")
-        n_kargs = inventory.profiles()[pname].kargs()
+        n_kargs = profile.kargs()
     return n_kargs
 
 
 @app.route(common.routes.profile, method='DELETE')
 @app.route(common.routes.profile_delete)
 def delete_profile(pname):
-    if pname not in inventory.profiles():
+    profile = inventory.profiles(pname)
+    if profile is None:
         bottle.abort(404, "Unknown profile")
     try:
-        inventory.profiles()[pname].delete()
+        profile.delete()
     except Exception as e:
         # FIXME could be solved in the cobblre backend
         logger.warning("An error occurred while removing a " +
                        "profile: %s (%s)" % (e.message, e))
+    inventory.invalidate("profiles")
 
 
 @app.route(common.routes.server_log)
@@ -609,9 +935,73 @@ def get_log():
     bottle.response.content_type = "text/plain; charset=utf8"
     return log.backlog()
 
+
+@app.route(common.routes.events)
+def get_events():
+    """A Server-Sent Events stream of the hook events, optionally only of
+    one job (?cookie=) or plan (?plan=).
+    Events missed while disconnected are replayed if still kept.
+    """
+    query = bottle.request.query
+    since = bottle.request.get_header("Last-Event-ID", "")
+    bottle.response.content_type = "text/event-stream"
+    bottle.response.set_header("Cache-Control", "no-cache")
+
+    def stream():
+        # Started by bottle before the response is sent, see get_artifact
+        with stream_slot():
+            subscriber = jc.events.subscribe(cookie=query.get("cookie"),
+                                             plan=query.get("plan"),
+                                             since=int(since)
+                                             if since.isdigit() else None)
+            try:
+                dropped = 0
+                while True:
+                    events = subscriber.get(EVENTS_KEEPALIVE)
+                    if subscriber.dropped > dropped:
+                        # The client was too slow, it needs to refetch the
+                        # state
+                        yield "event: dropped\ndata: %d\n\n" % \
+                            (subscriber.dropped - dropped)
+                        dropped = subscriber.dropped
+                    if not events:
+                        yield ": keepalive\n\n"
+                    for event in events:
+                        yield "id: %d\nevent: %s\ndata: %s\n\n" % \
+                            (event["id"], event["type"], json.dumps(event))
+            finally:
+                jc.events.unsubscribe(subscriber)
+    return stream()
+
+
+@app.route(common.routes.server_diagnostics)
+def get_diagnostics():
+    return to_json({"inventory": inventory.diagnostics()})
+
+
+def run_server():
+    """Run the configured server, either the pooled server, bottles single
+    threaded wsgiref server, or any other server bottle has an adapter for
+    """
+    server_type = server_config.get("type", "pooled")
+    host = server_config.get("host", "0.0.0.0")
+    port = server_config.get("port", 8080)
+    if server_type == "pooled":
+        adapter = server.PooledServer(
+            host=host, port=port,
+            workers=server_config.get("workers", 16),
+            queue_size=server_config.get("queue_size", 64),
+            request_timeout=server_config.get("request_timeout", 60),
+            keepalive_timeout=server_config.get("keepalive_timeout", 5))
+    else:
+        adapter = bottle.server_names[server_type](
+            host=host, port=port, **server_config.get("options", {}))
+    bottle.run(app, server=adapter, reloader=False)
+
+
 if __name__ == "__main__":
     try:
     #    logger.info("Starting igord")
-        bottle.run(app, host='0.0.0.0', port=8080, reloader=False)
+        run_server()
     except KeyboardInterrupt:
         logger.debug("Ending igor")
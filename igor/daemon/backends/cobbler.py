@@ -63,6 +63,9 @@ class ProfileOrigin(main.Origin):
     """
     cobbler = None
 
+    # Profiles keep per-assignment state
+    reusable_items = False
+
     def __init__(self, server_url, user, pw, ssh_uri,
                  remote_path_prefix):
         self.cobbler = Cobbler(server_url, (user, pw), ssh_uri)
@@ -83,6 +86,7 @@ class ProfileOrigin(main.Origin):
     def create_item(self, pname, kernel_file, initrd_file, kargs_file):
         profile = Profile(self.cobbler, pname, self.remote_path_prefix)
         profile.populate_with(kernel_file, initrd_file, kargs_file)
+        self._changed()
 
 
 class HostsOrigin(main.Origin):
@@ -160,6 +164,12 @@ class Host(files.Host):
     def purge(self):
         self._power("off")
 
+    def __getstate__(self):
+        # The connection to Cobbler is not kept
+        state = files.Host.__getstate__(self)
+        state.pop("remote", None)
+        return state
+
     def _power(self, t):
         r = None
         if t != "status":
@@ -186,6 +196,12 @@ class Profile(main.Profile):
         self.name = profile_name
         self.remote_path_prefix = remote_path_prefix
 
+    def __getstate__(self):
+        # The connection to Cobbler is not kept
+        state = main.Profile.__getstate__(self)
+        state.pop("remote", None)
+        return state
+
     def get_name(self):
         return self.name
 
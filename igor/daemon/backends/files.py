@@ -20,36 +20,57 @@
 
 from igor import log, utils
 from igor.daemon import main
+import cPickle as pickle
 import glob
+import hashlib
 import os
 import tarfile
 import tempfile
-import yaml
+import threading
+import time
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
 
 
 logger = log.getLogger(__name__)
 
+# Shared by all origins of this backend, created by initialize_origins
+catalog = None
+
 
 def initialize_origins(category, CONFIG):
+    global catalog
     origins = []
 
+    if catalog is None:
+        cache_config = CONFIG.get("cache", {})
+        catalog = Catalog(check_interval=cache_config.get("check_interval",
+                                                          1),
+                          path=cache_config.get("path", None),
+                          watch=cache_config.get("watch", False))
+
     superorigin = TestDraftSuperOrigin(tempfile.mkdtemp())
 
     if category == "testplan":
         origins += [("draft-files",
                      superorigin.get_testplans_origin()),
                     ("files",
-                     TestplansOrigin(CONFIG["testplans"]["paths"]))]
+                     TestplansOrigin(CONFIG["testplans"]["paths"],
+                                     catalog))]
 
     if category == "testsuite":
         origins += [("draft-files",
                      superorigin.get_testsuites_origin()),
                     ("files",
-                     TestsuitesOrigin(CONFIG["testcases"]["paths"]))]
+                     TestsuitesOrigin(CONFIG["testcases"]["paths"],
+                                      catalog))]
 
     if category == "host":
         origins += [("files",
-                     HostsOrigin(CONFIG["hosts"]["paths"]))]
+                     HostsOrigin(CONFIG["hosts"]["paths"], catalog))]
 
     return origins
 
@@ -90,17 +111,114 @@ class Host(main.Host):
         return hash(str(self))
 
 
+class LazyTestsuite(main.Testsuite):
+    """A testsuite of which initially just the header (the first document
+    of the suite file) is read.
+    The testsets are read on first access.
+    """
+    filename = None
+    loaded_at = None
+
+    # Called with the suite once the testsets were loaded
+    on_load = None
+    # The InternTable to get the testsets from
+    interned = None
+
+    _testsets = None
+
+    def __init__(self, name, filename, interned=None):
+        self.name = name
+        self.filename = filename
+        self.interned = interned
+
+    @property
+    def testsets(self):
+        if self._testsets is None:
+            self.loaded_at = time.time()
+            self._testsets = Factory.testsets_from_testsuite_file(
+                self.filename, self.interned)
+            if self.on_load:
+                self.on_load(self)
+        return self._testsets
+
+    def is_loaded(self):
+        return self._testsets is not None
+
+    def __getstate__(self):
+        state = main.Testsuite.__getstate__(self)
+        state.pop("on_load", None)
+        state.pop("interned", None)
+        return state
+
+
+class InternTable(object):
+    """Hands out shared, frozen Testsets and Testcases.
+    Sets are keyed by the resolved path of the set file and are only read
+    again if the file changed. Testcases are keyed by their resolved path
+    and properties, and are replaced if their file changed.
+
+    >>> interned = InternTable()
+    >>> a = interned.testset("testcases/sets/example.set")
+    >>> a is interned.testset("testcases/sets/example.set")
+    True
+    """
+    _testsets = None
+    _testcases = None
+
+    def __init__(self):
+        self._testsets = {}
+        self._testcases = {}
+
+    def testset(self, filename):
+        key = os.path.realpath(filename)
+        mtime = _mtime(key)
+        entry = self._testsets.get(key)
+        if entry is None or entry[0] != mtime:
+            testset = Factory.testset_from_file(filename, interned=self)
+            entry = (mtime, testset)
+            self._testsets[key] = entry
+        return entry[1]
+
+    def testcase(self, filename, props):
+        path = os.path.realpath(filename)
+        key = (path, repr(sorted(props.items())))
+        mtime = _mtime(path)
+        entry = self._testcases.get(key)
+        if entry is None or entry[0] != mtime:
+            testcase = main.Testcase(filename=filename)
+            testcase.update_props(props)
+            testcase.freeze()
+            entry = (mtime, testcase)
+            self._testcases[key] = entry
+        return entry[1]
+
+    def forget(self, filename):
+        """Drop the set or the testcases read from filename
+        """
+        path = os.path.realpath(filename)
+        self._testsets.pop(path, None)
+        for key in [k for k in self._testcases.keys() if k[0] == path]:
+            self._testcases.pop(key, None)
+
+
 class HostsOrigin(main.Origin):
     paths = None
+    catalog = None
 
-    def __init__(self, paths):
+    def __init__(self, paths, catalog=None):
         self.paths = paths
+        self.catalog = catalog
+        if self.catalog:
+            self.catalog.subscribe(self._changed, "hosts", self.paths)
 
     def name(self):
         return "FilesystemRealHostsOrigin(%s)" % self.paths
 
     def items(self):
-        hosts = Factory.hosts_from_paths(self.paths)
+        if self.catalog:
+            hosts = self.catalog.hosts(self.paths)
+        else:
+            hosts = Factory.hosts_from_paths(self.paths)
         for key in hosts:
             hosts[key].origin = self
         return hosts
@@ -108,35 +226,53 @@ class HostsOrigin(main.Origin):
 
 class TestsuitesOrigin(main.Origin):
     paths = None
+    catalog = None
 
-    def __init__(self, paths):
+    def __init__(self, paths, catalog=None):
         if type(paths) is not list:
             paths = [paths]
         self.paths = paths
+        self.catalog = catalog
+        if self.catalog:
+            self.catalog.subscribe(self._changed, "testsuites", self.paths)
 
     def name(self):
         return "FilesystemTestsuitesOrigin(%s)" % self.paths
 
     def items(self):
+        if self.catalog:
+            return self.catalog.testsuites(self.paths)
         testsuites = Factory.testsuites_from_paths(self.paths)
         return testsuites
 
+    def names(self):
+        return Factory.names_from_paths(self.paths, ".suite")
+
 
 class TestplansOrigin(main.Origin):
     paths = None
+    catalog = None
 
-    def __init__(self, paths):
+    def __init__(self, paths, catalog=None):
         if type(paths) is not list:
             paths = [paths]
         self.paths = paths
+        self.catalog = catalog
+        if self.catalog:
+            self.catalog.subscribe(self._changed, "testplans", self.paths)
 
     def name(self):
         return "FilesystemPlansOrigin(%s)" % self.paths
 
     def items(self):
+        if self.catalog:
+            return self.catalog.testplans(self.paths)
         plans = Factory.testplans_from_paths(self.paths)
         return plans
 
+    def names(self):
+        return Factory.names_from_paths(self.paths, ".plan")
+
 
 class TestDraftSuperOrigin(object):
     __temporary_path = None
@@ -207,6 +343,7 @@ class TestDraftSuperOrigin(object):
 
         def create_item(self, dname, archive):
             self.superorigin.create_item(dname, archive)
+            self._changed()
 
 
 class Factory(utils.Factory):
@@ -281,7 +418,22 @@ class Factory(utils.Factory):
         return plans
 
     @staticmethod
-    def testsuites_from_path(path, suffix=".suite"):
+    def names_from_paths(paths, suffix):
+        """The names of all items in paths - without reading the files.
+
+        >>> Factory.names_from_paths(["testcases/suites/"], ".suite")
+        ['examplesuite']
+        """
+        names = []
+        for path in [str.strip(p) for p in paths]:
+            pat = os.path.join(path, "*%s" % suffix)
+            names += [os.path.basename(f).replace(suffix, "")
+                      for f in sorted(glob.glob(pat))]
+        return names
+
+    @staticmethod
+    def testsuites_from_path(path, suffix=".suite", lazy=False,
+                             interned=None):
         """Builds a dict of testsuites from *.suite files in a path.
         A filesystem layout could look like:
             suites/basic.suite
@@ -298,13 +450,14 @@ class Factory(utils.Factory):
             raise RuntimeError("Testsuites path does not exist: %s" % path)
         suites = {}
         pat = os.path.join(path, "*%s" % suffix)
+        interned = interned or InternTable()
         for f in glob.glob(pat):
-            suite = Factory.testsuite_from_file(f)
+            suite = Factory.testsuite_from_file(f, suffix, lazy, interned)
             suites[suite.name] = suite
         return suites
 
     @staticmethod
-    def testsuites_from_paths(paths, suffix=".suite"):
+    def testsuites_from_paths(paths, suffix=".suite", lazy=False):
         """Builds a dict of testsuites from *.suite files in a list of paths.
         If more testsuites with the same name exist, the suite in the latest
         path is winning.
@@ -316,17 +469,22 @@ class Factory(utils.Factory):
         >>> suite = suites["examplesuite"]
         """
         suites = {}
+        interned = InternTable()
         paths = [str.strip(p) for p in paths]
         for path in paths:
-            suites.update(Factory.testsuites_from_path(path, suffix))
+            suites.update(Factory.testsuites_from_path(path, suffix, lazy,
+                                                       interned))
         return suites
 
     @staticmethod
-    def testsuite_from_file(filename, suffix=".suite"):
+    def testsuite_from_file(filename, suffix=".suite", lazy=False,
+                            interned=None):
         """Builds a Testsuite from a testsuite file.
         The *.suite files are expected to contain one testset file per line.
         The testset files path is relative to the testsuite file.
         Testsets can appear more than once.
+        If lazy is True, a LazyTestsuite is returned.
+        The testsets are taken from interned, if given.
 
         A sample testsuite could look like:
             ---
@@ -338,38 +496,64 @@ class Factory(utils.Factory):
             sets:
               - 'example.set'
               - 'selinux.set'
+
+        >>> suite = Factory.testsuite_from_file(
+        ...     "testcases/suites/examplesuite.suite", lazy=True)
+        >>> suite.is_loaded()
+        False
+        >>> len(suite.testcases()) > 0
+        True
         """
+        name = os.path.basename(filename).replace(suffix, "")
 
-        documents = Factory.__read_yaml(filename)
-#        set_fields = ["sets"]  # searchpath
+        if lazy:
+            properties = Factory.__read_yaml_header(filename)
+            suite = LazyTestsuite(name=name, filename=filename,
+                                  interned=interned)
+        else:
+            documents = Factory.__read_yaml(filename)
+            properties = documents[0]
+            sets = Factory._testsets_from_blocks(filename, documents[1:],
+                                                 interned)
+            suite = main.Testsuite(name=name, testsets=sets)
+        suite.__dict__.update(properties)
+
+        return suite
 
-        properties, blocks = (documents[0],
-                              [d for d in documents[1:] if d is not None])
+    @staticmethod
+    def testsets_from_testsuite_file(filename, interned=None):
+        """Builds the testsets of a testsuite file
+        """
+        documents = Factory.__read_yaml(filename)
+        return Factory._testsets_from_blocks(filename, documents[1:],
+                                             interned)
 
+    @staticmethod
+    def _testsets_from_blocks(filename, blocks, interned=None):
+        # set_fields = ["sets"]  # searchpath
         sets = []
         testsuitedir = os.path.dirname(filename)
-        for block in blocks:
+        for block in [b for b in blocks if b is not None]:
             searchpath = "."
             if "searchpath" in block:
                 searchpath = block["searchpath"]
             for tset in block["sets"]:
                 tsetfn = os.path.join(testsuitedir, searchpath, tset)
                 tsetfn = os.path.relpath(os.path.realpath(tsetfn))
-                testset = Factory.testset_from_file(tsetfn)
+                if interned:
+                    testset = interned.testset(tsetfn)
+                else:
+                    testset = Factory.testset_from_file(tsetfn)
                 sets.append(testset)
-
-        name = os.path.basename(filename).replace(suffix, "")
-        suite = main.Testsuite(name=name, testsets=sets)
-        suite.__dict__.update(properties)
-
-        return suite
+        return sets
 
     @staticmethod
-    def testset_from_file(filename, suffix=".set"):
-        """Builds a Testset from a testset file.
+    def testset_from_file(filename, suffix=".set", interned=None):
+        """Builds a frozen Testset from a testset file.
         The *.set files are expected to contain one testcase file and
         optionally some arguments per line.
         The testcase files path is relative to the testset file.
+        The testcases are taken from interned, if given.
 
         Example of a testset file:
             ---
@@ -402,13 +586,19 @@ class Factory(utils.Factory):
         for l in layouts:
             tcasefn = os.path.join(testsetdir, searchpath, l["filename"])
             tcasefn = os.path.relpath(os.path.realpath(tcasefn))
-            testcase = main.Testcase(filename=tcasefn)
-            del l["filename"]
-            testcase.__dict__.update(l)
+            props = {k: v for k, v in l.items() if k != "filename"}
+            if interned:
+                testcase = interned.testcase(tcasefn, props)
+            else:
+                testcase = main.Testcase(filename=tcasefn)
+                testcase.update_props(props)
             cases.append(testcase)
 
         name = os.path.basename(filename).replace(suffix, "")
-        return main.Testset(name=name, testcases=cases, libs=libs)
+        testset = main.Testset(name=name, testcases=cases, libs=libs)
+        testset.filename = filename
+        testset.freeze()
+        return testset
 
     @staticmethod
     def hosts_from_file(filename, suffix=".hosts"):
@@ -426,7 +616,7 @@ class Factory(utils.Factory):
         default_key = "DEFAULT"
 
         data = open(filename).read()
-        documents = yaml.load_all(data)
+        documents = utils.yaml_load_all(data)
         hosts = {}
         # Read hosts from file
         for document in documents:
@@ -477,3 +667,530 @@ class Factory(utils.Factory):
         for path in paths:
             hosts.update(Factory.hosts_from_path(path, suffix))
         return hosts
+
+
+def _mtime(filename):
+    """The mtime of filename or None if it does not exist
+    """
+    try:
+        return os.stat(filename).st_mtime
+    except OSError:
+        return None
+
+
+def _digest(filename):
+    """The sha1 hexdigest of the content of filename or None
+    """
+    try:
+        with open(filename, "rb") as src:
+            return hashlib.sha1(src.read()).hexdigest()
+    except IOError:
+        return None
+
+
+def _testsuite_sources(suite):
+    """All files a testsuite was built from (besides the suite file)
+    """
+    if isinstance(suite, LazyTestsuite) and not suite.is_loaded():
+        return []
+    return ([tset.filename for tset in suite.testsets] +
+            [case.filename for case in suite.testcases()])
+
+
+def _merge_unique(plans):
+    merged = {}
+    for plan in plans:
+        assert plan.name not in merged, "Only unique plan names allowed"
+        merged[plan.name] = plan
+    return merged
+
+
+def _merge_dicts(dicts):
+    merged = {}
+    for d in dicts:
+        merged.update(d)
+    return merged
+
+
+class Catalog(object):
+    """A change-aware cache around the Factory.
+    Each object built from a file is kept together with the mtimes of all
+    the files it was built from (for a suite this includes its sets and
+    testcases). An object is only rebuilt if one of these files changed,
+    everything else is served from memory.
+    The listings of the paths are reused for check_interval seconds before
+    the files are checked again.
+
+    If the catalog is watching, the files are not checked on access.
+    Instead a watcher reports changed files and only the objects built from
+    them (e.g. the suites using a changed set) and the listings are
+    rebuilt.
+
+    If a path is given, the catalog is stored there after changes and
+    loaded from there on creation. The loaded objects are served right
+    away, while they are checked against the filesystem in the background.
+    Files with a different mtime but the same content (sha1) are not
+    rebuilt.
+
+    Listings and objects are built and the catalog is stored without
+    holding the lock, meanwhile the previous listing is served.
+
+    >>> c = Catalog()
+    >>> suites = c.testsuites(["testcases/suites/"])
+    >>> "examplesuite" in suites
+    True
+    >>> c.testsuites(["testcases/suites/"]) is suites
+    True
+    """
+    # Bump this if the layout of the catalog or the pickled classes change
+    VERSION = 1
+
+    # kind: (build(filename, interned), sources(obj), merge(objs))
+    kinds = {
+        "testsuites": (lambda fn, interned:
+                       Factory.testsuite_from_file(fn, lazy=True,
+                                                   interned=interned),
+                       _testsuite_sources,
+                       lambda suites: {s.name: s for s in suites}),
+        "testplans": (lambda fn, interned: Factory.testplan_from_file(fn),
+                      lambda plan: [], _merge_unique),
+        "hosts": (lambda fn, interned: Factory.hosts_from_file(fn),
+                  lambda hosts: [], _merge_dicts)
+    }
+
+    check_interval = None
+    path = None
+
+    _entries = None
+    _listings = None
+    _dependents = None
+    _outdated = None
+    _interned = None
+    _lock = None
+    _is_dirty = False
+    # Keys of the listings which are being rebuilt
+    _building = None
+    _save_lock = None
+
+    _watcher = None
+    _listeners = None
+
+    def __init__(self, check_interval=1, path=None, watch=False):
+        self.check_interval = check_interval
+        self.path = path
+        self._entries = {}
+        self._listings = {}
+        self._dependents = {}
+        self._outdated = set()
+        self._interned = InternTable()
+        self._listeners = []
+        self._lock = threading.RLock()
+        self._building = set()
+        self._save_lock = threading.Lock()
+        if watch:
+            self._watcher = create_watcher(self.file_changed,
+                                           check_interval)
+        if self.path:
+            self.load()
+
+    def subscribe(self, callback, kind=None, paths=None):
+        """Call callback() when a watched file changed, if kind and paths
+        are given only if it changed a listing of them
+        """
+        paths = tuple(str.strip(p) for p in paths) if paths else None
+        self._listeners.append((callback, kind, paths))
+
+    def testsuites(self, paths, suffix=".suite"):
+        """A dict of testsuites, see Factory.testsuites_from_paths
+        """
+        return self._listing("testsuites", paths, suffix)
+
+    def testplans(self, paths, suffix=".plan"):
+        """A dict of testplans, see Factory.testplans_from_paths
+        """
+        return self._listing("testplans", paths, suffix)
+
+    def hosts(self, paths, suffix=".hosts"):
+        """A dict of hosts, see Factory.hosts_from_paths
+        """
+        return self._listing("hosts", paths, suffix)
+
+    def _listing(self, kind, paths, suffix, force=False):
+        """Returns the merged objects built from all files with suffix in
+        paths. The result is reused until check_interval has passed or -
+        if watching - until a file changed.
+        """
+        build, sources, merge = self.kinds[kind]
+        paths = [str.strip(p) for p in paths]
+        key = (kind, tuple(paths), suffix)
+        with self._lock:
+            checked_at, items = self._listings.get(key, (None, None))
+            if checked_at is not None and not force and \
+               (self._watcher or
+                    time.time() - checked_at < self.check_interval):
+                return items
+            if key in self._building and items is not None:
+                # Another thread rebuilds it
+                return items
+            self._building.add(key)
+
+        try:
+            check = force or not self._watcher
+            objs = []
+            seen = set()
+            for path in paths:
+                if not os.path.exists(path):
+                    raise RuntimeError("Path does not exist: %s" % path)
+                if self._watcher:
+                    self._watcher.watch(path)
+                pat = os.path.join(path, "*%s" % suffix)
+                for filename in sorted(glob.glob(pat)):
+                    objs.append(self._lookup(filename, build, sources,
+                                             check))
+                    seen.add(filename)
+            items = merge(objs)
+
+            with self._lock:
+                # Forget about objects whose files were removed
+                for filename in self._entries.keys():
+                    if filename.endswith(suffix) and filename not in seen \
+                       and _mtime(filename) is None:
+                        self._forget(filename)
+                self._listings[key] = (time.time(), items)
+                do_save = self._is_dirty and self.path
+        finally:
+            with self._lock:
+                self._building.discard(key)
+
+        if do_save:
+            self.save()
+        return items
+
+    def _lookup(self, filename, build, sources, check=True):
+        """Returns the object built from filename, it's only (re-)built if
+        it's unknown, was reported as changed or if any of the files it was
+        built from changed (only if check is True).
+        The object is built without holding the lock.
+        """
+        with self._lock:
+            entry = self._entries.get(filename)
+            is_outdated = filename in self._outdated
+            if entry is not None and not is_outdated and not check:
+                return entry[1]
+            # A change reported while building outdates it again
+            self._outdated.discard(filename)
+        if entry is not None and not is_outdated and \
+           self._is_current(entry[0]):
+            if self._watcher:
+                self._watch(filename, entry[0])
+            return entry[1]
+
+        logger.debug("(Re-)Building objects from %s" % filename)
+        mtime = _mtime(filename)
+        try:
+            obj = build(filename, self._interned)
+        except Exception:
+            with self._lock:
+                self._outdated.add(filename)
+            raise
+        stamps = {fn: [_mtime(fn), None] for fn in sources(obj) if fn}
+        stamps[filename] = [mtime, None]
+        with self._lock:
+            is_outdated = filename in self._outdated
+            self._forget(filename)
+            if is_outdated:
+                self._outdated.add(filename)
+            self._entries[filename] = (stamps, obj)
+            for fn in stamps:
+                self._dependents.setdefault(os.path.abspath(fn),
+                                            set()).add(filename)
+            self._is_dirty = True
+        if self._watcher:
+            self._watch(filename, stamps)
+        self._track_lazy_loading(filename, obj, sources)
+        return obj
+
+    def _track_lazy_loading(self, filename, obj, sources):
+        if isinstance(obj, LazyTestsuite):
+            obj.interned = self._interned
+            obj.on_load = lambda suite: self._add_late_sources(filename,
+                                                               sources)
+
+    def _add_late_sources(self, filename, sources):
+        """Track the sources of objects which were loaded lazily after they
+        were built
+        """
+        with self._lock:
+            entry = self._entries.get(filename)
+            if entry is None:
+                return
+            stamps, obj = entry
+            for fn in sources(obj):
+                if not fn or fn in stamps:
+                    continue
+                mtime = _mtime(fn)
+                if mtime is None or mtime > obj.loaded_at:
+                    # Changed after loading, outdate it on the next check
+                    mtime = None
+                stamps[fn] = [mtime, None]
+                self._dependents.setdefault(os.path.abspath(fn),
+                                            set()).add(filename)
+                if self._watcher:
+                    self._watcher.watch(fn)
+                self._is_dirty = True
+
+    def _forget(self, filename):
+        """Drop the object built from filename
+        """
+        self._outdated.discard(filename)
+        entry = self._entries.pop(filename, None)
+        if entry is not None:
+            for fn in entry[0]:
+                self._dependents.get(os.path.abspath(fn),
+                                     set()).discard(filename)
+            self._is_dirty = True
+
+    def _watch(self, filename, stamps):
+        for fn in stamps:
+            self._watcher.watch(fn)
+
+    def _is_current(self, stamps):
+        for filename, stamp in stamps.items():
+            mtime, digest = stamp
+            current_mtime = _mtime(filename)
+            if current_mtime == mtime:
+                continue
+            if digest is None or current_mtime is None or \
+               _digest(filename) != digest:
+                return False
+            # Just touched, the content is the same
+            stamp[0] = current_mtime
+        return True
+
+    def file_changed(self, filename):
+        """Called by the watcher if filename (a file or dir) changed.
+        Marks the objects built from it as outdated, the listings which
+        contain them or the file get rebuilt on the next access.
+
+        >>> c = Catalog()
+        >>> changes = []
+        >>> c.subscribe(lambda: changes.append("plans"), "testplans",
+        ...             ["testcases/"])
+        >>> c.subscribe(lambda: changes.append("suites"), "testsuites",
+        ...             ["testcases/suites/"])
+        >>> _ = c.testsuites(["testcases/suites/"])
+        >>> _ = c.testplans(["testcases/"])
+        >>> c.file_changed("testcases/suites/examplesuite.suite")
+        >>> changes
+        ['suites']
+        """
+        filename = os.path.abspath(filename)
+        with self._lock:
+            outdated = self._dependents.get(filename, set())
+            logger.debug("%s changed, outdates %s" % (filename,
+                                                      list(outdated)))
+            self._outdated.update(outdated)
+            self._interned.forget(filename)
+            changed = set([filename]) | \
+                set(os.path.abspath(fn) for fn in outdated)
+            # Rebuilding a listing is cheap, the entries are kept
+            affected = [key for key in self._listings
+                        if self._affects(changed, *key)]
+            for key in affected:
+                self._listings[key] = (None, self._listings[key][1])
+            listed = set(key[:2] for key in self._listings)
+            listeners = list(self._listeners)
+        affected = set(key[:2] for key in affected)
+        for callback, kind, paths in listeners:
+            if kind is None or (kind, paths) in affected or \
+               ((kind, paths) not in listed and
+                    self._affects(changed, kind, paths, "")):
+                callback()
+
+    @staticmethod
+    def _affects(changed, kind, paths, suffix):
+        """If a change of the (absolute) filenames changes the listing of
+        paths: The dir itself changed, or a file with suffix in it
+        """
+        dirnames = set(os.path.abspath(p) for p in paths)
+        for filename in changed:
+            if filename in dirnames or \
+               (os.path.dirname(filename) in dirnames and
+                    filename.endswith(suffix)):
+                return True
+        return False
+
+    def save(self):
+        """Store all entries and listings at path
+        A copy is taken under the lock, the digests are calculated and the
+        copy is written without holding it.
+        """
+        with self._save_lock:
+            with self._lock:
+                entries = {filename: ({fn: list(stamp) for fn, stamp
+                                       in stamps.items()}, obj)
+                           for filename, (stamps, obj)
+                           in self._entries.items()}
+                listings = dict(self._listings)
+                self._is_dirty = False
+
+            digests = {}
+            for stamps, obj in entries.values():
+                for filename, stamp in stamps.items():
+                    # Only if the file did not change since it was read
+                    if stamp[1] is None and _mtime(filename) == stamp[0]:
+                        if filename not in digests:
+                            digests[filename] = (stamp[0],
+                                                 _digest(filename))
+                        stamp[1] = digests[filename][1]
+            data = {"version": Catalog.VERSION,
+                    "entries": entries,
+                    "listings": listings}
+            tmpfilename = self.path + ".tmp"
+            try:
+                with open(tmpfilename, "wb") as dst:
+                    pickle.dump(data, dst, pickle.HIGHEST_PROTOCOL)
+                os.rename(tmpfilename, self.path)
+            except Exception:
+                with self._lock:
+                    self._is_dirty = True
+                raise
+
+            # Keep the digests, so they are only calculated once
+            with self._lock:
+                for stamps, obj in self._entries.values():
+                    for filename, stamp in stamps.items():
+                        if stamp[1] is None and \
+                           digests.get(filename, (None,))[0] == stamp[0]:
+                            stamp[1] = digests[filename][1]
+        logger.debug("Stored catalog in %s" % self.path)
+
+    def load(self):
+        """Load a previously stored catalog and check it in the background
+        """
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "rb") as src:
+                data = pickle.load(src)
+            if data["version"] != Catalog.VERSION:
+                raise RuntimeError("Version %s, expected %s" %
+                                   (data["version"], Catalog.VERSION))
+        except Exception as e:
+            logger.warning("Ignoring catalog %s: %s" % (self.path, e))
+            return
+
+        with self._lock:
+            self._entries = data["entries"]
+            for filename, (stamps, obj) in self._entries.items():
+                for fn in stamps:
+                    self._dependents.setdefault(os.path.abspath(fn),
+                                                set()).add(filename)
+                self._track_lazy_loading(filename, obj, _testsuite_sources)
+            # Serve the stored listings until they were checked
+            self._listings = {key: (time.time(), items) for key, (_, items)
+                              in data["listings"].items()}
+        logger.info("Loaded catalog with %d entries from %s" %
+                    (len(self._entries), self.path))
+
+        verifier = threading.Thread(target=self.verify)
+        verifier.daemon = True
+        verifier.start()
+
+    def verify(self):
+        """Check all listings against the filesystem
+        """
+        for kind, paths, suffix in self._listings.keys():
+            try:
+                self._listing(kind, paths, suffix, force=True)
+            except Exception as e:
+                logger.warning("Failed to verify %s in %s: %s" %
+                               (kind, paths, e))
+        logger.debug("Verified catalog")
+
+
+def create_watcher(callback, interval=1):
+    """Returns a started watcher reporting changed files to callback.
+    inotify is used if pyinotify is available, otherwise the files are
+    polled every interval seconds.
+    """
+    if pyinotify:
+        watcher = InotifyWatcher(callback)
+    else:
+        logger.info("pyinotify is not available, polling for changes")
+        watcher = PollingWatcher(callback, interval)
+    watcher.start()
+    return watcher
+
+
+class InotifyWatcher(object):
+    """Watches the directories of all files and reports changed entries
+    """
+    callback = None
+
+    _dirs = None
+    _manager = None
+    _notifier = None
+
+    def __init__(self, callback):
+        self.callback = callback
+        self._dirs = set()
+        self._manager = pyinotify.WatchManager()
+
+        def on_event(event):
+            self.callback(event.pathname)
+
+        self._notifier = pyinotify.ThreadedNotifier(self._manager, on_event)
+        self._notifier.daemon = True
+
+    def start(self):
+        self._notifier.start()
+
+    def stop(self):
+        self._notifier.stop()
+
+    def watch(self, filename):
+        """Watch filename (by watching it's directory) or a directory
+        """
+        path = os.path.abspath(filename)
+        if not os.path.isdir(path):
+            path = os.path.dirname(path)
+        if path in self._dirs:
+            return
+        self._dirs.add(path)
+        mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_CREATE | \
+            pyinotify.IN_DELETE | pyinotify.IN_MOVED_TO | \
+            pyinotify.IN_MOVED_FROM | pyinotify.IN_ATTRIB
+        self._manager.add_watch(path, mask)
+
+
+class PollingWatcher(utils.PollingWorkerDaemon):
+    """Polls the mtimes of all files and reports changed ones
+    Directories are reported when entries were added or removed.
+    """
+    callback = None
+
+    _mtimes = None
+    _lock = None
+
+    def __init__(self, callback, interval=1):
+        self.callback = callback
+        self._mtimes = {}
+        self._lock = threading.Lock()
+        utils.PollingWorkerDaemon.__init__(self, interval)
+
+    def watch(self, filename):
+        path = os.path.abspath(filename)
+        with self._lock:
+            if path not in self._mtimes:
+                self._mtimes[path] = _mtime(path)
+
+    def work(self):
+        with self._lock:
+            mtimes = self._mtimes.items()
+        for path, mtime in mtimes:
+            current_mtime = _mtime(path)
+            if current_mtime != mtime:
+                with self._lock:
+                    self._mtimes[path] = current_mtime
+                self.callback(path)
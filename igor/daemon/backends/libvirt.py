@@ -28,6 +28,7 @@ import re
 import shutil
 import subprocess
 import tempfile
+import threading
 
 
 logger = log.getLogger(__name__)
@@ -165,6 +166,10 @@ class VMHost(main.Host):
 
     remove_afterwards = True
 
+    # VMs created for a job are not known by their name, and the
+    # connection is just it's URI
+    kept_with_job = True
+
     _connection = None
 
     def __init__(self, name, connection_uri=None, remove=True):
@@ -449,6 +454,9 @@ class CommonLibvirtOrigin(main.Origin):
 
 
 class CreateDomainHostOrigin(CommonLibvirtOrigin):
+    # Each job needs it's own host, they are created from the template
+    reusable_items = False
+
     def name(self):
         return "VMAlwaysCreateHostOrigin(%s)" % str(self.__dict__)
 
@@ -492,6 +500,8 @@ class LibvirtProfile(main.Profile):
     """A kernel, initrd + kargs
     A libvirt profile is actually just a dict with kernel,initrd and kargs
     Assigning happens by populating the domain definition with this values
+    Each host the profile is assigned to gets it's own boot ISO and
+    volume, they carry the cookie of the hosts job.
     """
 
     origin = None
@@ -501,7 +511,9 @@ class LibvirtProfile(main.Profile):
     # FIXME
     _datadir_prefix = "/var/tmp/igor"
     _datadir = None
-    _boot_iso = None
+
+    # The profiles only live in the memory of the origin
+    kept_with_job = True
 
     __isolinux_bin = "/usr/share/syslinux/isolinux.bin"
 
@@ -511,10 +523,12 @@ class LibvirtProfile(main.Profile):
 
     __previous_values = {}
 
-    __host = None
-    __additional_kargs = None
-
-    _volname = None
+    # host name: (host, additional kargs) of the hosts assigned to
+    __hosts = None
+    # volume name: connection of the boot volumes created
+    __volumes = None
+    # Guards the assignments, the isolinux.cfg and the ISOs
+    __lock = None
 
     def __init__(self, name):
         self.name = name
@@ -525,49 +539,75 @@ class LibvirtProfile(main.Profile):
         self._root_dir = os.path.join(self._datadir, "iso_root")
         self._isolinux_dir = os.path.join(self._root_dir, "isolinux")
 
-        self._boot_iso = os.path.join(self._datadir, "boot.iso")
-
         self.__created_files = []
+        self.__hosts = {}
+        self.__volumes = {}
+        self.__lock = threading.RLock()
         super(LibvirtProfile, self).__init__()
 
+    def __getstate__(self):
+        """Kept with a job the profile only needs to know which hosts it
+        was assigned to, to revoke it from the host of the job
+        """
+        state = main.Profile.__getstate__(self)
+        state.pop("_LibvirtProfile__lock", None)
+        state["_LibvirtProfile__hosts"] = {n: (None, kargs) for n, (h, kargs)
+                                           in self.__hosts.items()}
+        state["_LibvirtProfile__volumes"] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__lock = threading.RLock()
+
     def get_name(self):
         return self.name
 
     def assign_to(self, host, additional_kargs=""):
         assert VMHost in host.__class__.mro()
 
-        self.__host = host
-        self.__additional_kargs = additional_kargs
-
-        self._volname = "%s-boot" % self.get_name()
-        self.__mkiso(additional_kargs)
-        self.__host.change_cdrom_source(self._volname)
+        with self.__lock:
+            self.__hosts[host.get_name()] = (host, additional_kargs)
+            volname = self.__mkiso(host, additional_kargs)
+        host.change_cdrom_source(volname)
 
     def revoke_from(self, host):
-        assert self.__host == host
+        with self.__lock:
+            assigned = self.__hosts.pop(host.get_name(), None)
+        assert assigned is not None, \
+            "Profile %s is not assigned to %s" % (self.name, host)
         try:
-            self.__host.change_cdrom_source(None)
+            host.change_cdrom_source(None)
         except etree.XMLSyntaxError:
             logger.debug("Can' revoke profile from %s, might be deleted." %
                          host)
 
     def kargs(self, kargs):
-        """get or set kargs
+        """Rebuild the ISOs of all assigned hosts with the additional kargs
         """
-        self.__mkiso(kargs)
+        with self.__lock:
+            for name, (host, previous_kargs) in self.__hosts.items():
+                self.__hosts[name] = (host, kargs)
+                self.__mkiso(host, kargs)
 
     def enable_pxe(self, host, enable):
         if enable:
-            self.assign_to(host, self.__additional_kargs)
+            with self.__lock:
+                assigned, kargs = self.__hosts.get(host.get_name(),
+                                                   (None, ""))
+            self.assign_to(host, kargs)
         else:
             self.revoke_from(host)
 
     def delete(self):
-        for filename in self.__created_files:
-            logger.debug("Removing %s" % filename)
-            os.remove(filename)
-        self.__created_files = []
-        self.__host._connection.delete_volume(self._volname)
+        with self.__lock:
+            for filename in self.__created_files:
+                logger.debug("Removing %s" % filename)
+                os.remove(filename)
+            self.__created_files = []
+            for volname, connection in self.__volumes.items():
+                connection.delete_volume(volname)
+            self.__volumes = {}
 
     def populate_with(self, kernel_file, initrd_file, kargs_file):
         self.__prepare_iso_root(kernel_file, initrd_file, kargs_file)
@@ -598,11 +638,17 @@ class LibvirtProfile(main.Profile):
             shutil.copyfile(srcfilename, dstfile)
             self.__created_files += [dstfile]
 
-    def __mkiso(self, additional_kargs):
+    def __mkiso(self, host, additional_kargs):
         """This is a hack as long as igor doesn't use isos directly
         http://www.syslinux.org/wiki/index.php/ISOLINUX
+        Must be called with the lock held, the isolinux.cfg is shared.
+
+        Returns:
+            The name of the boot volume of host
         """
-        assert self.__host
+        volname = "%s-%s-boot" % (self.get_name(), host.get_name())
+        boot_iso = os.path.join(self._datadir,
+                                "boot-%s.iso" % host.get_name())
 
         cmdlinefile = os.path.join(self._isolinux_dir, "cmdline")
 
@@ -611,7 +657,7 @@ class LibvirtProfile(main.Profile):
         logger.debug("Read kargs: %s" % kargs)
         logger.debug("Additional kargs: %s" % additional_kargs)
 
-        cookie = self.__host.session.cookie
+        cookie = host.session.cookie
         appendline = " ".join(kargs.split() + additional_kargs.split())
         appendline = appendline.format(igor_cookie=cookie)
 
@@ -630,7 +676,7 @@ class LibvirtProfile(main.Profile):
             cfg.write(data)
 
         cmd = ["mkisofs",
-               "-output", self._boot_iso,
+               "-output", boot_iso,
                "-no-emul-boot",
                "-eltorito-boot", "isolinux/isolinux.bin",
                "-eltorito-catalog", "isolinux/boot.cat",
@@ -640,9 +686,10 @@ class LibvirtProfile(main.Profile):
 
         subprocess.check_output(cmd)
 
-        image = DiskImage(self._boot_iso, "256M", "raw")
-        self.__host._connection.create_volume(image, self._volname)
-        return self._volname
+        image = DiskImage(boot_iso, "256M", "raw")
+        host._connection.create_volume(image, volname)
+        self.__volumes[volname] = host._connection
+        return volname
 
 
 class ProfileOrigin(CommonLibvirtOrigin):
@@ -674,3 +721,4 @@ class ProfileOrigin(CommonLibvirtOrigin):
         profile.populate_with(kernel_file, initrd_file, kargs_file)
         self.__profiles.append(profile)
         logger.debug("Created libvirt profile: %s" % profile)
+        self._changed()
@@ -18,10 +18,9 @@
 # Author: Fabian Deutsch <fabiand@fedoraproject.org>
 #
 
-from igor import log
+from igor import log, utils
 import os
 import pprint
-import yaml
 
 logger = log.getLogger(__name__)
 
@@ -51,7 +50,7 @@ def parse_config(fn="igord.cfg", updates=None):
     filename = locate_config_file(fn)
     logger.info("Loading config from: %s" % filename)
     with open(filename) as src:
-        config = yaml.load(src.read())
+        config = utils.yaml_load(src.read(), cached=False)
 
     logger.debug("Config: %s" % pprint.pformat(config))
 
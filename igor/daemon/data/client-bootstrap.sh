@@ -10,20 +10,33 @@
 SESSION=${igor_cookie}
 CURRENT_STEP=${igor_current_step}
 TESTSUITE=${igor_testsuite}
+HEARTBEAT_INTERVAL=${igor_heartbeat_interval}
 TMPDIR=$(mktemp -d /tmp/oat.XXXXXX)
 LOGFILE=${TMPDIR}/testsuite.log
+LOG_STREAM_INTERVAL=2
+# The daemon answers 503 when it is busy, curl retries then
+CURL_RETRIES=5
 
 # 
 # Functions
 #
 debug() { echo "$SESSION $(date) - $@" >&2 ; }
-debug_curl() { debug "Calling $1" ; curl --silent "$1" ; }
+debug_curl() { debug "Calling $1" ; curl --silent --retry $CURL_RETRIES "$1" ; }
 api_url() { echo "${APIURL%/}/${1#/}" ; }
 api_call() { debug_curl $(api_url "$1") ; }
 step_succeeded() { api_call jobs/$SESSION/step/$CURRENT_STEP/success ; }
 step_failed()    { api_call jobs/$SESSION/step/$CURRENT_STEP/failed ; }
 skip_step()      { api_call jobs/$SESSION/step/$CURRENT_STEP/skip ; }
 step_result()    { api_call jobs/$SESSION/step/${1}/result ; }
+heartbeat()      { curl --silent --retry $CURL_RETRIES $(api_url jobs/$SESSION/heartbeat) ; }
+start_heartbeat()
+{
+  [[ $HEARTBEAT_INTERVAL -gt 0 ]] || return 0
+  debug "Sending a heartbeat every ${HEARTBEAT_INTERVAL}s"
+  { while true ; do heartbeat > /dev/null ; sleep $HEARTBEAT_INTERVAL ; done ; } &
+  HEARTBEAT_PID=$!
+}
+stop_heartbeat() { [[ -n $HEARTBEAT_PID ]] && kill $HEARTBEAT_PID ; }
 add_artifact()
 {
   local DST=$1
@@ -35,10 +48,12 @@ add_artifact()
   URL=$(api_url "jobs/$SESSION/artifacts/$DST")
 
   python <<EOP
+import time
 import urllib2
 
 filename = "$FILENAME"
 url = "$URL"
+retries = $CURL_RETRIES
 
 data = open(filename, "rb").read()
 
@@ -46,9 +61,54 @@ opener = urllib2.build_opener(urllib2.HTTPHandler)
 request = urllib2.Request(url, data=data)
 request.add_header('Content-Type', 'text/plain')
 request.get_method = lambda: 'PUT'
-resp = opener.open(request)
+for attempt in range(retries + 1):
+    try:
+        resp = opener.open(request)
+        break
+    except urllib2.HTTPError as e:
+        # The daemon is busy
+        if e.code != 503 or attempt == retries:
+            raise
+        time.sleep(int(e.headers.get("Retry-After", 1)))
 EOP
 }
+stream_artifact()
+{
+  # Appends whatever was added to FILENAME to the artifact DST, every
+  # LOG_STREAM_INTERVAL seconds, until STOPFILE exists
+  local DST=$1
+  local FILENAME=$2
+  local STOPFILE=$3
+  local OFFSET=0
+  local SIZE
+  local RESPONSE
+  local URL=$(api_url "jobs/$SESSION/artifacts/$DST")
+  local STOP=false
+  until $STOP
+  do
+    [[ -e $STOPFILE ]] && STOP=true
+    SIZE=$(stat -c %s $FILENAME 2>/dev/null || echo 0)
+    if [[ $SIZE -gt $OFFSET ]]
+    then
+      # The reply has the offset to continue at, also if an append got lost
+      RESPONSE=$(tail -c +$(($OFFSET + 1)) $FILENAME | \
+                 head -c $(($SIZE - $OFFSET)) | \
+                 curl --silent --retry $CURL_RETRIES \
+                   --request POST --data-binary @- \
+                   "$URL?offset=$OFFSET")
+      RESPONSE=$(echo "$RESPONSE" | sed -n 's/.*"offset": *\([0-9]*\).*/\1/p')
+      [[ -n $RESPONSE ]] && OFFSET=$RESPONSE
+    fi
+    $STOP || sleep $LOG_STREAM_INTERVAL
+  done
+}
+start_log_stream()
+{
+  debug "Streaming the log to the artifact testsuite.log"
+  stream_artifact testsuite.log $LOGFILE $TMPDIR/stop-log-stream &
+  LOG_STREAM_PID=$!
+}
+stop_log_stream() { touch $TMPDIR/stop-log-stream ; wait $LOG_STREAM_PID ; }
 testcase_x_succeeded_last_time() {
   # Go backwards and return 0 in the case that the
   # last run of X was successfull
@@ -76,6 +136,10 @@ testcase_x_succeeded_last_time() {
 #
 # Run
 #
+start_heartbeat
+trap stop_heartbeat EXIT
+start_log_stream
+
 {
   debug "Entering tmpdir $TMPDIR"
   cd $TMPDIR
@@ -172,7 +236,7 @@ testcase_x_succeeded_last_time() {
   add_artifact "job_status.json.txt" "/tmp/job_status.json"
 } 2>&1 | tee $LOGFILE
 
-add_artifact "testsuite.log" $LOGFILE
+stop_log_stream
 
 debug "Done"
 
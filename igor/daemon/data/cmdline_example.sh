@@ -48,7 +48,7 @@ export $(bash ./igorclient.sh cookie)
 
 highlight "The job is starting and waited to reach some endstate"
 bash ./igorclient.sh start
-bash ./igorclient.sh wait_state "aborted|failed|timedout|passed"
+bash ./igorclient.sh wait_state "aborted|failed|timedout|unresponsive|passed"
 highlight "The job has finished"
 
 LAST_STATE=$(bash ./igorclient.sh state)
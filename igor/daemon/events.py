@@ -0,0 +1,148 @@
+#
+# Copyright (C) 2012  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Fabian Deutsch <fabiand@fedoraproject.org>
+#
+# -*- coding: utf-8 -*-
+
+"""
+Delivers daemon events (the hook events) to in-process subscribers.
+"""
+
+from igor import log
+import collections
+import threading
+import time
+
+
+logger = log.getLogger(__name__)
+
+
+class EventBus(object):
+    """Passes events to all subscribers whose filter matches.
+    Publishing never blocks on a subscriber: Each subscriber has a bounded
+    buffer, if it is full the oldest events are dropped and counted.
+    The last events are kept, so a subscriber can catch up after
+    reconnecting.
+
+    >>> bus = EventBus(history_size=2)
+    >>> sub = bus.subscribe(cookie="i1", maxsize=1)
+    >>> bus.publish("post-setup", "i1")["id"]
+    1
+    >>> _ = bus.publish("post-setup", "i2")
+    >>> _ = bus.publish("post-start", "i1")
+    >>> [e["type"] for e in sub.get(0)], sub.dropped
+    (['post-start'], 1)
+    >>> late = bus.subscribe(since=1)
+    >>> [e["id"] for e in late.get(0)]
+    [2, 3]
+    >>> bus.unsubscribe(sub)
+    >>> len(bus.subscribers)
+    1
+    """
+    subscribers = None
+    history = None
+
+    _last_id = 0
+    _lock = None
+
+    def __init__(self, history_size=256):
+        self.subscribers = []
+        self.history = collections.deque(maxlen=history_size)
+        self._lock = threading.Lock()
+
+    def publish(self, event_type, cookie, plan=None):
+        """Create an event and pass it to the matching subscribers
+
+        Returns:
+            The event
+        """
+        with self._lock:
+            self._last_id += 1
+            event = {"id": self._last_id,
+                     "type": event_type,
+                     "session": cookie,
+                     "plan": plan,
+                     "created_at": time.time()}
+            self.history.append(event)
+            for subscriber in self.subscribers:
+                subscriber.put(event)
+        return event
+
+    def subscribe(self, cookie=None, plan=None, since=None, maxsize=1024):
+        """Subscribe to the events of a job or plan, or all events
+
+        Args:
+            since: Also deliver the kept events newer than this event id
+            maxsize: Number of events buffered for the subscriber
+        """
+        subscriber = EventBus.Subscriber(cookie, plan, maxsize)
+        with self._lock:
+            if since is not None:
+                for event in self.history:
+                    if event["id"] > since:
+                        subscriber.put(event)
+            self.subscribers.append(subscriber)
+        logger.debug("New event subscriber, %d in total" %
+                     len(self.subscribers))
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            if subscriber in self.subscribers:
+                self.subscribers.remove(subscriber)
+
+    class Subscriber(object):
+        cookie = None
+        plan = None
+
+        # Number of events which were dropped because the buffer was full
+        dropped = 0
+
+        _buffer = None
+        _available = None
+
+        def __init__(self, cookie=None, plan=None, maxsize=1024):
+            self.cookie = cookie
+            self.plan = plan
+            self._buffer = collections.deque(maxlen=maxsize)
+            self._available = threading.Condition()
+
+        def matches(self, event):
+            return (self.cookie is None or self.cookie == event["session"]) \
+                and (self.plan is None or self.plan == event["plan"])
+
+        def put(self, event):
+            if not self.matches(event):
+                return
+            with self._available:
+                if len(self._buffer) == self._buffer.maxlen:
+                    self.dropped += 1
+                self._buffer.append(event)
+                self._available.notify()
+
+        def get(self, timeout):
+            """Wait at most timeout seconds for events
+
+            Returns:
+                A list of all buffered events, can be empty
+            """
+            with self._available:
+                if not self._buffer and timeout > 0:
+                    self._available.wait(timeout)
+                events = list(self._buffer)
+                self._buffer.clear()
+            return events
@@ -19,11 +19,16 @@
 # -*- coding: utf-8 -*-
 
 from igor import log, utils
+from igor.daemon.events import EventBus
+from igor.daemon.jobstore import JobStore
+from multiprocessing.pool import ThreadPool
+import collections
+import copy
+import heapq
 import main
 import os
 import threading
 import time
-import yaml
 
 
 logger = log.getLogger(__name__)
@@ -35,13 +40,37 @@ s_running = utils.State("running")
 s_aborted = utils.State("aborted")
 s_failed = utils.State("failed")
 s_timedout = utils.State("timedout")
+s_unresponsive = utils.State("unresponsive")
 s_passed = utils.State("passed")
-endstates = [s_aborted, s_failed, s_timedout, s_passed]
+endstates = [s_aborted, s_failed, s_timedout, s_unresponsive, s_passed]
 
+# Locks are taken in this order, and only held shortly unless noted:
+# JobCenter._lock (the job table), Job._lock (the lifecycle of one job, held
+# during setup and teardown), Job._state_lock (the state of one job)
 
-_high_state_change_lock = threading.RLock()
-_state_change_lock = threading.RLock()
-_jobcenter_lock = threading.RLock()
+
+class UnavailableItem(object):
+    """Stands in for the host or profile of a restored job, which is not
+    known to the inventory anymore
+    """
+    name = None
+    session = None
+
+    def __init__(self, name):
+        self.name = name
+
+    def get_name(self):
+        return self.name
+
+    def purge(self):
+        logger.warning("Can not purge host %s, it is gone" % self.name)
+
+    def revoke_from(self, host):
+        logger.warning("Can not revoke profile %s, it is gone" % self.name)
+
+    def __to_dict__(self):
+        return {"name": self.name,
+                "origin": None}
 
 
 class Job(object):
@@ -61,6 +90,8 @@ class Job(object):
     profile = None
     testsuite = None
     additional_kargs = None
+    # The name of the plan which submitted this job
+    plan = None
 
     current_step = 0
     results = None
@@ -68,12 +99,32 @@ class Job(object):
 
     _state = None
     _state_history = None
+    # The time each state was first entered, by state name
+    _state_times = None
     state_changed = None
     _created_at = None
+    # If the job was handed to start_job, it waits for it's host until it
+    # is set up
+    _queued = False
     _ended = False
     _ended_at = None
+    _last_heartbeat = None
 
-    _watchdog = None
+    # Seconds after which a watchdog check is retried if the job was busy
+    watchdog_retry_delay = 1
+
+    # Increased whenever the dict of this job changes
+    version = 0
+    _snapshot = None
+
+    # Guards the lifecycle of this job
+    _lock = None
+    _state_lock = None
+    # Notified when data was appended to an artifact
+    _appended = None
+
+    # Bytes of the end of the log kept with the result of a failed step
+    result_log_size = 64 * 1024
 
     def __init__(self, job_center, cookie, jobspec, session_path="/tmp"):
         """Create a new job to run the testsuite on host prepared with profile
@@ -92,7 +143,9 @@ class Job(object):
 
         assert host is not None, "host can not be None"
         assert profile is not None, "profile can not be None"
-        self.host = host
+        # The inventory hands out the same host object to every job, the
+        # session is per job
+        self.host = copy.copy(host)
         self.host.session = self.session
         self.profile = profile
 
@@ -103,39 +156,17 @@ class Job(object):
         self.results = []
         self._artifacts = []
 
+        self._lock = threading.RLock()
+        self._state_lock = threading.RLock()
+        self._appended = threading.Condition()
         self._state_history = []
+        self._state_times = {}
         self.state_changed = threading.Event()
         self.state(s_open)
 
-        self.watchdog = self.__init_watchdog()
-
         self._created_at = time.time()
 
-    def __init_watchdog(self):
-        class JobTimeoutWatchdog(utils.PollingWorkerDaemon):
-            job = None
-
-            def __init__(self, job):
-                self.job = job
-                utils.PollingWorkerDaemon.__init__(self)
-
-            def work(self):
-                logger.debug("Watching current step: %s" %
-                             self.job.current_step)
-                logger.debug("%ss of %ss (timeout) passed" % (
-                             self.job.runtime(),
-                             self.job.allowed_time_up_to_current_testcase()))
-                if self.job.is_timedout():
-                    with _high_state_change_lock:
-                        logger.debug("Watchdog for job %s: timed out." %
-                                     self.job.cookie)
-                        self.job.state(s_timedout)
-                    self.stop()
-
-        watchdog = JobTimeoutWatchdog(self)
-        return watchdog
-
-    @utils.synchronized(_high_state_change_lock)
+    @utils.synchronized_on("_lock")
     def setup(self):
         """Prepare a host to get started
         """
@@ -152,7 +183,7 @@ class Job(object):
         self.state(s_prepared)
         self.job_center._run_hook("post-setup", self.cookie)
 
-    @utils.synchronized(_high_state_change_lock)
+    @utils.synchronized_on("_lock")
     def start(self):
         """Start the actual test
         We expecte the testsuite to be gathered by the host, thus the host
@@ -164,10 +195,10 @@ class Job(object):
         logger.debug("Starting job %s" % (self.cookie))
         self.state(s_running)
         self.host.start()
-        self.watchdog.start()
+        self._schedule_timeout()
         self.job_center._run_hook("post-start", self.cookie)
 
-    @utils.synchronized(_high_state_change_lock)
+    @utils.synchronized_on("_lock")
     def finish_step(self, n, is_success, note=None, is_abort=False,
                     is_skipped=False):
         """Finish one test step
@@ -192,7 +223,8 @@ class Job(object):
         log = "(log output suppressed, only for failed testcases)"
         if not is_passed:
             try:
-                log = unicode(str(self.get_artifact("log")), errors='ignore')
+                log = unicode(self.session.tail_artifact(
+                    "%s-log" % n, self.result_log_size), errors='ignore')
             except:
                 log = "(no log output)"
 
@@ -236,7 +268,6 @@ class Job(object):
 
         if self.state() in endstates:
             logger.debug("Finished job %s: %s" % (self.cookie, self.state()))
-            self.watchdog.stop()
         else:
             logger.debug("Awaiting results for step %s: %s" %
                          (n + 1, self.testsuite.testcases()[n + 1]))
@@ -244,10 +275,159 @@ class Job(object):
         self.job_center._run_hook("post-testcase", self.cookie)
 
         self.current_step += 1
+        self._changed()
+        if self.state() == s_running:
+            self._schedule_timeout()
+        self._persist()
         return self.current_step
 
+    def _changed(self):
+        with self._state_lock:
+            self.version += 1
+        if self.job_center:
+            self.job_center._notify_change()
+
+    def _persist(self):
+        if self.job_center:
+            self.job_center._store_job(self)
+
+    def __getstate__(self):
+        """The job center, the locks and the session are re-associated when
+        the job is restored.
+        Only the names of the host and profile are kept, they can hold
+        connections (e.g. to Cobbler) and are looked up again on restore.
+        Items which can not be looked up by name (e.g. a VM created for
+        this job) are kept themselves, see Host.kept_with_job.
+        """
+        state = self.__dict__.copy()
+        for k in ["job_center", "_lock", "_state_lock", "_appended",
+                  "state_changed", "session", "_snapshot", "host",
+                  "profile"]:
+            state.pop(k, None)
+        state["_session_dirname"] = self.session.dirname
+        state["_item_names"] = {"host": self.host.get_name(),
+                                "profile": self.profile.get_name()}
+        state["_kept_items"] = {k: item for k, item
+                                in [("host", self.host),
+                                    ("profile", self.profile)]
+                                if getattr(item, "kept_with_job", False)}
+        return state
+
+    def __setstate__(self, state):
+        dirname = state.pop("_session_dirname")
+        self.__dict__.update(state)
+        if self._state_times is None:
+            # Stored before the state times were kept
+            self._state_times = {}
+            for s in self._state_history:
+                self._state_times.setdefault(str(s["state"]), s["created_at"])
+        self._lock = threading.RLock()
+        self._state_lock = threading.RLock()
+        self._appended = threading.Condition()
+        self.state_changed = threading.Event()
+        self.session = main.TestSession.resume(self.cookie, dirname)
+
+    def _resolve_items(self, inventory):
+        """Look up the host and profile of a restored job by their names,
+        unless they were kept with the job
+
+        Returns:
+            False if one of them is not known anymore
+        """
+        names = self.__dict__.pop("_item_names", None)
+        kept = self.__dict__.pop("_kept_items", None) or {}
+        if names is None:
+            # Pickled with the objects
+            self.host.session = self.session
+            return True
+        host = kept.get("host")
+        if host is None and inventory:
+            host = inventory.hosts(names["host"])
+            host = copy.copy(host) if host is not None else None
+        self.host = host
+        self.profile = kept.get("profile")
+        if self.profile is None and inventory:
+            self.profile = inventory.profiles(names["profile"])
+        resolved = self.host is not None and self.profile is not None
+        if self.host is None:
+            self.host = UnavailableItem(names["host"])
+        if self.profile is None:
+            self.profile = UnavailableItem(names["profile"])
+        self.host.session = self.session
+        return resolved
+
+    def _schedule_timeout(self):
+        self.job_center._watchdog.schedule((self.cookie, "timeout"),
+                                           self.deadline(),
+                                           self._check_timeout)
+
+    def _check_timeout(self):
+        if not self._lock.acquire(False):
+            self._retry_check("timeout", self._check_timeout)
+            return
+        try:
+            if self.state() != s_running:
+                return
+            if self.is_timedout():
+                logger.debug("Watchdog for job %s: timed out." % self.cookie)
+                self.state(s_timedout)
+            else:
+                # A retry can replace the deadline of a new step
+                self._schedule_timeout()
+        finally:
+            self._lock.release()
+
+    def _retry_check(self, kind, check):
+        """The job is busy (e.g. finishing a step), the watchdog thread must
+        not wait for it, so the check is done again a bit later
+        """
+        logger.debug("Job %s is busy, retrying the %s check" %
+                     (self.cookie, kind))
+        self.job_center._watchdog.schedule((self.cookie, kind),
+                                           time.time() +
+                                           self.watchdog_retry_delay,
+                                           check)
+
+    def heartbeat(self):
+        """Called by the host to tell that it is still alive
+        The job becomes unresponsive if no beat arrives within the
+        heartbeat timeout of the JobCenter. Jobs are only watched once the
+        first beat arrived.
+        A beat does not change the version, only becoming unresponsive does.
+        """
+        self._last_heartbeat = time.time()
+        timeout = self.job_center.heartbeat_timeout()
+        if timeout and self.state() == s_running:
+            self.job_center._watchdog.schedule((self.cookie, "heartbeat"),
+                                               self._last_heartbeat + timeout,
+                                               self._check_heartbeat)
+        return self.state()
+
+    def _check_heartbeat(self):
+        if not self._lock.acquire(False):
+            self._retry_check("heartbeat", self._check_heartbeat)
+            return
+        try:
+            timeout = self.job_center.heartbeat_timeout()
+            if self.state() != s_running:
+                return
+            if time.time() - self._last_heartbeat >= timeout:
+                logger.info("Job %s: No heartbeat since %ss" %
+                            (self.cookie, timeout))
+                self.state(s_unresponsive)
+            else:
+                # A retry can replace the deadline of a newer beat
+                self.job_center._watchdog.schedule(
+                    (self.cookie, "heartbeat"),
+                    self._last_heartbeat + timeout,
+                    self._check_heartbeat)
+        finally:
+            self._lock.release()
+
     def annotate(self, note, step="current", is_append=True):
         """Annotate - by default - the current step.
+        Existing annotations which can not be read are not replaced, the
+        YAMLError is raised.
         """
         filename = "annotations.yaml"
         if step == "current":
@@ -256,14 +436,13 @@ class Job(object):
             filename = "%s-%s" % (step, filename)
 
         notes = []
-        if is_append:
-            try:
-                data = self.get_artifact(filename)
-                notes = list(yaml.load_all(data))
-            except:
-                logger.debug("Creating new annotation")
+        if is_append and os.path.exists(self.artifact_filename(filename)):
+            notes = utils.yaml_load_all(self.get_artifact(filename),
+                                        cached=False)
+        elif is_append:
+            logger.debug("Creating new annotation")
         notes.append(note)
-        data = yaml.dump_all(notes)
+        data = utils.yaml_dump_all(notes)
         self.add_artifact(filename, data)
         self.job_center._run_hook("post-annotate", self.cookie)
 
@@ -273,7 +452,7 @@ class Job(object):
             filename = "%s-%s" % (self.current_step, filename)
         elif step is not None:
             filename = "%s-%s" % (step, filename)
-        return list(yaml.load_all(self.get_artifact(filename)))
+        return utils.yaml_load_all(self.get_artifact(filename), cached=False)
 
     def add_artifact_to_current_step(self, name, data):
         aname = "%s-%s" % (self.current_step, name)
@@ -284,10 +463,67 @@ class Job(object):
         aname = "%s-%s" % (self.current_step, name)
         return self.get_artifact(aname)
 
+    def upload_artifact_to_current_step(self, name, stream, length,
+                                        offset=0, total=None, checksum=None):
+        """Write a (part of an) artifact as it arrives, see
+        TestSession.upload_artifact
+
+        Returns:
+            The name of the artifact and if it is complete
+        """
+        aname = "%s-%s" % (self.current_step, name)
+        complete = self.session.upload_artifact(aname, stream, length,
+                                                offset, total, checksum)
+        if complete:
+            self._register_artifact(aname)
+        return aname, complete
+
+    def uploaded_size_for_current_step(self, name):
+        aname = "%s-%s" % (self.current_step, name)
+        return self.session.uploaded_size(aname)
+
     def add_artifact(self, name, data):
+        self._register_artifact(name)
+        self.session.add_artifact(name, data)
+
+    def append_artifact(self, name, stream, length, offset=None):
+        """Append to an artifact of this job (not of the current step), see
+        TestSession.append_artifact
+
+        Returns:
+            The new size of the artifact
+        """
+        size = self.session.append_artifact(name, stream, length, offset)
+        self._register_artifact(name)
+        with self._appended:
+            self._appended.notify_all()
+        return size
+
+    def wait_for_artifact(self, name, offset, timeout):
+        """Wait at most timeout seconds for an artifact to grow beyond
+        offset
+        """
+        with self._appended:
+            if self.artifact_size(name) <= offset:
+                self._appended.wait(timeout)
+
+    def artifact_size(self, name):
+        return self.session.artifact_size(name)
+
+    def artifact_filename(self, name):
+        return self.session.artifact_filename(name)
+
+    def read_artifact(self, name, offset=0, size=-1):
+        return self.session.read_artifact(name, offset, size)
+
+    def tail_artifact(self, name, size):
+        return self.session.tail_artifact(name, size)
+
+    def _register_artifact(self, name):
         if name not in self._artifacts:
             self._artifacts.append(name)
-        self.session.add_artifact(name, data)
+            self._changed()
+            self._persist()
 
     def get_artifact(self, name):
         return self.session.get_artifact(name)
@@ -295,10 +531,11 @@ class Job(object):
     def list_artifacts(self):
         return self._artifacts
 
-    def get_artifacts_archive(self):
+    def iter_artifacts_archive(self, codec="bz2"):
         logger.debug("Creating artifacts archive for: %s" % self._artifacts)
-        return self.session.get_artifacts_archive(self._artifacts)
+        return self.session.iter_artifacts_archive(self._artifacts, codec)
 
+    @utils.synchronized_on("_lock")
     def abort(self):
         """Abort the test
         """
@@ -311,7 +548,7 @@ class Job(object):
         self.finish_step(self.current_step, is_success=False, note="aborted",
                          is_abort=True)
 
-    @utils.synchronized(_high_state_change_lock)
+    @utils.synchronized_on("_lock")
     def end(self):
         """Tear down this test, might clean up the host
         """
@@ -320,16 +557,21 @@ class Job(object):
             raise Exception("Job %s can not yet be torn down: %s" %
                             (self.cookie, self.state()))
 
-        self.host.purge()
-        self.profile.revoke_from(self.host)
-        self._ended = True
-        self._ended_at = time.time()
+        try:
+            self.host.purge()
+            self.profile.revoke_from(self.host)
+        finally:
+            # Also a host which failed to be prepared is torn down just once
+            self._ended = True
+            self._ended_at = time.time()
+            self._changed()
+            self._persist()
         self.job_center._run_hook("post-end", self.cookie)
 
     def ended_within(self, span):
         return (time.time() - self._ended_at) < span
 
-    @utils.synchronized(_high_state_change_lock)
+    @utils.synchronized_on("_lock")
     def clean(self):
         assert self._ended is True
         self.session.remove()
@@ -338,16 +580,29 @@ class Job(object):
         assert self._ended is True
         return time.time() - self._ended_at
 
-    @utils.synchronized(_state_change_lock)
+    @utils.synchronized_on("_state_lock")
     def state(self, new_state=None):
         if new_state is not None:
+            now = time.time()
             self._state_history.append({
-                "created_at": time.time(),
+                "created_at": now,
                 "state": new_state
             })
+            self._state_times.setdefault(str(new_state), now)
             self._state = new_state
+            self.version += 1
             self.state_changed.set()
             self.state_changed.clear()
+            if self.job_center:
+                if new_state in endstates:
+                    # However the job ended, it is not watched anymore
+                    self.job_center._watchdog.cancel((self.cookie,
+                                                      "timeout"))
+                    self.job_center._watchdog.cancel((self.cookie,
+                                                      "heartbeat"))
+                self.job_center._notify_change()
+                self._persist()
+                self.job_center._wakeup_worker()
         return self._state
 
     def result(self):
@@ -366,8 +621,14 @@ class Job(object):
             assert self.is_timedout()
             msg = "timedout"
 
+        elif self.state() == s_unresponsive:
+            assert self._last_heartbeat is not None
+            msg = "unresponsive"
+
         elif self.state() == s_failed:
-            assert not all([r["is_passed"] for r in self.results])
+            # No results if the setup failed
+            assert not self.results or \
+                not all([r["is_passed"] for r in self.results])
             msg = "failed"
 
         elif self.state() == s_running:
@@ -393,21 +654,16 @@ class Job(object):
         """
         runtime = 0
         now = time.time()
-        get_first_state_change = lambda q: [s for s in self._state_history
-                                            if s["state"] == q][0]
-        if self.state() == s_running:
-            time_started = get_first_state_change(s_running)["created_at"]
+        state = self.state()
+        if state == s_running:
+            time_started = self._state_times[str(s_running)]
             runtime = now - time_started
-        elif self.state() == s_timedout:
-            time_started = get_first_state_change(s_running)["created_at"]
-            time_ended = get_first_state_change(s_timedout)["created_at"]
-            runtime = time_ended - time_started
-        elif self.state() == s_aborted:
-            time_started = get_first_state_change(s_running)["created_at"]
-            time_ended = get_first_state_change(s_aborted)["created_at"]
+        elif state in [s_timedout, s_aborted, s_unresponsive]:
+            time_started = self._state_times[str(s_running)]
+            time_ended = self._state_times[str(state)]
             runtime = time_ended - time_started
-        elif self.state() in endstates:
-            time_started = get_first_state_change(s_running)["created_at"]
+        elif state in endstates and self.results:
+            time_started = self._state_times[str(s_running)]
             time_ended = self.results[-1]["created_at"]
             runtime = time_ended - time_started
         return runtime
@@ -421,49 +677,25 @@ class Job(object):
         is_timeout = False
 
         timeout = self.allowed_time_up_to_current_testcase()
-        if self.runtime() > timeout:
+        if self.runtime() >= timeout:
             is_timeout = True
 
         return is_timeout
 
+    def deadline(self):
+        """The point in time the current step times out
+        """
+        time_started = self._state_times[str(s_running)]
+        return time_started + self.allowed_time_up_to_current_testcase()
+
     def allowed_time_up_to_current_testcase(self):
         """Doesn't return the whole timeout of the whole job, but the time
         allowed until the current step
         """
-        return Job._calculate_timeout_for_tcs(self.testsuite.testcases(),
-                                              self.current_step)
-
-    @staticmethod
-    def _calculate_timeout_for_tcs(all_tcs, cur):
-        """Calculcate the the timeout including the current testcase.
-
-        >>> Job._calculate_timeout_for_tcs([], 0)
-        0
-        >>> Job._calculate_timeout_for_tcs([], 42)
-        0
-        >>> class Obj(object):
-        ...     def __init__(self, **kwargs):
-        ...         self.__dict__.update(kwargs)
-        >>> tcs = [
-        ...     Obj(timeout=1),
-        ...     Obj(timeout=1),
-        ...     ]
-        >>> Job._calculate_timeout_for_tcs(tcs, 0)
-        1
-        >>> Job._calculate_timeout_for_tcs(tcs, 1)
-        2
-        >>> Job._calculate_timeout_for_tcs(tcs, 2)
-        2
-
-        Args:
-            all_tcs: All testcases
-            cur: The current testcase idx
-        Returns:
-            The timeout in seconds
-        """
-        # +1 because we want the timeouts, including the current one
-        tcs_up_to_now = all_tcs[:cur + 1]
-        return sum([t.timeout for t in tcs_up_to_now])
+        deadlines = self.testsuite.view().deadlines
+        if not deadlines:
+            return 0
+        return deadlines[min(self.current_step, len(deadlines) - 1)]
 
     def reached_endstate(self):
         """If this testsuite has reached any end state
@@ -484,20 +716,189 @@ class Job(object):
         return ("ID: %s\nState: %s\nStep: %d\nTestsuite:\n%s" %
                 (self.cookie, self.state(), self.current_step, self.testsuite))
 
+    def snapshot_key(self):
+        """A key for the serialized dict of this job, or None if it is
+        running and it's runtime changes all the time
+        """
+        if self.state() in endstates:
+            return (self.cookie, self.version)
+        return None
+
     def __to_dict__(self):
-        return {"id": self.cookie,
+        """The dict is rebuilt only if the version changed, just the runtime
+        and the last heartbeat are always taken
+        """
+        version = self.version
+        snapshot = self._snapshot
+        if snapshot is None or snapshot[0] != version:
+            snapshot = (version, {
+                "id": self.cookie,
+                "version": version,
                 "profile": self.profile.get_name(),
                 "host": self.host.get_name(),
                 "testsuite": self.testsuite.__to_dict__(),
                 "state": self.state(),
                 "is_endstate": self.state() in endstates,
                 "current_step": self.current_step,
-                "results": self.results,
+                "results": list(self.results),
                 "timeout": self.timeout(),
-                "runtime": self.runtime(),
                 "created_at": self._created_at,
-                "artifacts": self._artifacts,
-                "additional_kargs": self.additional_kargs}
+                "artifacts": list(self._artifacts),
+                "additional_kargs": self.additional_kargs})
+            self._snapshot = snapshot
+        d = dict(snapshot[1])
+        d["runtime"] = self.runtime()
+        d["last_heartbeat"] = self._last_heartbeat
+        return d
+
+
+class DeadlineWatchdog(threading.Thread):
+    """Calls a callback once it's deadline passed. Used to time out the
+    steps of running jobs and to detect missing heartbeats.
+    One thread watches all jobs, the deadlines are kept in a heap.
+
+    >>> wd = DeadlineWatchdog()
+    >>> wd.start()
+    >>> fired = threading.Event()
+    >>> wd.schedule("a", time.time() + 60, lambda: None)
+    >>> wd.schedule("a", time.time(), fired.set)
+    >>> fired.wait(5)
+    True
+    >>> wd.stop()
+    """
+    _heap = None
+    _deadlines = None
+    _condition = None
+    _stopped = False
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._heap = []
+        self._deadlines = {}
+        self._condition = threading.Condition()
+
+    def schedule(self, key, deadline, callback):
+        """(Re-)set the deadline of key, callback is called once it passed
+        """
+        with self._condition:
+            self._deadlines[key] = deadline
+            heapq.heappush(self._heap, (deadline, key, callback))
+            self._condition.notify()
+
+    def cancel(self, key):
+        with self._condition:
+            self._deadlines.pop(key, None)
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+
+    def _next_expired(self):
+        """Blocks until a deadline passed, returns the callback or None if
+        stopped
+        """
+        with self._condition:
+            while not self._stopped:
+                # Drop entries of cancelled or rescheduled jobs
+                while self._heap and \
+                        self._deadlines.get(self._heap[0][1]) != \
+                        self._heap[0][0]:
+                    heapq.heappop(self._heap)
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+                timeout = self._heap[0][0] - time.time()
+                if timeout <= 0:
+                    deadline, key, callback = heapq.heappop(self._heap)
+                    del self._deadlines[key]
+                    return callback
+                self._condition.wait(timeout)
+        return None
+
+    def run(self):
+        callback = self._next_expired()
+        while callback is not None:
+            try:
+                callback()
+            except Exception as e:
+                logger.warning("Watchdog callback failed: %s" % e)
+            callback = self._next_expired()
+
+
+class HostQueues(object):
+    """Pending jobs in one FIFO queue per host, and the hosts which are free
+    and have pending jobs, in the order they became ready.
+    Not thread-safe, the JobCenter guards it.
+
+    >>> q = HostQueues()
+    >>> q.push("hostA", "j1")
+    >>> q.push("hostA", "j2")
+    >>> q.push("hostB", "j3")
+    >>> len(q)
+    3
+    >>> q.pop_ready(), q.pop_ready(), q.pop_ready()
+    (('hostA', 'j1'), ('hostB', 'j3'), None)
+    >>> q.release("hostA")
+    >>> q.pop_ready()
+    ('hostA', 'j2')
+    >>> q.is_busy("hostA"), len(q)
+    (True, 0)
+    """
+    _queues = None
+    _ready = None
+    _busy = None
+    _count = 0
+
+    def __init__(self):
+        self._queues = {}
+        self._ready = collections.OrderedDict()
+        self._busy = set()
+
+    def push(self, host_key, cookie):
+        """Queue a job for a host
+        """
+        self._queues.setdefault(host_key, collections.deque()).append(cookie)
+        self._count += 1
+        if host_key not in self._busy:
+            self._ready[host_key] = True
+
+    def pop_ready(self):
+        """Take the next job of the first ready host, the host is then busy
+
+        Returns:
+            A tuple (host_key, cookie) or None if no host is ready
+        """
+        if not self._ready:
+            return None
+        host_key, _ = self._ready.popitem(last=False)
+        queue = self._queues[host_key]
+        cookie = queue.popleft()
+        if not queue:
+            del self._queues[host_key]
+        self._count -= 1
+        self._busy.add(host_key)
+        return (host_key, cookie)
+
+    def claim(self, host_key):
+        """Mark a host as busy, e.g. by a restored job
+        """
+        self._busy.add(host_key)
+        self._ready.pop(host_key, None)
+
+    def release(self, host_key):
+        """Mark a host as free, it's next job becomes ready
+        """
+        self._busy.discard(host_key)
+        if host_key in self._queues:
+            self._ready[host_key] = True
+
+    def is_busy(self, host_key):
+        return host_key in self._busy
+
+    def __len__(self):
+        return self._count
 
 
 class JobCenter(object):
@@ -505,55 +906,231 @@ class JobCenter(object):
     """
     session_path = None
     hooks_path = None
+    setup_workers = None
+    heartbeat_interval = None
+    max_missed_heartbeats = None
 
     jobs = {}
     closed_jobs = []
 
-    _queue_of_pending_jobs = []
-    _queue_of_ended_jobs = []
-    _pool_of_hosts_in_use = set([])
+    _pending_jobs = None
+    # Ended jobs, in the order they ended
+    _queue_of_ended_jobs = None
 
     _running_plans = {}
     _plan_results = {}
 
     _cookie_lock = threading.Lock()
+    _cookie_counter = 0
 
     _worker = None
+    # Sets up and tears down jobs
+    _setup_pool = None
+    # Cookies of the jobs handed to the pool to be torn down
+    _ending = None
+    _watchdog = None
+    _store = None
+    inventory = None
 
-    def __init__(self, session_path, hooks_path=None):
+    # Gets all hook events, for in-process subscribers
+    events = None
+
+    # Guards the job table and the queues
+    _lock = None
+
+    # Increased whenever a job or plan changes, waiters are notified
+    version = 0
+    _changes = None
+
+    def __init__(self, session_path, hooks_path=None, setup_workers=4,
+                 heartbeat_interval=30, max_missed_heartbeats=4,
+                 store_path=None, store_commit_interval=1,
+                 max_ended_jobs=10, cleanup_age=5 * 60, inventory=None):
+        """
+        Args:
+            setup_workers: Number of jobs which are set up or torn down in
+                parallel
+            heartbeat_interval: Seconds between two heartbeats of a host
+            max_missed_heartbeats: Missed beats until a job is unresponsive,
+                0 disables the detection
+            store_path: Optional SQLite database to keep the jobs and plan
+                results in, they are restored from it on start
+            store_commit_interval: Seconds between two writes to the store
+            max_ended_jobs: Number of ended jobs to keep in memory, older
+                ones are removed (and archived if a store is used) once they
+                ended cleanup_age seconds ago
+            inventory: Used to look up the hosts and profiles of restored
+                jobs
+        """
         self.session_path = session_path
+        self.inventory = inventory
         self.hooks_path = hooks_path
+        self.setup_workers = setup_workers
+        self.heartbeat_interval = heartbeat_interval
+        self.max_missed_heartbeats = max_missed_heartbeats
+        self._lock = threading.RLock()
+        self._changes = threading.Condition()
+        self.events = EventBus()
+        self._pending_jobs = HostQueues()
+        self._queue_of_ended_jobs = collections.deque()
+        self._setup_pool = ThreadPool(setup_workers)
+        self._ending = set()
         if not os.path.exists(self.session_path):
             os.makedirs(self.session_path)
 
         logger.debug("JobCenter opened in %s" % self.session_path)
 
-        self._worker = JobCenter.JobWorker(jc=self, cleanup_age=5 * 60)
+        self._watchdog = DeadlineWatchdog()
+        self._watchdog.start()
+
+        if store_path:
+            self._store = JobStore(store_path, store_commit_interval)
+            self._restore()
+            self._store.start()
+
+        self._worker = JobCenter.JobWorker(jc=self, cleanup_age=cleanup_age,
+                                           max_ended_jobs=max_ended_jobs)
         self._worker.start()
 
     def __del__(self):
         self._worker.stop()
+        self._watchdog.stop()
+        if self._store:
+            self._store.stop()
         logger.debug("JobCenter is gone.")
 
-    @utils.synchronized(_jobcenter_lock)
-    def get_jobs(self):
-        return {"all": self.jobs,
-                "closed": self.closed_jobs}
+    def _restore(self):
+        """Load the jobs and plan results of a previous run
+        Running jobs are watched again, their hosts are not set up again.
+        Jobs which were interrupted while being set up fail, queued ones
+        are queued again in their order. Running plans can not be
+        continued.
+        """
+        jobs = sorted(self._store.jobs(), key=lambda j: j._ended_at)
+        queued = []
+        for job in jobs:
+            job.job_center = self
+            resolved = job._resolve_items(self.inventory)
+            self.jobs[job.cookie] = job
+            if job._ended:
+                self.closed_jobs.append(job)
+                self._queue_of_ended_jobs.append(job)
+                continue
+            if job.state() in [s_preparing, s_prepared]:
+                logger.info("Job %s was interrupted during setup" %
+                            job.cookie)
+                job.state(s_failed)
+            if not resolved and job.state() not in endstates:
+                logger.info("Host or profile of job %s are gone" %
+                            job.cookie)
+                job.state(s_failed)
+            if job.state() == s_running:
+                job._schedule_timeout()
+                if job._last_heartbeat:
+                    # Give the host time to reach the restarted daemon
+                    job.heartbeat()
+            if job.state() != s_open:
+                self._pending_jobs.claim(self._host_key(job))
+            elif job._queued:
+                queued.append(job)
+            logger.info("Restored job %s: %s" % (job.cookie, job.state()))
+
+        for job in sorted(queued, key=lambda j: j._created_at):
+            self._pending_jobs.push(self._host_key(job), job.cookie)
+
+        for name, result in self._store.plans().items():
+            if result["status"] == "running":
+                result["status"] = "interrupted"
+            self._plan_results[name] = result
+
+    def _store_job(self, job):
+        if self._store:
+            try:
+                self._store.put_job(job)
+            except Exception as e:
+                logger.warning("Can not store job %s: %s" % (job.cookie, e))
+
+    def _store_plan(self, name, result):
+        if self._store:
+            self._store.put_plan(name, result)
+
+    @utils.synchronized_on("_lock")
+    def get_jobs(self, archived_limit=100, archived_since=None):
+        """Returns all jobs in memory, and the summaries of the last
+        archived_limit archived ones (optionally only of those created
+        after archived_since), the others are available by their cookie.
+        """
+        archived = self._store.archived_jobs(archived_limit,
+                                             archived_since) \
+            if self._store else []
+        all_jobs = {j["id"]: j for j in archived}
+        all_jobs.update(self.jobs)
+        return {"all": all_jobs,
+                "closed": archived + self.closed_jobs,
+                "version": self.version}
+
+    def _notify_change(self):
+        with self._changes:
+            self.version += 1
+            self._changes.notify_all()
+
+    def wait_for_change(self, is_changed, timeout):
+        """Block until is_changed() returns True, at most timeout seconds.
+        is_changed is checked whenever a job or plan changed, it must not
+        take any locks.
+
+        Returns:
+            The last value of is_changed()
+        """
+        deadline = time.time() + timeout
+        with self._changes:
+            changed = is_changed()
+            while not changed:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._changes.wait(remaining)
+                changed = is_changed()
+        return changed
+
+    def job_summary(self, cookie):
+        """Returns a job, or the summary of an archived job, or None
+        """
+        with self._lock:
+            job = self.jobs.get(cookie)
+        if job is None and self._store:
+            job = self._store.archived_job(cookie)
+        return job
+
+    def _archive_job(self, job):
+        """Remove an ended job from memory, keep it's summary in the store
+        """
+        summary = job.__to_dict__()
+        with self._lock:
+            self.closed_jobs.remove(job)
+            del self.jobs[job.cookie]
+            if self._store:
+                self._store.archive_job(job.cookie, summary)
+        self._notify_change()
 
     def _generate_cookie(self, cookie_req=None):
         cookie = cookie_req
         self._cookie_lock.acquire()
-        while cookie is None or cookie in self.jobs.keys():
+        while cookie is None or cookie in self.jobs or \
+                (self._store and self._store.archived_job(cookie)):
+            # The counter makes cookies unique within a second, archived
+            # jobs are not counted in self.jobs
+            JobCenter._cookie_counter += 1
             cookie = "%s-%d" % (time.strftime("%Y%m%d-%H%M%S"),
-                                len(self.jobs.items()))
+                                JobCenter._cookie_counter)
             cookie = "i" + utils.surl(cookie.replace("-", ""))
         self._cookie_lock.release()
         assert cookie is not None, ("Cookie creation failed: %s -> %s" %
                                     (cookie_req, cookie))
         return cookie
 
-    @utils.synchronized(_jobcenter_lock)
-    def submit(self, jobspec, cookie_req=None):
+    @utils.synchronized_on("_lock")
+    def submit(self, jobspec, cookie_req=None, plan=None):
         """Enqueue a jobspec to be run against a specififc build on
         given host
         """
@@ -561,8 +1138,11 @@ class JobCenter(object):
 
         j = Job(self, cookie, jobspec, session_path=self.session_path)
         j.created_at = time.time()
+        j.plan = plan
 
         self.jobs[cookie] = j
+        self._store_job(j)
+        self._notify_change()
 
         logger.debug("Created job %s with cookie %s" % (repr(j), cookie))
 
@@ -570,61 +1150,123 @@ class JobCenter(object):
 
         return {"cookie": cookie, "job": j}
 
-    @utils.synchronized(_jobcenter_lock)
+    @utils.synchronized_on("_lock")
     def start_job(self, cookie):
-        self._queue_of_pending_jobs.append(cookie)
+        job = self.jobs[cookie]
+        job._queued = True
+        job._persist()
+        self._pending_jobs.push(self._host_key(job), cookie)
+        self._wakeup_worker()
         return "Started job %s. %d in queue" % \
-            (cookie, len(self._queue_of_pending_jobs))
+            (cookie, len(self._pending_jobs))
+
+    def _host_key(self, job):
+        """Jobs with the same key run one after another
+        Hosts which are created for each job don't need to wait.
+        """
+        origin = getattr(job.host, "origin", None)
+        if not getattr(origin, "reusable_items", True):
+            return (job.host.get_name(), job.cookie)
+        return job.host.get_name()
+
+    @utils.synchronized_on("_lock")
+    def _next_pending_job(self):
+        """Returns the cookie of a job whose host is free, or None
+        """
+        ready = self._pending_jobs.pop_ready()
+        return ready[1] if ready else None
+
+    def _wakeup_worker(self):
+        """Let the worker look for pending and ended jobs right away
+        """
+        if self._worker:
+            self._worker.wakeup()
 
     def _start_job(self, cookie):
-        job = self.jobs[cookie]
-        if job.host in self._pool_of_hosts_in_use:
-            raise Exception("The host is already in use: %s" % job.cookie)
-        self._pool_of_hosts_in_use.add(job.host)
+        """Setup and start a job, this is run in the setup pool
+        A job which can not be set up or started fails.
+        """
+        job = self._job(cookie)
+        assert self._pending_jobs.is_busy(self._host_key(job)), \
+            "The host of job %s was not claimed" % cookie
 
         logger.info("Job %s is beeing started." % cookie)
-        job.setup()
-        job.start()
+        try:
+            self._run_hook("pre-job", cookie)
+            job.setup()
+            job.start()
+        except Exception as e:
+            logger.warning("Job %s failed to start: %s" % (cookie, e))
+            job.state(s_failed)
+            return "Failed to start job %s: %s" % (cookie, e)
         logger.info("Job %s got started." % cookie)
 
         return "Started job %s (%s)." % (cookie, repr(job))
 
-    @utils.synchronized(_jobcenter_lock)
+    @utils.synchronized_on("_lock")
+    def _job(self, cookie):
+        return self.jobs[cookie]
+
     def finish_test_step(self, cookie, step, is_success, note=None):
-        j = self.jobs[cookie]
+        j = self._job(cookie)
         j.finish_step(step, is_success, note)
         logger.info("Job %s finished step %s" % (cookie, step))
         return j
 
-    @utils.synchronized(_jobcenter_lock)
     def skip_step(self, cookie, step, note=None):
-        j = self.jobs[cookie]
+        j = self._job(cookie)
         j.finish_step(step, False, note, is_skipped=True)
         logger.info("Job %s skipped step %s" % (cookie, step))
         return j
 
-    @utils.synchronized(_jobcenter_lock)
+    def heartbeat(self, cookie):
+        j = self._job(cookie)
+        return j.heartbeat()
+
+    def heartbeat_timeout(self):
+        """Seconds without heartbeat until a job is unresponsive, or None
+        """
+        if not self.heartbeat_interval or not self.max_missed_heartbeats:
+            return None
+        return self.heartbeat_interval * self.max_missed_heartbeats
+
     def test_step_result(self, cookie, step):
-        j = self.jobs[cookie]
+        j = self._job(cookie)
         return j.results[step]
 
-    @utils.synchronized(_jobcenter_lock)
     def abort_job(self, cookie):
         logger.debug("Aborting %s" % cookie)
-        j = self.jobs[cookie]
+        j = self._job(cookie)
         j.abort()
         logger.info("Job %s aborted." % (cookie))
         return j
 
+    def _unwind_job(self, cookie):
+        """Run the post-job hook and tear down an ended job, this is run in
+        the setup pool
+        """
+        try:
+            self._run_hook("post-job", cookie)
+            self._end_job(cookie)
+        finally:
+            with self._lock:
+                self._ending.discard(cookie)
+
     def _end_job(self, cookie):
-        job = self.jobs[cookie]
-        job.end()
-        if job.host not in self._pool_of_hosts_in_use:
-            logger.warning("The host was not in use: %s" % job.cookie)
-        self._pool_of_hosts_in_use.discard(job.host)
-        self.closed_jobs.append(job)
-        #del self.jobs[job]
-        # cant poll the status if we remove the job from jobs
+        job = self._job(cookie)
+        try:
+            job.end()
+        except Exception as e:
+            logger.warning("Job %s could not be torn down: %s" % (cookie, e))
+        host_key = self._host_key(job)
+        with self._lock:
+            if not self._pending_jobs.is_busy(host_key):
+                logger.warning("The host was not in use: %s" % job.cookie)
+            self._pending_jobs.release(host_key)
+            self.closed_jobs.append(job)
+            self._queue_of_ended_jobs.append(job)
+        # A pending job might wait for this host
+        self._wakeup_worker()
         logger.info("Job %s ended." % cookie)
         return "Ended job %s." % cookie
 
@@ -632,11 +1274,23 @@ class JobCenter(object):
         if plan.name in self._running_plans:
             raise Exception("Plan with same name already running: %s" %
                             plan.name)
-        running_plan = JobCenter.PlanWorker(self, plan)
+        # A rerun continues the versions of the previous run, so a client
+        # waiting for a change of the plan does not miss it
+        running_plan = JobCenter.PlanWorker(self, plan,
+                                            self.plan_version(plan.name) or 0)
         running_plan.start()
         self._running_plans[plan.name] = running_plan
         return running_plan
 
+    def plan_version(self, name):
+        """The version of a running or ended plan, or None
+        """
+        if name in self._running_plans:
+            return self._running_plans[name].version()
+        if name in self._plan_results:
+            return self._plan_results[name].get("version", 0)
+        return None
+
     def status_plan(self, name):
         results = None
         if name in self._running_plans:
@@ -655,6 +1309,9 @@ class JobCenter(object):
         allowed_hooks = ["pre-job", "post-job", "post-testcase",
                          "post-setup", "post-start", "post-annotate",
                          "post-end"]
+        if hook in allowed_hooks:
+            job = self.jobs.get(cookie)
+            self.events.publish(hook, cookie, job.plan if job else None)
         cmd_tpl = "{script} {hook} {cookie}"
         if hook in allowed_hooks and os.path.isdir(self.hooks_path):
             for scriptfile in os.listdir(self.hooks_path):
@@ -678,26 +1335,38 @@ class JobCenter(object):
 
         status = None
 
+        # Increased when the status of the plan changes, the version of the
+        # plan also includes the versions of it's jobs
+        _version = 0
+        _snapshot = None
+
         _do_end = False
 
-        def __init__(self, jc, plan):
+        def __init__(self, jc, plan, initial_version=0):
             threading.Thread.__init__(self)
             self.daemon = True
 
             self.jc = jc
             self.plan = plan
+            self._version = initial_version
             self.created_at = time.time()
             self.jobs = []
 
         def run(self):
             logger.debug("Starting plan %s" % self.plan.name)
             self.status = "running"
+            self._version += 1
+            self.jc._notify_change()
+            self.jc.events.publish("pre-plan", None, self.plan.name)
 
             for jobspec in self.plan.job_specs():
-                resp = self.jc.submit(jobspec)
+                resp = self.jc.submit(jobspec, plan=self.plan.name)
                 cookie, self.current_job = (resp["cookie"], resp["job"])
                 self.jc.start_job(cookie)
                 self.jobs.append(self.current_job)
+                self._version += 1
+                self.jc._notify_change()
+                self.jc._store_plan(self.plan.name, self.__to_dict__())
                 self.current_job.wait()
 
                 if self._do_end:
@@ -709,9 +1378,14 @@ class JobCenter(object):
                                for r in self.jobs])
 #            self.jobs.reverse()
             self.status = "stopped"
+            self._version += 1
+            self.jc._notify_change()
 
             self.jc._plan_results[self.plan.name] = self.__to_dict__()
+            self.jc._store_plan(self.plan.name,
+                                self.jc._plan_results[self.plan.name])
             del self.jc._running_plans[self.plan.name]
+            self.jc.events.publish("post-plan", None, self.plan.name)
             logger.debug("Plan ended: %s" % self.plan.name)
 
         def stop(self):
@@ -724,71 +1398,87 @@ class JobCenter(object):
         def runtime(self):
             return time.time() - self.created_at
 
+        def version(self):
+            return self._version + sum([j.version for j in self.jobs])
+
         def __to_dict__(self):
-            return {
-                "plan": self.plan.__to_dict__(),
-                "jobs": [r.__to_dict__() for r in self.jobs],
-                "current_job_cookie": self.current_job.cookie
-                if self.current_job else "",
-                "passed": self.passed,
-                "runtime": self.runtime(),
-                "created_at": self.created_at,
-                "status": self.status
-            }
+            """The dict is rebuilt only if the version changed, the
+            runtimes are always calculated
+            """
+            version = self.version()
+            snapshot = self._snapshot
+            if snapshot is None or snapshot[0] != version:
+                snapshot = (version, {
+                    "plan": self.plan.__to_dict__(),
+                    "version": version,
+                    "current_job_cookie": self.current_job.cookie
+                    if self.current_job else "",
+                    "passed": self.passed,
+                    "created_at": self.created_at,
+                    "status": self.status
+                })
+                self._snapshot = snapshot
+            d = dict(snapshot[1])
+            d["jobs"] = [r.__to_dict__() for r in self.jobs]
+            d["runtime"] = self.runtime()
+            return d
 
     class JobWorker(utils.PollingWorkerDaemon):
+        """Hands pending jobs to the setup pool to be started, and ended ones
+        to be torn down, when woken up by the JobCenter. The interval is
+        only a fallback and for the cleanup
+        """
         jc = None
         cleanup_age = None
-        max_cleaned_jobs = 10
+        max_ended_jobs = None
 
-        def __init__(self, jc, cleanup_age):
+        def __init__(self, jc, cleanup_age, max_ended_jobs=10):
             self.jc = jc
             self.cleanup_age = cleanup_age
+            self.max_ended_jobs = max_ended_jobs
             utils.PollingWorkerDaemon.__init__(self)
 
         def work(self):
-            if len(self.jc._queue_of_pending_jobs) == 0:
-                # No item
-                pass
-            else:
-                # FIXME this doesn't respect the order
-                for cookie in self.jc._queue_of_pending_jobs:
-                    candidate = self.jc.jobs[cookie]
-                    logger.debug("Checking if host is in use: %s" %
-                                 candidate.host)
-                    if candidate.host in self.jc._pool_of_hosts_in_use:
-                        self._debug("Host of candidate %s is still in use" %
-                                    cookie)
-                    else:
-                        self._debug("Starting job %s" % cookie)
-                        self.jc._run_hook("pre-job", cookie)
-                        self.jc._start_job(cookie)
-                        self.jc._queue_of_pending_jobs.remove(cookie)
+            # Only jobs whose host is free are handed out, in queue order
+            cookie = self.jc._next_pending_job()
+            while cookie is not None:
+                self._debug("Starting job %s" % cookie)
+                self.jc._setup_pool.apply_async(self.jc._start_job, (cookie,))
+                cookie = self.jc._next_pending_job()
 
             # Look for ended jobs
-            for cookie, j in self.jc.jobs.items():
-                if j.reached_endstate():
-                    if not j._ended:
-                        self._debug("Unwinding job %s" % cookie)
-                        self.jc._run_hook("post-job", cookie)
-                        self.jc._end_job(j.cookie)
-                        self.jc._queue_of_ended_jobs.append(j)
-
-            while len(self.jc._queue_of_ended_jobs) > self.max_cleaned_jobs:
-                self._remove_oldest_job()
+            with self.jc._lock:
+                jobs = self.jc.jobs.items()
+            for cookie, j in jobs:
+                if j.reached_endstate() and not j._ended:
+                    # A slow teardown must not hold up starting other jobs
+                    with self.jc._lock:
+                        if cookie in self.jc._ending:
+                            continue
+                        self.jc._ending.add(cookie)
+                    self._debug("Unwinding job %s" % cookie)
+                    self.jc._setup_pool.apply_async(self.jc._unwind_job,
+                                                    (cookie,))
+
+            while len(self.jc._queue_of_ended_jobs) > self.max_ended_jobs:
+                if not self._remove_oldest_job():
+                    break
 
         def _remove_oldest_job(self):
-            oldest_job = None
-
-            for job in self.jc._queue_of_ended_jobs:
-                if oldest_job is None \
-                   or job.created_at < oldest_job.created_at \
-                   and not oldest_job.ended_within(self.cleanup_age):
-                    oldest_job = job
-
-            if oldest_job is not None:
-                self._debug("Cleaning job %s" % oldest_job.cookie)
+            """Clean and archive the job which ended first, unless it ended
+            within the cleanup age
+            """
+            oldest_job = self.jc._queue_of_ended_jobs[0]
+            if oldest_job.ended_within(self.cleanup_age):
+                return False
+
+            self._debug("Cleaning job %s" % oldest_job.cookie)
+            self.jc._queue_of_ended_jobs.popleft()
+            try:
                 oldest_job.clean()
-                self.jc._queue_of_ended_jobs.remove(oldest_job)
-                del self.jc.jobs[oldest_job.cookie]
-                logger.info("Job %s cleaned and removed." % oldest_job.cookie)
+            except Exception as e:
+                logger.warning("Cleaning job %s failed: %s" %
+                               (oldest_job.cookie, e))
+            self.jc._archive_job(oldest_job)
+            logger.info("Job %s cleaned and archived." % oldest_job.cookie)
+            return True
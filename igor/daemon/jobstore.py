@@ -0,0 +1,254 @@
+#
+# Copyright (C) 2012  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Fabian Deutsch <fabiand@fedoraproject.org>
+#
+# -*- coding: utf-8 -*-
+
+"""
+Keeps jobs and plan results across daemon restarts.
+"""
+
+from igor import log, utils
+import cPickle as pickle
+import sqlite3
+import threading
+import time
+import zlib
+
+
+logger = log.getLogger(__name__)
+
+
+class JobStore(object):
+    """Stores pickled jobs and plan results in a SQLite database in WAL mode.
+    Changes are collected and written in one transaction every
+    commit_interval seconds, only the latest version of an object is
+    written.
+    Finished jobs can be moved to the archive, which only keeps their
+    compressed summary (their dict).
+
+    >>> store = JobStore(":memory:")
+    >>> store.put_plan("plan", {"status": "stopped"})
+    >>> store.flush()
+    >>> store.plans()
+    {'plan': {'status': 'stopped'}}
+    >>> store.remove_plan("plan")
+    >>> store.flush()
+    >>> store.plans()
+    {}
+    >>> store.archive_job("i1", {"id": "i1", "created_at": 1,
+    ...                          "state": "passed"})
+    >>> store.archived_job("i1")["state"]
+    'passed'
+    >>> store.archive_job("i2", {"id": "i2", "created_at": 2,
+    ...                          "state": "failed"})
+    >>> [j["id"] for j in store.archived_jobs()], store.archived_job("i3")
+    (['i1', 'i2'], None)
+    >>> store.flush()
+    >>> [j["id"] for j in store.archived_jobs(limit=1)]
+    ['i2']
+    >>> [j["id"] for j in store.archived_jobs(since=1)]
+    ['i2']
+    """
+    VERSION = 1
+
+    # table: (key column, number of columns)
+    tables = {"jobs": ("cookie", 5),
+              "plans": ("name", 4),
+              "archive": ("cookie", 5)}
+
+    path = None
+    commit_interval = None
+
+    _connection = None
+    _pending = None
+    _lock = None
+    _flusher = None
+
+    def __init__(self, path, commit_interval=1):
+        self.path = path
+        self.commit_interval = commit_interval
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        with self._connection:
+            self._connection.execute("CREATE TABLE IF NOT EXISTS jobs "
+                                     "(cookie TEXT PRIMARY KEY, "
+                                     "state TEXT, version INTEGER, "
+                                     "updated_at REAL, data BLOB)")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS plans "
+                                     "(name TEXT PRIMARY KEY, "
+                                     "version INTEGER, "
+                                     "updated_at REAL, data BLOB)")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS archive "
+                                     "(cookie TEXT PRIMARY KEY, "
+                                     "state TEXT, version INTEGER, "
+                                     "created_at REAL, data BLOB)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS "
+                                     "archive_created_at ON archive "
+                                     "(created_at)")
+
+    def start(self):
+        """Start writing the changes in the background
+        """
+        self._flusher = JobStore.Flusher(self, self.commit_interval)
+        self._flusher.start()
+
+    def stop(self):
+        if self._flusher:
+            self._flusher.stop()
+        self.flush()
+
+    def put_job(self, job):
+        """Remember the current state of a job
+        The job is pickled right away, so the caller should hold it's lock.
+        """
+        data = pickle.dumps(job, pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._pending[("jobs", job.cookie)] = (str(job.state()),
+                                                   self.VERSION, time.time(),
+                                                   buffer(data))
+
+    def remove_job(self, cookie):
+        with self._lock:
+            self._pending[("jobs", cookie)] = None
+
+    def put_plan(self, name, result):
+        data = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._pending[("plans", name)] = (self.VERSION, time.time(),
+                                              buffer(data))
+
+    def remove_plan(self, name):
+        with self._lock:
+            self._pending[("plans", name)] = None
+
+    def archive_job(self, cookie, summary):
+        """Replace a stored job by it's summary
+        """
+        data = zlib.compress(pickle.dumps(summary, pickle.HIGHEST_PROTOCOL))
+        with self._lock:
+            self._pending[("jobs", cookie)] = None
+            self._pending[("archive", cookie)] = (str(summary["state"]),
+                                                  self.VERSION,
+                                                  summary["created_at"],
+                                                  buffer(data))
+
+    def archived_job(self, cookie):
+        """Returns the summary of an archived job, or None
+        """
+        with self._lock:
+            entry = self._pending.get(("archive", cookie))
+            if entry is None:
+                entry = self._connection.execute(
+                    "SELECT state, version, created_at, data FROM archive "
+                    "WHERE cookie = ? AND version = ?",
+                    (cookie, self.VERSION)).fetchone()
+        if entry is None:
+            return None
+        return pickle.loads(zlib.decompress(str(entry[3])))
+
+    def archived_jobs(self, limit=None, since=None):
+        """Returns the summaries of the last limit archived jobs, or of all,
+        optionally only those created after since, oldest first.
+        Only the returned summaries are unpickled.
+        """
+        with self._lock:
+            entries = {key: entry[2:] for (table, key), entry
+                       in self._pending.items()
+                       if table == "archive" and entry is not None}
+            rows = self._connection.execute(
+                "SELECT cookie, created_at, data FROM archive "
+                "WHERE version = ? AND created_at > ? "
+                "ORDER BY created_at DESC LIMIT ?",
+                (self.VERSION, since or 0,
+                 -1 if limit is None else limit)).fetchall()
+        for cookie, created_at, data in rows:
+            entries.setdefault(cookie, (created_at, data))
+        entries = sorted((created_at, data) for created_at, data
+                         in entries.values()
+                         if since is None or created_at > since)
+        if limit is not None:
+            entries = entries[max(0, len(entries) - limit):]
+        return [pickle.loads(zlib.decompress(str(data)))
+                for created_at, data in entries]
+
+    def flush(self):
+        """Write all pending changes in one transaction
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            if not pending:
+                return
+            try:
+                with self._connection:
+                    for (table, key), entry in pending.items():
+                        key_column, n_columns = self.tables[table]
+                        if entry is None:
+                            self._connection.execute(
+                                "DELETE FROM %s WHERE %s = ?" % (table,
+                                                                 key_column),
+                                (key,))
+                        else:
+                            self._connection.execute(
+                                "INSERT OR REPLACE INTO %s VALUES (%s)" %
+                                (table, ", ".join("?" * n_columns)),
+                                (key,) + entry)
+            except Exception:
+                # Keep the changes for the next try, unless newer ones
+                # arrived meanwhile
+                for key, entry in pending.items():
+                    self._pending.setdefault(key, entry)
+                raise
+        logger.debug("Stored %d changes in %s" % (len(pending), self.path))
+
+    def jobs(self):
+        """Returns all stored jobs which can be restored
+        """
+        jobs = []
+        for cookie, data in self._rows("SELECT cookie, data FROM jobs"):
+            try:
+                jobs.append(pickle.loads(str(data)))
+            except Exception as e:
+                logger.warning("Can not restore job %s: %s" % (cookie, e))
+        return jobs
+
+    def plans(self):
+        """Returns all stored plan results
+        """
+        return {str(name): pickle.loads(str(data)) for name, data
+                in self._rows("SELECT name, data FROM plans")}
+
+    def _rows(self, query, order=""):
+        with self._lock:
+            return self._connection.execute(query + " WHERE version = ? " +
+                                            order, (self.VERSION,)).fetchall()
+
+    class Flusher(utils.PollingWorkerDaemon):
+        store = None
+
+        def __init__(self, store, interval):
+            self.store = store
+            utils.PollingWorkerDaemon.__init__(self, interval)
+
+        def work(self):
+            try:
+                self.store.flush()
+            except Exception as e:
+                logger.warning("Storing jobs failed: %s" % e)
@@ -22,13 +22,19 @@
 The main module of igor, specifying the model.
 """
 
-from igor import log
+from igor import log, utils
+from igor.daemon.tarstream import TarStream
 from igor.utils import run, update_properties_only
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+import copy
+import hashlib
 import io
+import itertools
 import os
 import random
-import tarfile
 import tempfile
+import threading
 import time
 
 
@@ -52,9 +58,14 @@ class Host(UpdateableObject):
         The associated test session object - set when associated with a Job
     origin : Origin
         The corresponding origin - associated by Origin
+    kept_with_job : bool
+        If the host is stored with a job (without origin and session)
+        instead of being looked up by it's name when the job is restored,
+        for hosts the inventory can not find again (e.g. created per job)
     """
     session = None
     origin = None
+    kept_with_job = False
 
     def prepare(self):
         """Prepare a host until the point where a testsuite can be submitted.
@@ -87,6 +98,28 @@ class Host(UpdateableObject):
         """
         raise Exception("Not implemented.")
 
+    def __getstate__(self):
+        # Origin and session are re-associated at runtime
+        state = self.__dict__.copy()
+        state.pop("origin", None)
+        state.pop("session", None)
+        return state
+
+    def __copy__(self):
+        """A copy for one job, sharing everything but the session, unlike
+        the pickled state it keeps the origin and connections
+
+        >>> h = Host(origin="o")
+        >>> h.session = "a"
+        >>> c = copy.copy(h)
+        >>> c.session = "b"
+        >>> (h.session, c.session, c.origin)
+        ('a', 'b', 'o')
+        """
+        other = self.__class__.__new__(self.__class__)
+        other.__dict__.update(self.__dict__)
+        return other
+
     def __to_dict__(self):
         return {"name": self.get_name(),
                 "origin": self.origin}
@@ -94,9 +127,13 @@ class Host(UpdateableObject):
 
 class Profile(UpdateableObject):
     """A profile is some abstraction of an installation.
+
+    kept_with_job : bool
+        See Host
     """
 
     origin = None
+    kept_with_job = False
 
     def get_name(self):
         """Get the unique name of this profile
@@ -121,12 +158,28 @@ class Profile(UpdateableObject):
     def __repr__(self):
         return "<%s name='%s'>" % (self.__class__.__name__, self.get_name())
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("origin", None)
+        return state
+
     def __to_dict__(self):
         return {"name": self.get_name(),
                 "origin": self.origin}
 
 
 class Origin(object):
+    """A source of items (hosts, profiles, ...)
+
+    reusable_items : bool
+        If the objects returned by items() can be handed out more than
+        once. Origins creating per-job objects (e.g. from a template) must
+        set this to False, lookups are then always passed to the origin.
+    """
+    reusable_items = True
+
+    _listeners = None
+
     def name(self):
         raise Exception("Not implemented.")
 
@@ -135,6 +188,25 @@ class Origin(object):
         """
         raise Exception("Not implemented.")
 
+    def subscribe(self, callback):
+        """Call callback() whenever the items of this origin changed
+        """
+        if self._listeners is None:
+            self._listeners = []
+        self._listeners.append(callback)
+
+    def _changed(self):
+        """Signal all subscribers that the items changed
+        """
+        for callback in self._listeners or []:
+            callback()
+
+    def names(self):
+        """Returns the names of all items
+        Origins can override this, if names are cheaper than items
+        """
+        return self.items().keys()
+
     def lookup(self, name):
         """Returns an item-obj
         """
@@ -157,11 +229,37 @@ class Inventory(object):
     """Is a central repository for Igor related items.
     This inventory can be used to lookup *existsing* items.
     Use a factory to create the objects, or pass a Factory as a callback.
+
+    All items are kept in an index per category, mapping the name of an
+    item to it's origin and the item. The index is rebuilt when an origin
+    signals a change, on invalidate() or periodically by the Refresher.
+    An outdated index is still used while it is rebuilt in the background,
+    only the first access to a category waits for it.
+    The origins of a category are queried in parallel by up to workers
+    threads, an origin not answering within origin_timeout seconds keeps
+    the items it had before. An origin gets no new query while it still
+    works on an earlier one, so a hanging origin occupies only one worker.
     """
 
-    _origins = None
+    workers = 4
+    origin_timeout = 30
 
-    def __init__(self, plans={}, testsuites={}, profiles={}, hosts={}):
+    _origins = None
+    _index = None
+    _items_cache = None
+    _stale = None
+    _index_lock = None
+    _stats = None
+
+    _pool = None
+    # (category, origin name): (query, AsyncResult) of the last query
+    _in_flight = None
+    # Categories which are rebuilt in the background
+    _refreshing = None
+    _refresher = None
+
+    def __init__(self, plans={}, testsuites={}, profiles={}, hosts={},
+                 workers=4, origin_timeout=30):
         """Each parameter is a list of callbacks to list all items of that
         category.
 
@@ -193,6 +291,15 @@ class Inventory(object):
             "profiles": {},
             "hosts": {}
         }
+        self._index = {}
+        self._items_cache = {}
+        self._stale = set(self._origins.keys())
+        self._index_lock = threading.Lock()
+        self._in_flight = {}
+        self._refreshing = set()
+        self._stats = {k: {} for k in self._origins}
+        self.workers = workers
+        self.origin_timeout = origin_timeout
         key_to_origin = [("plans", plans), ("testsuites", testsuites),
                          ("profiles", profiles), ("hosts", hosts)]
         for (k, origins) in key_to_origin:
@@ -205,32 +312,191 @@ class Inventory(object):
 #                raise Exception(("Invalid %s origin '%s': '%s'") % (k, \
 #                                                               name, origin))
             self._origins[k][name] = origin
+            if hasattr(origin, "subscribe"):
+                origin.subscribe(lambda k=k: self.invalidate(k))
+        self.invalidate(k)
 
-    def _items(self, k):
-        """Retrieves all items from all origins
+    def invalidate(self, k):
+        """Mark the index of category k as outdated, it get's rebuilt on
+        the next access
         """
-        all_items = {}
-        for name, origin in self._origins[k].items():
+        with self._index_lock:
+            self._stale.add(k)
+
+    def _query(self, k, name, query, func, *args):
+        """Run func(*args) for origin name of category k in the pool.
+        If the origin did not answer an earlier query yet, it is not asked
+        again: The pending query is returned instead, the caller has to
+        check which query the result belongs to.
+
+        Returns:
+            The query and it's AsyncResult
+        """
+        with self._index_lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.workers)
+            previous = self._in_flight.get((k, name))
+            if previous is not None and not previous[1].ready():
+                return previous
+            result = self._pool.apply_async(func, args)
+            self._in_flight[(k, name)] = (query, result)
+            return (query, result)
+
+    def refresh(self, k):
+        """Rebuild the index of category k by querying all origins
+        """
+        with self._index_lock:
+            self._stale.discard(k)
+
+        def timed_items(origin):
+            started_at = time.time()
             items = origin.items()
-            for item in items:
-                if item in all_items:
+            return items, time.time() - started_at
+
+        pending = [(name, self._query(k, name, ("items",), timed_items,
+                                      origin))
+                   for name, origin in self._origins[k].items()]
+
+        previous_index = self._index.get(k, {})
+        deadline = time.time() + self.origin_timeout
+        index = {}
+        skipped = False
+        for name, (query, result) in pending:
+            stats = {"refreshed_at": time.time()}
+            try:
+                if query != ("items",):
+                    # Asked again on the next access
+                    skipped = True
+                    raise Exception("Still busy with a lookup")
+                items, stats["latency"] = \
+                    result.get(max(0, deadline - time.time()))
+                if type(items) is not dict:
+                    raise Exception("%s did not return a dict." % k)
+                stats["status"] = "ok"
+            except TimeoutError:
+                logger.warning("Origin %s timed out, keeping it's old %s" %
+                               (name, k))
+                stats["status"] = "timeout"
+                stats["latency"] = self.origin_timeout
+                items = {n: item for n, (o, item) in previous_index.items()
+                         if o == name}
+            except Exception as e:
+                logger.warning("Origin %s failed, keeping it's old %s: %s" %
+                               (name, k, e))
+                stats["status"] = "error: %s" % e
+                items = {n: item for n, (o, item) in previous_index.items()
+                         if o == name}
+            stats["items"] = len(items)
+            self._stats[k][name] = stats
+
+            for item_name, item in items.items():
+                if item_name in index:
                     raise Exception(("Item name is not unique over all %s " +
-                                     "origins: %s") % (k, item))
-            if type(items) is not dict:
-                raise Exception("%s did not return a dict." % k)
-            all_items.update(items)
-        return all_items
+                                     "origins: %s") % (k, item_name))
+                index[item_name] = (name, item)
+        self._index[k] = index
+        self._items_cache[k] = {n: item for n, (o, item) in index.items()}
+        if skipped:
+            self.invalidate(k)
+
+    def _ensure_fresh(self, k):
+        if k not in self._index:
+            self.refresh(k)
+        elif k in self._stale:
+            self._refresh_in_background(k)
+
+    def _refresh_in_background(self, k):
+        with self._index_lock:
+            if k in self._refreshing:
+                return
+            self._refreshing.add(k)
+
+        def run():
+            try:
+                self.refresh(k)
+            except Exception as e:
+                logger.warning("Refreshing the %s index failed: %s" % (k, e))
+            finally:
+                with self._index_lock:
+                    self._refreshing.discard(k)
+
+        thread = threading.Thread(target=run, name="refresh-%s" % k)
+        thread.daemon = True
+        thread.start()
+
+    def names(self, k):
+        """Returns the names of all items of category k.
+        Uses the index if it is current, otherwise asks the origins for the
+        names only.
+        """
+        if k in self._index and k not in self._stale:
+            return self._index[k].keys()
+        names = []
+        for name, origin in self._origins[k].items():
+            names += origin.names()
+        return names
+
+    def _items(self, k):
+        """Retrieves all items from all origins
+        """
+        self._ensure_fresh(k)
+        return self._items_cache[k]
 
     def _lookup(self, k, q=None):
         logger.debug("Looking up %s: %s" % (k, q))
         if q is None:
             return self._items(k)
-        item = None
-        for name, origin in self._origins[k].items():
-            item = origin.lookup(q)
+        self._ensure_fresh(k)
+        if q in self._index[k]:
+            name, item = self._index[k][q]
+            origin = self._origins[k][name]
+            if not getattr(origin, "reusable_items", True):
+                item = origin.lookup(q)
+            return item
+        # Not (yet) indexed, the origins might know it nevertheless, they
+        # are asked in parallel and get origin_timeout seconds
+        pending = [(oname, self._query(k, oname, ("lookup", q), o.lookup, q))
+                   for oname, o in self._origins[k].items()]
+        deadline = time.time() + self.origin_timeout
+        for name, (query, result) in pending:
+            try:
+                item = self._lookup_result(k, name, q, query, result,
+                                           deadline)
+            except TimeoutError:
+                logger.warning("Origin %s timed out looking up %s" %
+                               (name, q))
+                continue
+            except Exception as e:
+                logger.warning("Origin %s failed looking up %s: %s" %
+                               (name, q, e))
+                continue
             if item is not None:
-                break
-        return item
+                self.invalidate(k)
+                return item
+        return None
+
+    def _lookup_result(self, k, name, q, query, result, deadline):
+        """Wait for the query origin name was busy with and find item q in
+        it's answer. After an other lookup, or listing the items of an
+        origin which creates them per lookup, q is looked up itself.
+        """
+        origin = self._origins[k][name]
+        while True:
+            answer = result.get(max(0, deadline - time.time()))
+            if query == ("lookup", q):
+                return answer
+            if query == ("items",) and \
+                    getattr(origin, "reusable_items", True):
+                items = answer[0]
+                return items.get(q) if type(items) is dict else None
+            query, result = self._query(k, name, ("lookup", q),
+                                        origin.lookup, q)
+
+    def diagnostics(self):
+        """Per category and origin: status, latency and number of items of
+        the last refresh
+        """
+        return self._stats
 
     def plans(self, q=None):
         return self._lookup("plans", q)
@@ -246,19 +512,19 @@ class Inventory(object):
 
     def check(self):
         logger.debug("Self checking invetory …")
-        ps = self.plans()
-        ts = self.testsuites()
-        prs = self.profiles()
-        hs = self.hosts()
+        ps = self.names("plans")
+        ts = self.names("testsuites")
+        prs = self.names("profiles")
+        hs = self.names("hosts")
         n = 10
         logger.debug("Found %d plan(s): %s …" %
-                     (len(ps), ps.keys()[0:n]))
+                     (len(ps), ps[0:n]))
         logger.debug("Found %d testsuite(s): %s …" %
-                     (len(ts), ts.keys()[0:n]))
+                     (len(ts), ts[0:n]))
         logger.debug("Found %d profiles(s): %s …" %
-                     (len(prs), prs.keys()[0:n]))
+                     (len(prs), prs[0:n]))
         logger.debug("Found %d hosts(s): %s …" %
-                     (len(hs), hs.keys()[0:n]))
+                     (len(hs), hs[0:n]))
 
     def create_profile(self, oname, pname, kernel, initrd, kargs):
         """Create a profile in the profile origin with the name.
@@ -267,6 +533,28 @@ class Inventory(object):
             raise Exception("Unknown origin: %s" % oname)
         origin = self._origins["profiles"][oname]
         origin.create_item(pname, kernel, initrd, kargs)
+        self.invalidate("profiles")
+
+    def start_refreshing(self, interval=60):
+        """Periodically rebuild the indexes in the background
+        """
+        self._refresher = Inventory.Refresher(self, interval)
+        self._refresher.start()
+
+    class Refresher(utils.PollingWorkerDaemon):
+        inventory = None
+
+        def __init__(self, inventory, interval):
+            self.inventory = inventory
+            utils.PollingWorkerDaemon.__init__(self, interval)
+
+        def work(self):
+            for k in self.inventory._origins.keys():
+                try:
+                    self.inventory.refresh(k)
+                except Exception as e:
+                    logger.warning("Refreshing the %s index failed: %s" %
+                                   (k, e))
 
 
 class JobSpec(UpdateableObject):
@@ -311,6 +599,15 @@ class Testplan(object):
         self.variables = {}
         self.id = random.randrange(10**2, 10**4)  # FIXME make jobs!
 
+    def instantiate(self):
+        """Returns an independent copy of this plan to be run.
+        Plans are cached by the origins, but running a plan substitutes
+        variables in place.
+        """
+        plan = copy.deepcopy(self)
+        plan.id = random.randrange(10**2, 10**4)
+        return plan
+
     def timeout(self):
         timeout = None
         if self.inventory:
@@ -358,6 +655,8 @@ class Testplan(object):
 
             logger.debug("New item: %s" % item)
             if kwargs and hasattr(item, "__dict__"):
+                # Items are shared by the inventory, only change a copy
+                item = copy.copy(item)
                 update_properties_only(item, kwargs)
 
             props = {k: item}
@@ -410,6 +709,47 @@ class Testplan(object):
         return hash(str(self.name))
 
 
+class TestsuiteView(object):
+    """An immutable, flattened view of the testcases of a suite.
+
+    >>> view = TestsuiteView([Testset("a", ["x.sh", "y.sh"]),
+    ...                       Testset("b", ["z.sh"])])
+    >>> [c.name for c in view.testcases]
+    ['x.sh', 'y.sh', 'z.sh']
+    >>> view.deadlines, view.timeout
+    ((60, 120, 180), 180)
+
+    Timeouts read from YAML can be strings:
+    >>> c = Testcase("s.sh")
+    >>> c.timeout = "30"
+    >>> TestsuiteView([Testset("c", [c])]).deadlines
+    (30,)
+    """
+    __slots__ = ["signature", "testcases", "deadlines", "timeout"]
+
+    def __init__(self, testsets):
+        self.signature = TestsuiteView.signature_of(testsets)
+        cases = []
+        for tset in testsets:
+            cases += tset.testcases()
+        self.testcases = tuple(cases)
+        # deadlines[n] is the time allowed up to and including testcase n
+        deadlines = []
+        total = 0
+        for c in self.testcases:
+            total += int(c.timeout)
+            deadlines.append(total)
+        self.deadlines = tuple(deadlines)
+        self.timeout = sum([int(c.timeout) for c in self.testcases])
+
+    @staticmethod
+    def signature_of(testsets):
+        """Changes when testsets or their testcases are replaced or added
+        """
+        return tuple([(id(tset), id(tset.testcases()),
+                       len(tset.testcases())) for tset in testsets])
+
+
 class Testsuite(object):
     """Represents a list of testsets.
     All testsets (and subsequently testcases) are tested in serial.
@@ -421,18 +761,31 @@ class Testsuite(object):
     origin = None
     description = None
 
+    _view = None
+    # (view, dict) of the last __to_dict__
+    _dict = None
+
     def __init__(self, name, testsets=[]):
         self.name = name
         self.testsets = testsets
 
+    def view(self):
+        """The flattened testcases and their deadlines, rebuilt when the
+        testsets changed.
+        """
+        testsets = self.testsets
+        view = self._view
+        if view is None or \
+           view.signature != TestsuiteView.signature_of(testsets):
+            view = TestsuiteView(testsets)
+            self._view = view
+        return view
+
     def testcases(self):
         """All testcases of this suite.
         Removes the intermediate Testset layer. So flattens the hierarchy.
         """
-        cases = []
-        for tset in self.testsets:
-            cases += tset.testcases()
-        return cases
+        return self.view().testcases
 
     def libs(self):
         """All dict of (libname, libpath) of libs
@@ -446,7 +799,13 @@ class Testsuite(object):
         """Calculates the time the suite has to complete before it times out.
         This is the sum of all testcases timeouts.
         """
-        return sum([int(c.timeout) for c in self.testcases()])
+        return self.view().timeout
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("_view", None)
+        state.pop("_dict", None)
+        return state
 
     def __str__(self):
         testsets_str = "\n".join([str(ts) for ts in self.testsets])
@@ -454,13 +813,18 @@ class Testsuite(object):
 
     def __to_dict__(self):
         """Is used to derive a JSON and XML description.
+        The dict is shared, until the testsets change.
         """
-        return {"name": self.name,
-                "timeout": self.timeout(),
-                "testsets": [t.__to_dict__() for t in self.testsets],
-                "libs": self.libs(),
-                "description": self.description
-                }
+        view = self.view()
+        if self._dict is None or self._dict[0] is not view:
+            self._dict = (view, {"name": self.name,
+                                 "timeout": view.timeout,
+                                 "testsets": [t.__to_dict__()
+                                              for t in self.testsets],
+                                 "libs": self.libs(),
+                                 "description": self.description
+                                 })
+        return self._dict[1]
 
     def get_archive(self, subdir="testcases"):
         """Creates an archive containing all testcases and optional testcase
@@ -488,6 +852,7 @@ class Testsuite(object):
                                                            "testcases/suites/")
         >>> suite = suites["examplesuite"]
         >>> archive = io.BytesIO(suite.get_archive().getvalue())
+        >>> import tarfile
         >>> tarball = tarfile.open(fileobj=archive, mode="r")
         >>> import re
         >>> all([re.match("testcases/", n) for n in tarball.getnames()])
@@ -495,16 +860,20 @@ class Testsuite(object):
         >>> any([re.match("testcases/lib/", n) for n in tarball.getnames()])
         True
         """
-        r = io.BytesIO()
+        return io.BytesIO("".join(self.iter_archive(subdir)))
+
+    def iter_archive(self, subdir="testcases", codec="bz2"):
+        """Yields the archive described in get_archive in chunks, compressed
+        with the given codec (see tarstream.codecs)
+        """
+        tar = TarStream(codec)
         logger.debug("Preparing archive for testsuite %s" % self.name)
-        with tarfile.open(fileobj=r, mode="w:bz2") as archive:
-            self.__add_testcases_to_archive(archive, subdir)
-            self.__add_libs_to_archive(archive, os.path.join(subdir, "lib"))
-        r.flush()
-        return r
+        return tar.stream(itertools.chain(
+            self.__testcase_members(tar, subdir),
+            self.__lib_members(tar, os.path.join(subdir, "lib"))))
 
-    def __add_testcases_to_archive(self, archive, subdir):
-        """Add many testcases to the archive
+    def __testcase_members(self, tar, subdir):
+        """The members of all testcases and their metadata files
         """
         stepn = 0
         for testcase in self.testcases():
@@ -517,40 +886,25 @@ class Testsuite(object):
             arcname = os.path.join(subdir, "%d-%s" %
                                    (stepn,
                                    os.path.basename(testcase.filename)))
-            self.__add_testcase_to_archive(archive, arcname, testcase)
+            # The testcase itself
+            yield tar.data_member(arcname, testcase.source())
+
+            # A file with testcase dependencies
+            dependencies = "\n".join(testcase.dependencies)
+            yield tar.data_member(arcname + ".deps",
+                                  "\n".join(dependencies))
+
+            # A testcase extra dir
+            testcaseextradir = testcase.filename + ".d"
+            if os.path.exists(testcaseextradir):
+                logger.debug("Adding extra dir: %s" % testcaseextradir)
+                for member in tar.file_members(testcaseextradir,
+                                               arcname + ".d"):
+                    yield member
             stepn += 1
 
-    def __add_testcase_to_archive(self, archive, arcname, testcase):
-        """Add a single testcase to the archive
-        And testcase specififc metadata files
-        """
-        # Add the testcase itself
-        self.__add_data_to_archive(archive, arcname, testcase.source())
-
-        # Add a file with testcase dependencies
-        arcdepsname = arcname + ".deps"
-        dependencies = "\n".join(testcase.dependencies)
-        self.__add_data_to_archive(archive, arcdepsname,
-                                   "\n".join(dependencies))
-
-        # Add a testcase extra dir
-        testcaseextradir = testcase.filename + ".d"
-        if os.path.exists(testcaseextradir):
-            logger.debug("Adding extra dir: %s" % testcaseextradir)
-            arcname += ".d"
-            archive.add(testcaseextradir, arcname=arcname,
-                        recursive=True)
-
-    def __add_data_to_archive(self, archive, arcname, data):
-        """Adds data as a file to an archive
-        """
-        srcobj = io.BytesIO(data)
-        info = tarfile.TarInfo(name=arcname)
-        info.size = len(srcobj.getvalue())
-        info.mtime = time.time()
-        archive.addfile(tarinfo=info, fileobj=srcobj)
-
-    def __add_libs_to_archive(self, archive, subdir):
+    def __lib_members(self, tar, subdir):
+        added = set()
         for libname, libpath in self.libs().items():
             if not os.path.exists(libpath):
                 msg = ("Adding lib '%s' / '%s' failed because path does " +
@@ -559,20 +913,23 @@ class Testsuite(object):
                 continue
 
             arcname = os.path.join(subdir, libname)
-            if arcname in archive.getnames():
+            if arcname in added:
                 logger.warning("Adding lib failed because arcname " +
                                "with name '%s' already exists" % libname)
                 continue
+            added.add(arcname)
 
             logger.debug("Adding library '%s' from '%s'" % (libname, libpath))
-            archive.add(libpath, arcname=arcname, recursive=True)
+            for member in tar.file_members(libpath, arcname):
+                yield member
 
     def validate(self):
         """Validate that all paths and check testcases can be gathered
         """
         valid = True
         try:
-            self.get_archive()
+            for chunk in self.iter_archive(codec="none"):
+                pass
         except:
             valid = False
         return valid
@@ -584,9 +941,11 @@ class Testset(object):
 
     name = None
     description = None
+    filename = None
     _libs = None
     _testcases = None
     _dependencies = []
+    _frozen = False
 
     def __init__(self, name, testcases=[], libs=None):
         self.name = name
@@ -611,6 +970,8 @@ class Testset(object):
         >>> ts.libs({"common": "libs/special"})
         {'common': 'libs/special'}
         """
+        if libs is not None:
+            self._check_frozen()
         if type(libs) is dict:
             self._libs = libs
         elif type(libs) is list:
@@ -628,10 +989,30 @@ class Testset(object):
     def add(self, cs):
         """Convenience function to add a testcase by filename or as an object.
         """
+        self._check_frozen()
         for c in cs:
             self._testcases.append(c if isinstance(c, Testcase)
                                    else Testcase(c))
 
+    def freeze(self):
+        """Make this set and it's testcases immutable, so they can be shared
+
+        >>> ts = Testset("foo", ["bar.sh"])
+        >>> ts.freeze()
+        >>> ts.add(["baz.sh"])
+        Traceback (most recent call last):
+        ...
+        AttributeError: Testset foo is frozen
+        """
+        for c in self._testcases:
+            c.freeze()
+        self._testcases = tuple(self._testcases)
+        self._frozen = True
+
+    def _check_frozen(self):
+        if self._frozen:
+            raise AttributeError("Testset %s is frozen" % self.name)
+
     def __str__(self):
         return "%s: %s" % (self.name, str(["%s: %s" % (n, c) for n, c in
                                            enumerate(self.testcases())]))
@@ -653,23 +1034,62 @@ class Testcase(object):
     on a host.
     A testcase can fail or succeed and has a timeout. Sometimes a testcase is
     expected to fail.
+    Testcases are shared between sets and suites, once frozen they can not
+    be changed anymore.
+
+    >>> tc = Testcase("foo.sh")
+    >>> tc.update_props({"timeout": 5, "owner": "me"})
+    >>> tc.freeze()
+    >>> tc.__to_dict__()["owner"], tc.timeout
+    ('me', 5)
+    >>> tc.timeout = 10
+    Traceback (most recent call last):
+    ...
+    AttributeError: Testcase foo.sh is frozen
     """
-    name = None
-    filename = None
-    timeout = 60
-    expect_failure = False
-    description = None
-    dependencies = []
+    __slots__ = ["name", "filename", "timeout", "expect_failure",
+                 "description", "dependencies", "properties", "_frozen"]
 
     def __init__(self, filename=None, name=None):
         if name is None and filename is None:
             raise Exception("At least a filename must be given")
+        self._frozen = False
         if name is None:
             self.name = os.path.basename(filename)
         else:
             self.name = name
         self.filename = filename
+        self.timeout = 60
+        self.expect_failure = False
+        self.description = None
         self.dependencies = []
+        self.properties = {}
+
+    def update_props(self, kwargs):
+        """Set the known attributes, keep all others as properties
+        """
+        for k, v in kwargs.items():
+            if k in Testcase.__slots__ and not k.startswith("_"):
+                setattr(self, k, v)
+            else:
+                self.properties[k] = v
+
+    def freeze(self):
+        if not self._frozen:
+            self.dependencies = tuple(self.dependencies)
+            self._frozen = True
+
+    def __setattr__(self, name, value):
+        if getattr(self, "_frozen", False):
+            raise AttributeError("Testcase %s is frozen" % self.name)
+        object.__setattr__(self, name, value)
+
+    def __getstate__(self):
+        return {k: getattr(self, k) for k in Testcase.__slots__}
+
+    def __setstate__(self, state):
+        for k, v in state.items():
+            object.__setattr__(self, k, v)
 
     def source(self):
         """Returns the source of this testcase
@@ -685,7 +1105,10 @@ class Testcase(object):
     def __to_dict__(self):
         """Is used to derive a JSON and XML description.
         """
-        return self.__dict__
+        d = dict(self.properties)
+        d.update({k: getattr(self, k) for k in Testcase.__slots__
+                  if k not in ["properties", "_frozen"]})
+        return d
 
 
 class TestSession(UpdateableObject):
@@ -694,17 +1117,44 @@ class TestSession(UpdateableObject):
 
     do_cleanup = False
 
+    # A lock per artifact, held while it is written
+    _artifact_locks = None
+    _artifact_locks_lock = None
+
     def __init__(self, cookie, session_path, cleanup=True):
         assert session_path is not None, "session path can not be None"
 
         self.do_cleanup = cleanup
         self.cookie = cookie
+        self._artifact_locks = {}
+        self._artifact_locks_lock = threading.Lock()
         self.dirname = tempfile.mkdtemp(suffix="-" + self.cookie,
                                         dir=session_path)
         os.mkdir(self.__artifacts_path())
         run("chmod -R a+X '%s'" % self.dirname)
         logger.info("Starting session %s in %s" % (self.cookie, self.dirname))
 
+    @classmethod
+    def resume(cls, cookie, dirname, cleanup=True):
+        """Continue a session in an existing session dir
+
+        >>> s = TestSession("cookie", "/tmp/")
+        >>> s.add_artifact("test", "foo")
+        >>> TestSession.resume("cookie", s.dirname).get_artifact("test")
+        'foo'
+        """
+        session = cls.__new__(cls)
+        session.do_cleanup = cleanup
+        session.cookie = cookie
+        session.dirname = dirname
+        session._artifact_locks = {}
+        session._artifact_locks_lock = threading.Lock()
+        if not os.path.isdir(session.__artifacts_path()):
+            raise Exception("Can not resume session %s, %s is gone" %
+                            (cookie, dirname))
+        logger.info("Resuming session %s in %s" % (cookie, dirname))
+        return session
+
     def remove(self):
         """Remove the session dir and all remaining artifacts
         """
@@ -729,6 +1179,11 @@ class TestSession(UpdateableObject):
             except Exception as e:
                 logger.warning("Exception while removing '%s': %s" %
                                (artifact, e.message))
+        if os.path.isdir(self.__uploads_path()):
+            for upload in os.listdir(self.__uploads_path()):
+                logger.debug("Removing unfinished upload '%s'" % upload)
+                os.remove(self.__uploads_path(upload))
+            os.rmdir(self.__uploads_path())
 
     def __artifacts_path(self, name=""):
         """Returns the absoulte path to the artifacts folder
@@ -736,6 +1191,12 @@ class TestSession(UpdateableObject):
         assert self.dirname is not None
         return os.path.join(self.dirname, "artifacts", name)
 
+    def __uploads_path(self, name=""):
+        """Returns the absolute path to the folder of unfinished uploads
+        """
+        assert self.dirname is not None
+        return os.path.join(self.dirname, "uploads", name)
+
     def add_artifact(self, name, data):
         """Adds an artifact
         """
@@ -745,6 +1206,148 @@ class TestSession(UpdateableObject):
         with open(afilename, "wb") as afile:
             afile.write(data)
 
+    def _artifact_lock(self, name):
+        with self._artifact_locks_lock:
+            if name not in self._artifact_locks:
+                self._artifact_locks[name] = threading.Lock()
+            return self._artifact_locks[name]
+
+    def uploaded_size(self, name):
+        """Returns the number of bytes an unfinished upload already has
+        """
+        try:
+            return os.path.getsize(self.__uploads_path(name))
+        except OSError:
+            return 0
+
+    def upload_artifact(self, name, stream, length, offset=0, total=None,
+                        checksum=None, chunk_size=1024 * 1024):
+        """Writes length bytes (all if None) from stream at offset of an
+        artifact.
+        The data is written to a part file in chunks, offset 0 starts a new
+        upload. Once total (or offset + length) bytes were received, the
+        checksum ("<algorithm>:<hexdigest>") is verified and the part file
+        is moved into place.
+
+        >>> import StringIO
+        >>> s = TestSession("cookie", "/tmp/")
+        >>> s.upload_artifact("log", StringIO.StringIO("foo"), 3, total=6)
+        False
+        >>> s.uploaded_size("log"), s.artifacts()
+        (3, [])
+        >>> s.upload_artifact("log", StringIO.StringIO("bar"), 3, offset=3,
+        ...                   checksum="md5:3858f62230ac3c915f300c664312c63f")
+        True
+        >>> s.get_artifact("log"), s.uploaded_size("log")
+        ('foobar', 0)
+
+        Returns:
+            True if the artifact is complete
+        """
+        assert("/" not in name and "\\" not in name)
+        with self._artifact_lock(name):
+            if offset and offset != self.uploaded_size(name):
+                raise ValueError("Upload of '%s' is at %d, not at %d" %
+                                 (name, self.uploaded_size(name), offset))
+            if not os.path.isdir(self.__uploads_path()):
+                os.mkdir(self.__uploads_path())
+
+            partfilename = self.__uploads_path(name)
+            with open(partfilename, "ab" if offset else "wb") as partfile:
+                received = self.__copy(stream, partfile, length, chunk_size)
+            if length is not None and received < length:
+                raise IOError("Upload of '%s' ended after %d of %d bytes" %
+                              (name, received, length))
+
+            if offset + received < (total or offset + received):
+                return False
+
+            if checksum:
+                algorithm, expected = checksum.split(":", 1)
+                digest = hashlib.new(algorithm)
+                with open(partfilename, "rb") as partfile:
+                    for chunk in iter(lambda: partfile.read(chunk_size), ""):
+                        digest.update(chunk)
+                if digest.hexdigest() != expected.lower():
+                    os.remove(partfilename)
+                    raise ValueError("Checksum of '%s' does not match: %s" %
+                                     (name, digest.hexdigest()))
+
+            os.rename(partfilename, self.__artifacts_path(name))
+            return True
+
+    def append_artifact(self, name, stream, length, offset=None,
+                        chunk_size=1024 * 1024):
+        """Appends length bytes (all if None) from stream to an artifact,
+        if an offset is given it must be the current size of the artifact,
+        so a retried append can not duplicate data.
+
+        >>> import StringIO
+        >>> s = TestSession("cookie", "/tmp/")
+        >>> s.append_artifact("log", StringIO.StringIO("foo"), 3)
+        3
+        >>> s.append_artifact("log", StringIO.StringIO("bar"), 3, offset=3)
+        6
+        >>> s.read_artifact("log", 2), s.tail_artifact("log", 2)
+        (('obar', 6), 'ar')
+        >>> s.append_artifact("log", StringIO.StringIO("!"), None)
+        7
+
+        Returns:
+            The new size of the artifact
+        """
+        assert("/" not in name and "\\" not in name)
+        # The size must not change between the check and the write
+        with self._artifact_lock(name):
+            size = self.artifact_size(name)
+            if offset is not None and offset != size:
+                raise ValueError("Artifact '%s' is at %d, not at %d" %
+                                 (name, size, offset))
+            with open(self.__artifacts_path(name), "ab") as afile:
+                received = self.__copy(stream, afile, length, chunk_size)
+            if length is not None and received < length:
+                raise IOError("Append to '%s' ended after %d of %d bytes" %
+                              (name, received, length))
+            return size + received
+
+    def __copy(self, stream, dst, length, chunk_size):
+        received = 0
+        while length is None or received < length:
+            chunk = stream.read(chunk_size if length is None
+                                else min(chunk_size, length - received))
+            if not chunk:
+                break
+            dst.write(chunk)
+            received += len(chunk)
+        return received
+
+    def artifact_size(self, name):
+        try:
+            return os.path.getsize(self.__artifacts_path(name))
+        except OSError:
+            return 0
+
+    def read_artifact(self, name, offset=0, size=-1):
+        """Returns up to size bytes of an artifact from offset on, and the
+        offset after them
+        """
+        with open(self.__artifacts_path(name), "rb") as afile:
+            afile.seek(offset)
+            data = afile.read(size)
+        return data, offset + len(data)
+
+    def tail_artifact(self, name, size):
+        """Returns the last size bytes of an artifact
+        """
+        return self.read_artifact(name, max(0, self.artifact_size(name) -
+                                            size))[0]
+
+    def artifact_filename(self, name):
+        """Returns the absolute path of an artifact
+        """
+        assert("/" not in name and "\\" not in name)
+        return self.__artifacts_path(name)
+
     def get_artifact(self, name):
         """Returns the data/content of an artifact
         >>> s = TestSession("cookie", "/tmp/")
@@ -775,20 +1378,33 @@ class TestSession(UpdateableObject):
                    for fn in fns]
         return fns
 
-    def get_artifacts_archive(self, selection=None):
-        """Return all artifacts as an .tar.bz2
+    def iter_artifacts_archive(self, selection=None, codec="bz2"):
+        """Yields an archive of the (selected) artifacts in chunks
+
+        >>> import tarfile
+        >>> s = TestSession("cookie", "/tmp/")
+        >>> s.add_artifact("test", "foo")
+        >>> archive = "".join(s.iter_artifacts_archive(["test", "gone"],
+        ...                                            codec="gz"))
+        >>> tarfile.open(fileobj=io.BytesIO(archive)).getnames()
+        ['test']
         """
-        selection = selection or self.artifacts()
-        container = io.BytesIO()
+        tar = TarStream(codec)
+        available = set(self.artifacts())
+        selection = selection or sorted(available)
         logger.debug("Preparing artifacts archive for session %s" %
                      self.cookie)
-        with tarfile.open(fileobj=container, mode="w:bz2") as archive:
+
+        def members():
             for artifact in selection:
-                if artifact not in self.artifacts():
+                if artifact not in available:
                     logger.debug("Artifact not here: %s" % artifact)
+                    continue
                 logger.debug("Adding artifact %s" % artifact)
-                archive.add(self.__artifacts_path(artifact), artifact)
-        return container
+                for member in tar.file_members(
+                        self.__artifacts_path(artifact), artifact):
+                    yield member
+        return tar.stream(members())
 
     def __enter__(self):
         logger.debug("With session '%s'" % self.cookie)
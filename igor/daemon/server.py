@@ -0,0 +1,419 @@
+#
+# Copyright (C) 2012  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Fabian Deutsch <fabiand@fedoraproject.org>
+#
+# -*- coding: utf-8 -*-
+
+"""
+A WSGI server which serves requests from a bounded pool of threads, and
+file responses for it.
+"""
+
+from igor import log
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, \
+    ServerHandler
+import Queue
+import bottle
+import email.utils
+import errno
+import os
+import re
+import select
+import socket
+import threading
+
+try:
+    from sendfile import sendfile
+except ImportError:
+    sendfile = None
+
+
+logger = log.getLogger(__name__)
+
+
+class FileRange(object):
+    """Reads length bytes of a file from offset on
+
+    >>> import tempfile
+    >>> f = tempfile.TemporaryFile()
+    >>> f.write("0123456789")
+    >>> r = FileRange(f, 2, 5)
+    >>> r.read(3), r.read(), r.read(), r.tell()
+    ('234', '56', '', 7)
+    """
+    _file = None
+    _remaining = None
+
+    def __init__(self, fileobj, offset, length):
+        self._file = fileobj
+        self._file.seek(offset)
+        self._remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._file.read(size)
+        self._remaining -= len(data)
+        return data
+
+    def tell(self):
+        return self._file.tell()
+
+    def fileno(self):
+        return self._file.fileno()
+
+    def close(self):
+        self._file.close()
+
+
+class BodyTooLarge(IOError):
+    pass
+
+
+class ChunkedBody(object):
+    """Decodes a chunked request body while it is read, raises BodyTooLarge
+    as soon as more than max_size bytes arrived
+
+    >>> import StringIO
+    >>> raw = "3\\r\\nfoo\\r\\n4;ext=1\\r\\nbar!\\r\\n0\\r\\n\\r\\n"
+    >>> b = ChunkedBody(StringIO.StringIO(raw))
+    >>> b.read(2), b.read(), b.read(), b.received
+    ('fo', 'obar!', '', 7)
+    >>> ChunkedBody(StringIO.StringIO(raw), 5).read(8)
+    Traceback (most recent call last):
+    ...
+    BodyTooLarge: Body is larger than 5 bytes
+    """
+    received = 0
+    max_size = None
+
+    _file = None
+    _remaining = 0
+    _done = False
+
+    def __init__(self, fileobj, max_size=None):
+        self._file = fileobj
+        self.max_size = max_size
+
+    def read(self, size=-1):
+        data = []
+        while not self._done and size != 0:
+            if self._remaining == 0:
+                self._next_chunk()
+                continue
+            n = self._remaining if size < 0 else min(size, self._remaining)
+            chunk = self._file.read(n)
+            if not chunk:
+                raise IOError("Chunked body ended early")
+            self._remaining -= len(chunk)
+            if self._remaining == 0:
+                self._file.readline(2)
+            self.received += len(chunk)
+            if self.max_size is not None and self.received > self.max_size:
+                raise BodyTooLarge("Body is larger than %d bytes" %
+                                   self.max_size)
+            data.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return "".join(data)
+
+    def _next_chunk(self):
+        line = self._file.readline(1024)
+        try:
+            self._remaining = int(line.split(";", 1)[0].strip(), 16)
+        except ValueError:
+            raise IOError("Invalid chunk header: %r" % line)
+        if self._remaining == 0:
+            # Skip the trailers up to the empty line which ends the body
+            while self._file.readline(1024).strip():
+                pass
+            self._done = True
+
+
+def parse_byte_range(value, size):
+    """Returns the (first, last) byte of a single range of a Range header,
+    None if there is none, or False if it can not be satisfied
+
+    >>> [parse_byte_range(v, 10) for v in ["bytes=2-4", "bytes=5-",
+    ...                                    "bytes=-3", "bytes=0-99"]]
+    [(2, 4), (5, 9), (7, 9), (0, 9)]
+    >>> parse_byte_range("bytes=10-", 10), parse_byte_range("bytes=0-1,5-",
+    ...                                                     10)
+    (False, None)
+    """
+    m = re.match(r"bytes=(\d*)-(\d*)$", value.strip())
+    if not m or m.groups() == ("", ""):
+        return None
+    first, last = m.groups()
+    if first == "":
+        first, last = max(0, size - int(last)), size - 1
+    else:
+        first, last = int(first), min(int(last or size - 1), size - 1)
+    if first > last:
+        return False
+    return first, last
+
+
+def file_response(filename, content_type="application/octet-stream"):
+    """Returns a response which streams a file, large files are not read
+    into memory.
+    Supports Range and If-Range requests (a single range), and answers
+    If-None-Match (ETag) and If-Modified-Since with 304.
+    """
+    if not os.path.isfile(filename):
+        return bottle.HTTPError(404, "File does not exist.")
+    stats = os.stat(filename)
+    size = stats.st_size
+    etag = '"%x-%x-%x"' % (stats.st_ino, size, int(stats.st_mtime))
+    last_modified = email.utils.formatdate(stats.st_mtime, usegmt=True)
+    headers = {"Content-Type": content_type,
+               "ETag": etag,
+               "Last-Modified": last_modified,
+               "Accept-Ranges": "bytes"}
+
+    request = bottle.request
+    if_none_match = request.get_header("If-None-Match")
+    if_modified_since = bottle.parse_date(
+        request.get_header("If-Modified-Since", "").split(";")[0])
+    if (if_none_match and etag in if_none_match) or \
+            (not if_none_match and if_modified_since and
+             int(stats.st_mtime) <= if_modified_since):
+        return bottle.HTTPResponse(status=304, headers=headers)
+
+    status, first, last = 200, 0, size - 1
+    byte_range = request.get_header("Range")
+    if_range = request.get_header("If-Range")
+    if byte_range and if_range in (None, etag, last_modified):
+        byte_range = parse_byte_range(byte_range, size)
+        if byte_range is False:
+            headers["Content-Range"] = "bytes */%d" % size
+            return bottle.HTTPResponse(status=416, headers=headers)
+        if byte_range:
+            status, (first, last) = 206, byte_range
+            headers["Content-Range"] = "bytes %d-%d/%d" % (first, last, size)
+
+    # The length is fixed now, even if the file grows meanwhile
+    headers["Content-Length"] = str(last - first + 1)
+    body = FileRange(open(filename, "rb"), first, last - first + 1)
+    return bottle.HTTPResponse(body, status, headers=headers)
+
+
+def client_disconnected(environ):
+    """Returns True if the client of a request closed the connection, can
+    only tell for requests served by the KeepAliveRequestHandler
+    """
+    connection = environ.get("igor.connection")
+    if connection is None:
+        return False
+    try:
+        if not select.select([connection], [], [], 0)[0]:
+            return False
+        # Readable without data means closed, else it is the next request
+        return connection.recv(1, socket.MSG_PEEK) == ""
+    except socket.error:
+        return True
+
+
+class KeepAliveServerHandler(ServerHandler):
+    """Answers with HTTP/1.1 and tells the request handler if the
+    connection can be kept open
+    """
+    http_version = "1.1"
+
+    def sendfile(self):
+        """Sends file responses with sendfile(2) if pysendfile is
+        installed, without copying them through python
+        """
+        filelike = self.result.filelike
+        if sendfile is None or not hasattr(filelike, "fileno") or \
+                "Content-Length" not in self.headers:
+            return False
+        if not self.headers_sent:
+            self.send_headers()
+        self._flush()
+
+        connection = self.request_handler.connection
+        timeout = connection.gettimeout()
+        offset = filelike.tell()
+        remaining = int(self.headers["Content-Length"])
+        while remaining > 0:
+            try:
+                sent = sendfile(connection.fileno(), filelike.fileno(),
+                                offset, remaining)
+            except OSError as e:
+                # The socket is non-blocking if it has a timeout
+                if e.errno != errno.EAGAIN:
+                    raise
+                if not select.select([], [connection], [], timeout)[1]:
+                    raise socket.timeout("Sending the file timed out")
+                continue
+            if sent == 0:
+                break
+            offset += sent
+            remaining -= sent
+            self.bytes_sent += sent
+        return True
+
+    def cleanup_headers(self):
+        ServerHandler.cleanup_headers(self)
+        # Without a length the client can only see the end of the response
+        # when the connection is closed
+        if "Content-Length" not in self.headers:
+            self.request_handler.close_connection = 1
+        # A kept connection holds it's worker, give it up if other
+        # connections are waiting for one
+        if self.request_handler.server.is_busy():
+            self.request_handler.close_connection = 1
+        if self.request_handler.close_connection:
+            self.headers["Connection"] = "close"
+
+
+class KeepAliveRequestHandler(WSGIRequestHandler):
+    """Serves several requests on one connection (HTTP/1.1 keep-alive)
+    """
+    protocol_version = "HTTP/1.1"
+
+    def handle(self):
+        self.close_connection = 1
+        self.handle_one_request()
+        while not self.close_connection:
+            self.connection.settimeout(self.server.keepalive_timeout)
+            self.handle_one_request()
+
+    def handle_one_request(self):
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except socket.timeout:
+            self.close_connection = 1
+            return
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            return
+
+        if not self.parse_request():
+            return
+
+        # A body the application did not read would end up in front of the
+        # next request
+        if self.headers.get("Content-Length", "0") != "0" or \
+                "Transfer-Encoding" in self.headers:
+            self.close_connection = 1
+
+        self.connection.settimeout(self.server.request_timeout)
+        environ = self.get_environ()
+        environ["igor.connection"] = self.connection
+        handler = KeepAliveServerHandler(
+            self.rfile, self.wfile, self.get_stderr(), environ
+        )
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s" % (self.client_address[0], format % args))
+
+
+class PooledWSGIServer(WSGIServer):
+    """Hands each connection to one of a fixed number of worker threads.
+    When queue_size connections are already waiting for a worker, new
+    ones are answered with 503 right away.
+    """
+    workers = None
+    request_timeout = None
+    keepalive_timeout = None
+
+    _queue = None
+    _threads = None
+
+    def __init__(self, server_address, handler_class, workers=16,
+                 queue_size=64, request_timeout=60, keepalive_timeout=5):
+        self.request_queue_size = queue_size
+        WSGIServer.__init__(self, server_address, handler_class)
+        self.workers = workers
+        self.request_timeout = request_timeout
+        self.keepalive_timeout = keepalive_timeout
+        self._queue = Queue.Queue(queue_size)
+        self._threads = []
+        for n in range(workers):
+            thread = threading.Thread(target=self._work,
+                                      name="http-worker-%d" % n)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def process_request(self, request, client_address):
+        request.settimeout(self.request_timeout)
+        # The headers and the body are sent separately, without this the
+        # body of a kept connection waits for the ACK of the headers
+        request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            self._queue.put_nowait((request, client_address))
+        except Queue.Full:
+            logger.warning("All %d workers are busy, rejecting %s" %
+                           (self.workers, client_address[0]))
+            self._reject(request)
+
+    def is_busy(self):
+        """If connections are waiting for a worker
+        """
+        return not self._queue.empty()
+
+    def _reject(self, request):
+        try:
+            request.sendall("HTTP/1.1 503 Service Unavailable\r\n"
+                            "Retry-After: 1\r\n"
+                            "Content-Length: 0\r\n"
+                            "Connection: close\r\n\r\n")
+        except socket.error:
+            pass
+        self.shutdown_request(request)
+
+    def _work(self):
+        while True:
+            request, client_address = self._queue.get()
+            if request is None:
+                break
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        WSGIServer.server_close(self)
+        for thread in self._threads:
+            self._queue.put((None, None))
+
+
+class PooledServer(bottle.ServerAdapter):
+    """The bottle adapter for the PooledWSGIServer, the options are passed
+    to it
+    """
+    def run(self, handler):
+        server = PooledWSGIServer((self.host, self.port),
+                                  KeepAliveRequestHandler, **self.options)
+        server.set_app(handler)
+        logger.info("Serving on %s:%d with %d workers" %
+                    (self.host, self.port, server.workers))
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
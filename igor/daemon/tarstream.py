@@ -0,0 +1,181 @@
+#
+# Copyright (C) 2012  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Fabian Deutsch <fabiand@fedoraproject.org>
+#
+# -*- coding: utf-8 -*-
+
+"""
+Writes tar archives as a stream of chunks, without keeping them in memory.
+"""
+
+from igor import log
+import bz2
+import io
+import os
+import stat
+import tarfile
+import time
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+logger = log.getLogger(__name__)
+
+
+class _Uncompressed(object):
+    def compress(self, data):
+        return data
+
+    def flush(self):
+        return ""
+
+
+# codec: (content type, compressor factory), only the available ones
+codecs = {"none": ("application/x-tar", _Uncompressed),
+          "gz": ("application/gzip",
+                 lambda: zlib.compressobj(6, zlib.DEFLATED,
+                                          zlib.MAX_WBITS | 16)),
+          "bz2": ("application/x-bzip2", bz2.BZ2Compressor)}
+if lzma:
+    codecs["xz"] = ("application/x-xz", lzma.LZMACompressor)
+if zstandard:
+    codecs["zstd"] = ("application/zstd",
+                      lambda: zstandard.ZstdCompressor().compressobj())
+
+
+class TarStream(object):
+    """Streams the members of a tar archive, compressed with one of the
+    available codecs.
+    A member is a tuple of a TarInfo and a function which opens it's
+    content, at most chunk_size bytes of a member are read at once.
+
+    >>> tar = TarStream("gz")
+    >>> members = [tar.data_member("a.txt", "foo")]
+    >>> data = "".join(tar.stream(members))
+    >>> archive = tarfile.open(fileobj=io.BytesIO(data), mode="r:gz")
+    >>> archive.getnames(), archive.extractfile("a.txt").read()
+    (['a.txt'], 'foo')
+    """
+    codec = None
+    content_type = None
+    chunk_size = None
+
+    _compressor_factory = None
+
+    def __init__(self, codec="bz2", chunk_size=64 * 1024):
+        if codec not in codecs:
+            raise ValueError("Unknown or unavailable codec '%s', " % codec +
+                             "available: %s" % ", ".join(sorted(codecs)))
+        self.codec = codec
+        self.content_type, self._compressor_factory = codecs[codec]
+        self.chunk_size = chunk_size
+
+    def data_member(self, arcname, data):
+        """A member with the given data as content
+        """
+        info = tarfile.TarInfo(name=arcname)
+        info.size = len(data)
+        info.mtime = time.time()
+        return (info, lambda: io.BytesIO(data))
+
+    def file_members(self, path, arcname):
+        """The members for a file, or a directory and everything below it
+        """
+        info = self._tarinfo(path, arcname)
+        if info is None:
+            return
+        yield (info, lambda: open(path, "rb"))
+        if info.isdir():
+            for name in sorted(os.listdir(path)):
+                for member in self.file_members(os.path.join(path, name),
+                                                os.path.join(arcname, name)):
+                    yield member
+
+    def _tarinfo(self, path, arcname):
+        st = os.lstat(path)
+        info = tarfile.TarInfo(name=arcname)
+        info.mode = stat.S_IMODE(st.st_mode)
+        info.mtime = st.st_mtime
+        if stat.S_ISREG(st.st_mode):
+            info.size = st.st_size
+        elif stat.S_ISDIR(st.st_mode):
+            info.type = tarfile.DIRTYPE
+        elif stat.S_ISLNK(st.st_mode):
+            info.type = tarfile.SYMTYPE
+            info.linkname = os.readlink(path)
+        else:
+            logger.debug("Skipping special file %s" % path)
+            return None
+        return info
+
+    def stream(self, members):
+        """Yields the compressed archive in chunks of about chunk_size
+        """
+        compressor = self._compressor_factory()
+        pending = []
+        pending_size = 0
+        written = 0
+        for block in self._blocks(members):
+            written += len(block)
+            data = compressor.compress(block)
+            if data:
+                pending.append(data)
+                pending_size += len(data)
+            if pending_size >= self.chunk_size:
+                yield "".join(pending)
+                pending, pending_size = [], 0
+
+        # End of archive marker, padded to a full record
+        end = tarfile.NUL * (2 * tarfile.BLOCKSIZE)
+        written += len(end)
+        end += tarfile.NUL * (-written % tarfile.RECORDSIZE)
+        pending.append(compressor.compress(end))
+        pending.append(compressor.flush())
+        yield "".join(pending)
+
+    def _blocks(self, members):
+        for info, opener in members:
+            yield info.tobuf(tarfile.GNU_FORMAT)
+            if not info.isreg():
+                continue
+            remaining = info.size
+            with opener() as src:
+                while remaining > 0:
+                    data = src.read(min(self.chunk_size, remaining))
+                    if not data:
+                        break
+                    remaining -= len(data)
+                    yield data
+            if remaining > 0:
+                # The file shrank meanwhile, the header can not change
+                logger.warning("%s got shorter while archiving" % info.name)
+            while remaining > 0:
+                yield tarfile.NUL * min(self.chunk_size, remaining)
+                remaining -= self.chunk_size
+            yield tarfile.NUL * (-info.size % tarfile.BLOCKSIZE)
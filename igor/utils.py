@@ -20,6 +20,8 @@
 
 from igor import log
 from lxml import etree
+import copy
+import hashlib
 import os
 import re
 import shlex
@@ -28,9 +30,30 @@ import threading
 import urllib
 import yaml
 
+try:
+    from yaml import CSafeLoader as _SafeLoader, CSafeDumper as YamlDumper
+except ImportError:
+    from yaml import SafeLoader as _SafeLoader, SafeDumper as YamlDumper
+
 logger = log.getLogger(__name__)
 
 
+class YamlLoader(_SafeLoader):
+    """The (C) safe loader, which also reads the python string tags the
+    default dumper wrote, e.g. into older annotations
+
+    >>> list(yaml.load_all("- !!python/unicode 'a'\\n- !!python/str 'b'",
+    ...                    Loader=YamlLoader))
+    [[u'a', 'b']]
+    """
+    pass
+
+YamlLoader.add_constructor(u"tag:yaml.org,2002:python/unicode",
+                           lambda loader, node: loader.construct_scalar(node))
+YamlLoader.add_constructor(u"tag:yaml.org,2002:python/str",
+                           YamlLoader.construct_yaml_str)
+
+
 def run(cmd, with_retval=False):
     import subprocess
     logger.debug("Running: %s" % cmd)
@@ -188,6 +211,26 @@ def synchronized(lock):
     return wrap
 
 
+def synchronized_on(lock_attr):
+    """Synchronization decorator for methods, using the lock the object
+    keeps in the attribute lock_attr.
+
+    >>> class Counter(object):
+    ...     _lock = threading.Lock()
+    ...     @synchronized_on("_lock")
+    ...     def incr(self):
+    ...         return self._lock.locked()
+    >>> Counter().incr()
+    True
+    """
+    def wrap(f):
+        def newFunction(self, *args, **kw):
+            with getattr(self, lock_attr):
+                return f(self, *args, **kw)
+        return newFunction
+    return wrap
+
+
 def xor(a, b):
     return bool(a) ^ bool(b)
 
@@ -202,12 +245,16 @@ def parse_bool(s):
 
 
 class PollingWorkerDaemon(threading.Thread):
+    """Calls work() every interval seconds, or earlier if woken up
+    """
     interval = None
     _stop_event = None
+    _wakeup_event = None
 
     def __init__(self, interval=10):
         self.interval = interval
         self._stop_event = threading.Event()
+        self._wakeup_event = threading.Event()
         threading.Thread.__init__(self)
         self.daemon = True
 
@@ -222,12 +269,20 @@ class PollingWorkerDaemon(threading.Thread):
             if self.is_stopped():
                 self._debug("Stopping")
                 keep_running = False
-            self._stop_event.wait(self.interval)
+            else:
+                self._wakeup_event.wait(self.interval)
+                self._wakeup_event.clear()
         self._debug("Ending")
 
+    def wakeup(self):
+        """Let the worker do it's work now, instead of after the interval
+        """
+        self._wakeup_event.set()
+
     def stop(self):
         self._debug("Requesting worker stop")
         self._stop_event.set()
+        self._wakeup_event.set()
 
     def is_stopped(self):
         return self._stop_event.is_set()
@@ -303,6 +358,86 @@ def obj2xml(root, obj, as_string=False):
     return root
 
 
+class YamlCache(object):
+    """Keeps the parsed documents of YAML texts, keyed by the hash of the
+    text. Callers get a copy, so they are free to modify it.
+
+    >>> cache = YamlCache(maxsize=2)
+    >>> docs = cache.load_all("a: 1\\n---\\nb: [2]")
+    >>> docs
+    [{'a': 1}, {'b': [2]}]
+    >>> docs[1]["b"].append(3)
+    >>> cache.load_all("a: 1\\n---\\nb: [2]")
+    [{'a': 1}, {'b': [2]}]
+    >>> cache.hits, cache.misses
+    (1, 1)
+    """
+    maxsize = None
+    hits = 0
+    misses = 0
+
+    _documents = None
+    _lock = None
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._documents = {}
+        self._lock = threading.Lock()
+
+    def load_all(self, data):
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+        key = hashlib.sha1(data).hexdigest()
+        with self._lock:
+            documents = self._documents.get(key)
+            if documents is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if documents is None:
+            documents = list(yaml.load_all(data, Loader=YamlLoader))
+            with self._lock:
+                if len(self._documents) >= self.maxsize:
+                    self._documents.clear()
+                self._documents[key] = documents
+        return copy.deepcopy(documents)
+
+
+yaml_cache = YamlCache()
+
+
+def yaml_load_all(data, cached=True):
+    """Parse all documents of a YAML text with the (C) safe loader
+
+    >>> yaml_load_all("foo: bar\\n---\\n- 1")
+    [{'foo': 'bar'}, [1]]
+    """
+    if hasattr(data, "read"):
+        data = data.read()
+    if cached:
+        return yaml_cache.load_all(data)
+    return list(yaml.load_all(data, Loader=YamlLoader))
+
+
+def yaml_load(data, cached=True):
+    """Parse the first document of a YAML text
+
+    >>> yaml_load("foo: bar")
+    {'foo': 'bar'}
+    """
+    return next(iter(yaml_load_all(data, cached)), None)
+
+
+def yaml_dump_all(documents):
+    """Dump documents, so they can be read again by yaml_load_all
+
+    >>> yaml_dump_all([{"a": u"b"}])
+    'a: b\\n'
+    """
+    return yaml.dump_all(documents, Dumper=YamlDumper,
+                         default_flow_style=False)
+
+
 class Factory(object):
     """A factory to build testing objects from different structures.
     The current default structure is a file/-system based approach.
@@ -323,7 +458,14 @@ class Factory(object):
     @staticmethod
     def __read_yaml(filename, fileobj=None):
         data = Factory.__open(filename, fileobj).read()
-        return list(yaml.load_all(data))
+        return yaml_load_all(data)
+
+    @staticmethod
+    def __read_yaml_header(filename, fileobj=None):
+        """Only parses the first document
+        """
+        data = Factory.__open(filename, fileobj).read()
+        return next(yaml.load_all(data, Loader=YamlLoader), None)
 
 
 def update_properties_only(obj, kwargs):